@@ -1,4 +1,3 @@
-from celery import chain
 from django.conf import settings
 from rest_framework import authentication
 from rest_framework import permissions
@@ -8,8 +7,7 @@ from rest_framework.views import APIView
 
 from scope.models import DIP
 from scope.models import DublinCore
-from scope.tasks import download_mets
-from scope.tasks import parse_mets
+from scope.tasks import import_ss_mets
 from scope.tasks import save_import_error
 
 
@@ -54,10 +52,8 @@ class DIPStoredWebhook(APIView):
                 {"detail": "A DIP already exists with the same UUID: %s" % dip_uuid},
                 status=status.HTTP_422_UNPROCESSABLE_ENTITY,
             )
-        # Download and parse METS file asynchronously
-        chain(download_mets.s(dip.pk), parse_mets.s(dip.pk)).on_error(
-            save_import_error.s(dip_id=dip.pk)
-        ).delay()
+        # Stream and parse METS file asynchronously
+        import_ss_mets.s(dip.pk).on_error(save_import_error.s(dip_id=dip.pk)).delay()
         return Response(
             {"message": "DIP stored event accepted: %s" % dip_uuid},
             status=status.HTTP_202_ACCEPTED,
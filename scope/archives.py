@@ -0,0 +1,198 @@
+"""Access to the members of tar and zip DIP files without extracting them."""
+
+import os
+import re
+import struct
+import tarfile
+import zipfile
+from contextlib import closing
+from contextlib import contextmanager
+
+# Access copies are placed in the DIP objects directory, prefixed with the UUID
+# of their original file.
+ACCESS_COPY_RE = re.compile(r"(?:^|/)objects/([0-9a-f\-]{36})-[^/]+$")
+
+# Size of the zip local file header before the file name and extra field, and
+# position of their lengths in it.
+ZIP_LOCAL_HEADER_SIZE = 30
+ZIP_LOCAL_HEADER_LENGTHS = struct.Struct("<26xHH")
+
+
+def get_access_copy_uuid(name):
+    """Get the original file UUID from the name of an access copy member."""
+    match = ACCESS_COPY_RE.search(name)
+    return match.group(1) if match else None
+
+
+@contextmanager
+def open_member(dip_path, match, description="Member"):
+    """Open the first file member of a tar or zip DIP accepted by `match`.
+
+    `match` is called with the name of each member. The DIP is opened once and
+    tar files are read as a stream, so compressed tar files are not decompressed
+    beyond the member, and only the central directory of zip files is read to
+    locate it. Yields the member name and size and a binary file object, which
+    can only be read within the context. Raises `ValueError` if the DIP is not a
+    tar or a zip file or `FileNotFoundError` if no member is accepted, with the
+    given member description in the message.
+    """
+    with open(dip_path, "rb") as dip_file:
+        with closing(iter_open_members(dip_file, match)) as members:
+            for member in members:
+                yield member
+                return
+    raise FileNotFoundError("%s not found in DIP file." % description)
+
+
+def iter_open_members(dip_file, match):
+    """Yield the file members of a tar or zip DIP file object accepted by `match`.
+
+    Tar files are read in a single pass as a stream, so non-seekable file
+    objects like HTTP responses are supported and each member must be read
+    before the next one is requested. Zip files need a seekable file object.
+    Yields the name, size and a binary file object of each member. Raises
+    `ValueError` if the DIP is not a tar or a zip file.
+    """
+    try:
+        dip = tarfile.open(fileobj=dip_file, mode="r|*")
+    except tarfile.ReadError:
+        dip = None
+    if dip is not None:
+        with dip:
+            for member in dip:
+                if member.isfile() and match(member.name):
+                    yield member.name, member.size, dip.extractfile(member)
+        return
+    name = os.path.basename(getattr(dip_file, "name", ""))
+    if not dip_file.seekable():
+        raise ValueError("DIP is not a tar file: %s" % name)
+    dip_file.seek(0)
+    try:
+        dip = zipfile.ZipFile(dip_file)
+    except zipfile.BadZipFile:
+        raise ValueError("DIP is not a tar or a zip file: %s" % name)
+    with dip:
+        for info in dip.infolist():
+            if not info.is_dir() and match(info.filename):
+                with dip.open(info) as member_file:
+                    yield info.filename, info.file_size, member_file
+
+
+def iter_members(dip_path):
+    """Yield the name, data offset and size of the file members of a DIP.
+
+    The data offset is only set for the members stored without compression,
+    in uncompressed tar files and stored zip entries, which can be read directly
+    from the DIP file, and it's `None` otherwise. Only the headers of the
+    uncompressed tar files and the central directory of the zip files are read.
+    Compressed tar files would have to be decompressed completely to list their
+    members, so nothing is yielded for them. Raises `ValueError` if the DIP is
+    not a tar or a zip file.
+    """
+    with open(dip_path, "rb") as dip_file:
+        for mode in ["r:", "r|*"]:
+            dip_file.seek(0)
+            try:
+                dip = tarfile.open(fileobj=dip_file, mode=mode)
+            except tarfile.ReadError:
+                continue
+            with dip:
+                if mode != "r:":
+                    return
+                for member in dip:
+                    if member.isfile():
+                        offset = None if member.issparse() else member.offset_data
+                        yield member.name, offset, member.size
+            return
+        dip_file.seek(0)
+        try:
+            dip = zipfile.ZipFile(dip_file)
+        except zipfile.BadZipFile:
+            raise ValueError(
+                "DIP is not a tar or a zip file: %s" % os.path.basename(dip_path)
+            )
+        with dip:
+            for info in dip.infolist():
+                if info.is_dir():
+                    continue
+                offset = None
+                # Encrypted entries can't be read directly either
+                if info.compress_type == zipfile.ZIP_STORED and not info.flag_bits & 1:
+                    offset = _get_zip_data_offset(dip_file, info)
+                yield info.filename, offset, info.file_size
+
+
+def get_access_copy_members(dip_path):
+    """Get the access copy members of a DIP by original file UUID.
+
+    Returns a dictionary with the name, data offset and size of each access
+    copy member (check `iter_members`).
+    """
+    members = {}
+    for name, offset, size in iter_members(dip_path):
+        uuid = get_access_copy_uuid(name)
+        if uuid:
+            members[uuid] = [name, offset, size]
+    return members
+
+
+def _get_zip_data_offset(dip_file, info):
+    """Get the data offset of a zip entry from its local file header.
+
+    The file name and extra field lengths may differ from the ones in the
+    central directory.
+    """
+    dip_file.seek(info.header_offset)
+    header = dip_file.read(ZIP_LOCAL_HEADER_SIZE)
+    name_length, extra_length = ZIP_LOCAL_HEADER_LENGTHS.unpack(header)
+    return info.header_offset + ZIP_LOCAL_HEADER_SIZE + name_length + extra_length
+
+
+class _ZipOutput:
+    """Write-only file object keeping the zip data until it's yielded.
+
+    It can't seek, so the entries are written with data descriptors.
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        chunks, self.chunks = self.chunks, []
+        return chunks
+
+
+def iter_zip(members, chunk_size=1048576):
+    """Build a zip file on the fly from the given members, yielding its data.
+
+    Each member is a tuple with the name, size, modification date and time
+    tuple, and a binary file object at the start of its data, from which only
+    `size` bytes are read. The data is read and yielded in chunks, so the
+    memory used doesn't depend on the size of the members. The members are
+    stored without compression, access copies are usually compressed already,
+    and ZIP64 extensions are used for members bigger than 4 GB.
+    """
+    output = _ZipOutput()
+    with zipfile.ZipFile(output, "w", zipfile.ZIP_STORED) as zip_file:
+        for name, size, date_time, member_file in members:
+            info = zipfile.ZipInfo(name, date_time)
+            info.external_attr = 0o644 << 16
+            info.file_size = size
+            with zip_file.open(info, "w") as entry:
+                remaining = size
+                while remaining:
+                    data = member_file.read(min(chunk_size, remaining))
+                    if not data:
+                        break
+                    entry.write(data)
+                    remaining -= len(data)
+                    yield from output.pop()
+            yield from output.pop()
+    yield from output.pop()
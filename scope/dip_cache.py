@@ -0,0 +1,176 @@
+"""Local disk cache of the DIPs downloaded from the Storage Service.
+
+The cached DIPs are placed in the media folder, to be served by Nginx like
+the uploaded DIPs, and their modification time is updated on each use to
+remove the least recently used ones when the cache exceeds the size set in
+the `SS_DIP_CACHE_SIZE` setting. Each DIP is downloaded holding an exclusive
+lock on a file next to it, so only one SS download is made for concurrent
+fills from any process sharing the media folder. The lock file is removed
+when the lock is released.
+"""
+
+import fcntl
+import os
+import tempfile
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from .storage_service import get_client
+
+CACHE_DIR = "ss_dips"
+
+
+def _get_cache_path(*parts):
+    """Join the given parts to the cache directory path."""
+    return os.path.join(settings.MEDIA_ROOT, CACHE_DIR, *parts)
+
+
+def get_cached_name(dip):
+    """Get the media name of a cached DIP, marking it as recently used.
+
+    Returns `None` if the cache is disabled or the DIP is not cached.
+    """
+    if not settings.SS_DIP_CACHE_SIZE or not dip.ss_uuid:
+        return None
+    name = "%s.tar" % dip.ss_uuid
+    try:
+        os.utime(_get_cache_path(name))
+    except FileNotFoundError:
+        return None
+    return "%s/%s" % (CACHE_DIR, name)
+
+
+def fill(dip):
+    """Download a DIP from the SS to the cache, if it's not cached already.
+
+    Returns `False` without waiting if the DIP is being downloaded by another
+    process, or if it doesn't fit in the cache, and `True` otherwise. The
+    download is stopped as soon as it exceeds the cache size when the SS
+    doesn't send it. Raises `requests.RequestException` if the download fails.
+    """
+    os.makedirs(_get_cache_path(), exist_ok=True)
+    path = _get_cache_path("%s.tar" % dip.ss_uuid)
+    with _lock(path) as locked:
+        if not locked:
+            return False
+        if os.path.exists(path):
+            os.utime(path)
+            return True
+        client = get_client(dip.ss_host_url)
+        with client.open(dip.ss_download_url) as (size, stream):
+            if size and size > settings.SS_DIP_CACHE_SIZE:
+                return False
+            fd, tmp_path = tempfile.mkstemp(dir=_get_cache_path(), suffix=".part")
+            try:
+                with os.fdopen(fd, "wb") as tmp_file:
+                    fits = _copy(stream, tmp_file, settings.SS_DIP_CACHE_SIZE)
+                    if fits and size and tmp_file.tell() != size:
+                        raise IOError("Incomplete DIP download: %s" % dip.ss_uuid)
+                if not fits:
+                    os.remove(tmp_path)
+                    return False
+                os.chmod(tmp_path, settings.FILE_UPLOAD_PERMISSIONS)
+                os.replace(tmp_path, path)
+            except BaseException:
+                _remove_file(tmp_path)
+                raise
+    evict(keep=path)
+    return True
+
+
+def _copy(source, target, max_size):
+    """Copy a file object in chunks, up to a maximum size.
+
+    Returns `False` if the copy is stopped because the data is bigger.
+    """
+    copied = 0
+    for chunk in iter(lambda: source.read(settings.SS_DOWNLOAD_CHUNK_SIZE), b""):
+        copied += len(chunk)
+        if copied > max_size:
+            return False
+        target.write(chunk)
+    return True
+
+
+@contextmanager
+def _lock(path):
+    """Hold an exclusive lock on the lock file of a cached DIP path.
+
+    Yields `False` without waiting if the lock is held by another process,
+    and `True` otherwise. The lock file is removed before releasing the lock,
+    so it's opened again if it was removed while it was being locked.
+    """
+    lock_path = "%s.lock" % path
+    while True:
+        lock_file = open(lock_path, "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            yield False
+            return
+        try:
+            if os.stat(lock_path).st_ino == os.fstat(lock_file.fileno()).st_ino:
+                break
+        except FileNotFoundError:
+            pass
+        lock_file.close()
+    try:
+        yield True
+    finally:
+        _remove_file(lock_path)
+        lock_file.close()
+
+
+def evict(keep=None):
+    """Remove the least recently used DIPs until the cache fits in its size.
+
+    The DIP in the `keep` path is removed last, unless it doesn't fit in the
+    cache on its own. The lock files left by the fills that were interrupted
+    are removed too.
+    """
+    entries = []
+    for entry in os.scandir(_get_cache_path()):
+        if entry.name.endswith(".lock"):
+            path = entry.path[: -len(".lock")]
+            if not os.path.exists(path):
+                # Removed on release if it's not in use
+                with _lock(path):
+                    pass
+            continue
+        if not entry.name.endswith(".tar"):
+            continue
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        mtime = stat.st_mtime
+        if entry.path == keep:
+            fits = stat.st_size <= settings.SS_DIP_CACHE_SIZE
+            mtime = float("inf") if fits else float("-inf")
+        entries.append((mtime, stat.st_size, entry.path))
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_size <= settings.SS_DIP_CACHE_SIZE:
+            break
+        _remove_file(path)
+        total_size -= size
+
+
+def remove(dip):
+    """Remove a DIP and its lock file, if it's not in use, from the cache."""
+    if dip.ss_uuid:
+        path = _get_cache_path("%s.tar" % dip.ss_uuid)
+        _remove_file(path)
+        if os.path.exists("%s.lock" % path):
+            # Removed on release if it's not in use
+            with _lock(path):
+                pass
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
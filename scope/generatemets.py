@@ -0,0 +1,234 @@
+"""Generation of synthetic Archivematica METS files.
+
+The generated files follow the structure of the METS files created by
+Archivematica, with a configurable number of original files, PREMIS events
+per file and Dublin Core dmdSecs, to measure the import performance with
+files of any size. The file and event UUIDs are derived from their position
+to get the same output for the same arguments.
+"""
+
+METS_HEADER = """<?xml version='1.0' encoding='UTF-8'?>
+<mets:mets xmlns:mets="http://www.loc.gov/METS/" xmlns:premis="http://www.loc.gov/premis/v3" xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:dcterms="http://purl.org/dc/terms/" xmlns:xlink="http://www.w3.org/1999/xlink" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://www.loc.gov/METS/ http://www.loc.gov/standards/mets/version1121/mets.xsd">
+  <mets:metsHdr CREATEDATE="2020-04-28T11:48:44"/>
+"""
+
+DMDSEC = """  <mets:dmdSec ID="dmdSec_{index}" CREATED="2020-04-{day:02d}T11:48:44" STATUS="{status}">
+    <mets:mdWrap MDTYPE="DC">
+      <mets:xmlData>
+        <dcterms:dublincore xsi:schemaLocation="http://purl.org/dc/terms/ https://dublincore.org/schemas/xmls/qdc/2008/02/11/dcterms.xsd">
+          <dc:title>Synthetic DIP ({index})</dc:title>
+          <dc:identifier>synthetic-{index}</dc:identifier>
+          <dc:creator>Synthetic creator</dc:creator>
+          <dc:description>Generated METS file with {files} original files.</dc:description>
+          <dc:date>2020-04-28</dc:date>
+          <dc:language>en</dc:language>
+        </dcterms:dublincore>
+      </mets:xmlData>
+    </mets:mdWrap>
+  </mets:dmdSec>
+"""
+
+AMDSEC_START = """  <mets:amdSec ID="amdSec_{index}">
+    <mets:techMD ID="techMD_{index}">
+      <mets:mdWrap MDTYPE="PREMIS:OBJECT">
+        <mets:xmlData>
+          <premis:object xsi:type="premis:file" version="3.0">
+            <premis:objectIdentifier>
+              <premis:objectIdentifierType>UUID</premis:objectIdentifierType>
+              <premis:objectIdentifierValue>{uuid}</premis:objectIdentifierValue>
+            </premis:objectIdentifier>
+            <premis:objectCharacteristics>
+              <premis:compositionLevel>0</premis:compositionLevel>
+              <premis:fixity>
+                <premis:messageDigestAlgorithm>sha256</premis:messageDigestAlgorithm>
+                <premis:messageDigest>{index:064x}</premis:messageDigest>
+              </premis:fixity>
+              <premis:size>{size}</premis:size>
+              <premis:format>
+                <premis:formatDesignation>
+                  <premis:formatName>JPEG</premis:formatName>
+                  <premis:formatVersion>1.01</premis:formatVersion>
+                </premis:formatDesignation>
+                <premis:formatRegistry>
+                  <premis:formatRegistryName>PRONOM</premis:formatRegistryName>
+                  <premis:formatRegistryKey>fmt/43</premis:formatRegistryKey>
+                </premis:formatRegistry>
+              </premis:format>
+              <premis:objectCharacteristicsExtension>
+                <fits xmlns="http://hul.harvard.edu/ois/xml/ns/fits/fits_output" version="0.8.4">
+                  <identification>
+                    <identity format="JPEG File Interchange Format" mimetype="image/jpeg" toolname="FITS" toolversion="0.8.4">
+                      <tool toolname="Droid" toolversion="3.0"/>
+                      <tool toolname="Jhove" toolversion="1.5"/>
+                      <version toolname="Jhove" toolversion="1.5">1.01</version>
+                      <externalIdentifier toolname="Droid" toolversion="3.0" type="puid">fmt/43</externalIdentifier>
+                    </identity>
+                  </identification>
+                  <fileinfo>
+                    <size toolname="Jhove" toolversion="1.5">{size}</size>
+                    <filepath toolname="OIS File Information" toolversion="0.2" status="SINGLE_RESULT">/var/archivematica/objects/file_{index}.jpg</filepath>
+                    <filename toolname="OIS File Information" toolversion="0.2" status="SINGLE_RESULT">file_{index}.jpg</filename>
+                    <md5checksum toolname="OIS File Information" toolversion="0.2" status="SINGLE_RESULT">{index:032x}</md5checksum>
+                    <fslastmodified toolname="OIS File Information" toolversion="0.2" status="SINGLE_RESULT">{modified}</fslastmodified>
+                  </fileinfo>
+                  <filestatus>
+                    <well-formed toolname="Jhove" toolversion="1.5" status="SINGLE_RESULT">true</well-formed>
+                    <valid toolname="Jhove" toolversion="1.5" status="SINGLE_RESULT">true</valid>
+                  </filestatus>
+                  <metadata>
+                    <image>
+                      <imageWidth toolname="Jhove" toolversion="1.5">1920</imageWidth>
+                      <imageHeight toolname="Jhove" toolversion="1.5">1080</imageHeight>
+                      <colorSpace toolname="Jhove" toolversion="1.5">YCbCr</colorSpace>
+                    </image>
+                  </metadata>
+                </fits>
+              </premis:objectCharacteristicsExtension>
+            </premis:objectCharacteristics>
+            <premis:originalName>%transferDirectory%objects/file_{index}.jpg</premis:originalName>
+          </premis:object>
+        </mets:xmlData>
+      </mets:mdWrap>
+    </mets:techMD>
+"""
+
+DIGIPROVMD = """    <mets:digiprovMD ID="digiprovMD_{index}_{event}">
+      <mets:mdWrap MDTYPE="PREMIS:EVENT">
+        <mets:xmlData>
+          <premis:event version="3.0">
+            <premis:eventIdentifier>
+              <premis:eventIdentifierType>UUID</premis:eventIdentifierType>
+              <premis:eventIdentifierValue>{uuid}</premis:eventIdentifierValue>
+            </premis:eventIdentifier>
+            <premis:eventType>{type}</premis:eventType>
+            <premis:eventDateTime>2020-04-28T11:47:31.778694+00:00</premis:eventDateTime>
+            <premis:eventDetailInformation>
+              <premis:eventDetail>{detail}</premis:eventDetail>
+            </premis:eventDetailInformation>
+            <premis:eventOutcomeInformation>
+              <premis:eventOutcome>{outcome}</premis:eventOutcome>
+              <premis:eventOutcomeDetail>
+                <premis:eventOutcomeDetailNote>{note}</premis:eventOutcomeDetailNote>
+              </premis:eventOutcomeDetail>
+            </premis:eventOutcomeInformation>
+            <premis:linkingAgentIdentifier>
+              <premis:linkingAgentIdentifierType>preservation system</premis:linkingAgentIdentifierType>
+              <premis:linkingAgentIdentifierValue>Archivematica-1.12</premis:linkingAgentIdentifierValue>
+            </premis:linkingAgentIdentifier>
+          </premis:event>
+        </mets:xmlData>
+      </mets:mdWrap>
+    </mets:digiprovMD>
+"""
+
+AMDSEC_END = "  </mets:amdSec>\n"
+
+# Tuples with type, detail, outcome and outcome note of the PREMIS events,
+# repeated in the same order if more events per file are requested.
+EVENTS = [
+    ("ingestion", "", "", ""),
+    (
+        "message digest calculation",
+        'program="python"; module="hashlib.sha256()"',
+        "",
+        "{hash}",
+    ),
+    (
+        "virus check",
+        'program="ClamAV (clamd)"; version="ClamAV 0.99.2"',
+        "Pass",
+        "",
+    ),
+    (
+        "name cleanup",
+        'prohibited characters removed: program="sanitize_names"',
+        "",
+        'Original name="%transferDirectory%objects/file_{index}.jpg"',
+    ),
+    (
+        "format identification",
+        'program="Siegfried"; version="1.8.0"',
+        "Positive",
+        "fmt/43",
+    ),
+    ("validation", 'program="JHOVE"; version="1.20"', "pass", 'format="JPEG"'),
+    ("fixity check", 'program="python"; module="hashlib.sha256()"', "Pass", ""),
+]
+
+
+def file_uuid(index):
+    """Get the UUID of the original file in a given position."""
+    return "%08x-0000-4000-8000-000000000000" % index
+
+
+def event_uuid(index, event):
+    """Get the UUID of an event from the original file in a given position."""
+    return "%08x-0000-4000-8000-%012x" % (index, event + 1)
+
+
+def write_mets(path, files, events=1, dmdsecs=1):
+    """Write a synthetic METS file to the given path.
+
+    The file is written incrementally, without keeping its content in memory.
+    The SIP dmdSecs are created with increasing dates, all of them related to
+    the objects directory, and each original file has its own amdSec with the
+    PREMIS object, including a FITS output, and the given number of events.
+    """
+    with open(path, "w") as mets_file:
+        mets_file.write(METS_HEADER)
+        for index in range(1, dmdsecs + 1):
+            status = "original" if index == 1 else "update"
+            mets_file.write(
+                DMDSEC.format(
+                    index=index, day=index % 28 + 1, status=status, files=files
+                )
+            )
+        for index in range(files):
+            mets_file.write(
+                AMDSEC_START.format(
+                    index=index,
+                    uuid=file_uuid(index),
+                    size=1024 + index,
+                    modified=1588074515000 + index * 1000,
+                )
+            )
+            for event in range(events):
+                type_, detail, outcome, note = EVENTS[event % len(EVENTS)]
+                mets_file.write(
+                    DIGIPROVMD.format(
+                        index=index,
+                        event=event,
+                        uuid=event_uuid(index, event),
+                        type=type_,
+                        detail=detail,
+                        outcome=outcome,
+                        note=note.format(index=index, hash="%064x" % index),
+                    )
+                )
+            mets_file.write(AMDSEC_END)
+        mets_file.write('  <mets:fileSec>\n    <mets:fileGrp USE="original">\n')
+        for index in range(files):
+            mets_file.write(
+                '      <mets:file GROUPID="Group-{0}" ID="file-{0}" ADMID="amdSec_{1}">\n'
+                '        <mets:FLocat xlink:href="objects/file_{1}.jpg" LOCTYPE="OTHER"'
+                ' OTHERLOCTYPE="SYSTEM"/>\n'
+                "      </mets:file>\n".format(file_uuid(index), index)
+            )
+        mets_file.write("    </mets:fileGrp>\n  </mets:fileSec>\n")
+        dmdids = " ".join("dmdSec_%d" % index for index in range(1, dmdsecs + 1))
+        mets_file.write(
+            '  <mets:structMap ID="structMap_1" LABEL="Archivematica default"'
+            ' TYPE="physical">\n'
+            '    <mets:div LABEL="synthetic" TYPE="Directory">\n'
+            '      <mets:div LABEL="objects" TYPE="Directory"%s>\n'
+            % (' DMDID="%s"' % dmdids if dmdids else "")
+        )
+        for index in range(files):
+            mets_file.write(
+                '        <mets:div LABEL="file_{1}.jpg" TYPE="Item">\n'
+                '          <mets:fptr FILEID="file-{0}"/>\n'
+                "        </mets:div>\n".format(file_uuid(index), index)
+            )
+        mets_file.write(
+            "      </mets:div>\n    </mets:div>\n  </mets:structMap>\n</mets:mets>\n"
+        )
@@ -1,6 +1,8 @@
+from django.db.models.signals import post_delete
 from django.db.models.signals import pre_delete
 from django.dispatch import receiver
 
+from . import dip_cache
 from .models import DIP
 from .models import Collection
 
@@ -19,3 +21,9 @@ def delete_related_dc(instance, **kwargs):
     """
     if instance.dc:
         instance.dc.delete()
+
+
+@receiver(post_delete, sender=DIP, dispatch_uid="dip_post_delete")
+def delete_cached_dip(instance, **kwargs):
+    """Remove the DIP from the local SS DIP cache."""
+    dip_cache.remove(instance)
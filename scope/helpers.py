@@ -1,3 +1,4 @@
+import hashlib
 import math
 from urllib.parse import urlparse
 
@@ -64,6 +65,95 @@ def update_instance_from_dict(instance, dict):
     return instance
 
 
+def iter_batches(iterable, size):
+    """Yield lists with up to a given size from the items of an iterable."""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def get_in_bulk(model, pks, chunk_size):
+    """Get a dictionary with the model instances matching a list of pks.
+
+    Queries the instances in chunks to limit the size of the `IN` clauses.
+    """
+    instances = {}
+    for chunk in iter_batches(pks, chunk_size):
+        instances.update(model.objects.in_bulk(chunk))
+    return instances
+
+
+def get_sha256(file, chunk_size=1048576):
+    """Get the SHA-256 hex digest of a file path or binary file object.
+
+    The file is read in chunks to avoid loading it in memory.
+    """
+    if isinstance(file, str):
+        with open(file, "rb") as f:
+            return get_sha256(f, chunk_size)
+    sha256 = hashlib.sha256()
+    for chunk in iter(lambda: file.read(chunk_size), b""):
+        sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class SHA256Reader:
+    """Binary file object wrapper computing the SHA-256 of the data read."""
+
+    def __init__(self, file):
+        self.file = file
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.sha256.update(data)
+        return data
+
+    def hexdigest(self, chunk_size=1048576):
+        """Read the rest of the file and return the SHA-256 hex digest."""
+        for _ in iter(lambda: self.read(chunk_size), b""):
+            pass
+        return self.sha256.hexdigest()
+
+
+def parse_range_header(header, size):
+    """Get the first and last byte positions from a HTTP Range header.
+
+    Only single byte ranges are supported. Returns `None` if the header is
+    missing, malformed or unsupported, to ignore it and send the whole content,
+    and raises `ValueError` if the range can't be satisfied for the given size.
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    start, separator, end = header[len("bytes=") :].strip().partition("-")
+    try:
+        if not separator or (not start and not end):
+            return None
+        if start:
+            first = int(start)
+            last = int(end) if end else max(first, size - 1)
+        else:
+            # Suffix range with the last bytes
+            length = int(end)
+            first = max(size - length, 0)
+            last = size - 1
+    except ValueError:
+        return None
+    if not start and length == 0:
+        # A zero-length suffix range doesn't select any byte
+        raise ValueError("Range not satisfiable: %s" % header)
+    if first < 0 or last < first:
+        return None
+    if first >= size:
+        raise ValueError("Range not satisfiable: %s" % header)
+    return first, min(last, size - 1)
+
+
 def get_sort_params(params, options, default):
     """Get sort option and direction from params.
 
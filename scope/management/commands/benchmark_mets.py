@@ -0,0 +1,139 @@
+import os
+import resource
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from scope.generatemets import write_mets
+from scope.models import DIP
+from scope.models import DublinCore
+from scope.parsemets import METS
+from search.tasks import delete_es_descendants
+
+
+class Command(BaseCommand):
+    help = "Time the METS import stages over METS files of increasing size."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes",
+            nargs="+",
+            type=int,
+            default=[1000, 10000, 100000],
+            help="Number of original files in each synthetic METS file.",
+        )
+        parser.add_argument(
+            "--events",
+            type=int,
+            default=7,
+            help="PREMIS events per original file in the synthetic METS files.",
+        )
+        parser.add_argument(
+            "--dmdsecs",
+            type=int,
+            default=1,
+            help="Dublin Core dmdSecs in the synthetic METS files.",
+        )
+        parser.add_argument(
+            "--mets",
+            nargs="+",
+            default=[],
+            help="Existing METS files to import instead of the synthetic ones.",
+        )
+        parser.add_argument(
+            "--repeat",
+            type=int,
+            default=1,
+            help="Times to import each METS file, the best time is reported.",
+        )
+        parser.add_argument(
+            "--streaming",
+            action="store_true",
+            help="Use the streaming parser instead of loading the whole tree.",
+        )
+        parser.add_argument(
+            "--index",
+            action="store_true",
+            help="Index the DigitalFiles in Elasticsearch, removing them after.",
+        )
+
+    def handle(self, *args, **options):
+        """Import each METS file and print the time of each stage.
+
+        The stages are the METS loading (`METS.__init__`), the parsing and
+        database import (`METS.parse_mets`) and, optionally, the indexing of
+        the DigitalFiles in Elasticsearch (`DIP.index_digital_files`). The
+        database changes are rolled back after each import and the indexed
+        documents are deleted. The peak RSS of the process is printed after
+        each METS file.
+        """
+        for mets_path in options["mets"]:
+            self._benchmark(mets_path, os.path.basename(mets_path), options)
+        if options["mets"]:
+            return
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            mets_path = os.path.join(tmp_dir, "METS.xml")
+            for size in options["sizes"]:
+                write_mets(
+                    mets_path,
+                    size,
+                    events=options["events"],
+                    dmdsecs=options["dmdsecs"],
+                )
+                self._benchmark(mets_path, "synthetic", options)
+
+    def _benchmark(self, mets_path, label, options):
+        """Import a METS file the given times and print the best time."""
+        results = []
+        for _ in range(max(options["repeat"], 1)):
+            results.append(self._import(mets_path, options))
+        count, times = min(results, key=lambda result: sum(result[1]))
+        elapsed = sum(times)
+        stages = "init %.4f s, parse %.4f s" % tuple(times[:2])
+        if options["index"]:
+            stages += ", index %.4f s" % times[2]
+        # The maximum resident set size is given in kilobytes on Linux
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        print(
+            "%s, %d files: %.4f s (%.1f µs/file) [%s], peak RSS %.1f MB"
+            % (
+                label,
+                count,
+                elapsed,
+                elapsed / max(count, 1) * 1000000,
+                stages,
+                peak_rss,
+            )
+        )
+
+    def _import(self, mets_path, options):
+        """Import a METS file in a rolled back transaction.
+
+        Returns the number of imported files and the time of each stage.
+        """
+        times = []
+        with transaction.atomic():
+            dip = DIP(dc=DublinCore.objects.create(identifier="benchmark"))
+            dip.save(update_es=False)
+
+            start = time.perf_counter()
+            mets = METS(mets_path, dip.pk, streaming=options["streaming"])
+            times.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            dip = mets.parse_mets(update_es=False)
+            times.append(time.perf_counter() - start)
+
+            if options["index"]:
+                start = time.perf_counter()
+                try:
+                    dip.index_digital_files()
+                    times.append(time.perf_counter() - start)
+                finally:
+                    delete_es_descendants("DIP", dip.pk)
+
+            count = dip.digital_files.count()
+            transaction.set_rollback(True)
+        return count, times
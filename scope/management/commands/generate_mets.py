@@ -0,0 +1,39 @@
+import os
+
+from django.core.management.base import BaseCommand
+
+from scope.generatemets import write_mets
+
+
+class Command(BaseCommand):
+    help = "Generate a synthetic Archivematica METS file."
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="Path of the METS file to create.")
+        parser.add_argument(
+            "--files", type=int, default=1000, help="Number of original files."
+        )
+        parser.add_argument(
+            "--events", type=int, default=7, help="PREMIS events per original file."
+        )
+        parser.add_argument(
+            "--dmdsecs", type=int, default=1, help="Dublin Core dmdSecs of the SIP."
+        )
+
+    def handle(self, *args, **options):
+        write_mets(
+            options["path"],
+            options["files"],
+            events=options["events"],
+            dmdsecs=options["dmdsecs"],
+        )
+        print(
+            "%s: %d files, %d events per file, %d dmdSecs (%.1f MB)"
+            % (
+                options["path"],
+                options["files"],
+                options["events"],
+                options["dmdsecs"],
+                os.path.getsize(options["path"]) / 1024 / 1024,
+            )
+        )
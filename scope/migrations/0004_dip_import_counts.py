@@ -0,0 +1,19 @@
+# Generated by Django 2.2.19 on 2026-10-18 02:17
+
+import jsonfield.fields
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("scope", "0003_alter_settings_value_field"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="dip",
+            name="import_counts",
+            field=jsonfield.fields.JSONField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 2.2.19 on 2026-10-18 02:21
+
+import jsonfield.fields
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("scope", "0004_dip_import_counts"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="dip",
+            name="import_progress",
+            field=jsonfield.fields.JSONField(blank=True, null=True),
+        ),
+    ]
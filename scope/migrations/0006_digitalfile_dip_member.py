@@ -0,0 +1,29 @@
+# Generated by Django 2.2.19 on 2026-10-18 02:37
+
+from django.db import migrations
+from django.db import models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("scope", "0005_dip_import_progress"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="digitalfile",
+            name="dip_member",
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name="digitalfile",
+            name="dip_member_offset",
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="digitalfile",
+            name="dip_member_size",
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
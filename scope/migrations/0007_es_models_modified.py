@@ -0,0 +1,29 @@
+# Generated by Django 2.2.19 on 2026-10-18 02:52
+
+from django.db import migrations
+from django.db import models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("scope", "0006_digitalfile_dip_member"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="collection",
+            name="modified",
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+        migrations.AddField(
+            model_name="digitalfile",
+            name="modified",
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+        migrations.AddField(
+            model_name="dip",
+            name="modified",
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 2.2.19 on 2026-10-18 02:59
+
+from django.db import migrations
+from django.db import models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("scope", "0007_es_models_modified"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="EsOutbox",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("created", models.DateTimeField(auto_now_add=True)),
+                ("model_name", models.CharField(max_length=20)),
+                ("object_id", models.CharField(max_length=36)),
+                ("operation", models.CharField(max_length=20)),
+            ],
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 2.2.19 on 2026-10-18 03:02
+
+from django.db import migrations
+from django.db import models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("scope", "0008_esoutbox"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="collection",
+            name="es_descendants_fingerprint",
+            field=models.CharField(blank=True, max_length=40),
+        ),
+        migrations.AddField(
+            model_name="collection",
+            name="es_fingerprint",
+            field=models.CharField(blank=True, max_length=40),
+        ),
+        migrations.AddField(
+            model_name="digitalfile",
+            name="es_fingerprint",
+            field=models.CharField(blank=True, max_length=40),
+        ),
+        migrations.AddField(
+            model_name="dip",
+            name="es_descendants_fingerprint",
+            field=models.CharField(blank=True, max_length=40),
+        ),
+        migrations.AddField(
+            model_name="dip",
+            name="es_fingerprint",
+            field=models.CharField(blank=True, max_length=40),
+        ),
+    ]
@@ -7,24 +7,34 @@ an `es_doc` attribute with the related Document class from search.documents
 and a `get_es_data` method to transform to a dictionary representation of
 the ES document.
 """
+
 from abc import ABCMeta
 from abc import abstractmethod
 from collections import OrderedDict
 
+from django.conf import settings
 from django.contrib.auth.models import AbstractUser
 from django.contrib.auth.models import Group
 from django.db import models
+from django.db import transaction
 from django.utils.translation import gettext
 from django.utils.translation import gettext_lazy as _
 from jsonfield import JSONField
 
 from scope.celery import app as celery_app
+from search.coalesce import request_descendants_update
 from search.documents import CollectionDoc
 from search.documents import DigitalFileDoc
 from search.documents import DIPDoc
+from search.helpers import add_version
+from search.helpers import bulk_index_documents
 from search.helpers import delete_document
+from search.helpers import get_fingerprint
+from search.helpers import save_document
+from search.helpers import write_documents
 
 from .helpers import add_if_not_empty
+from .helpers import iter_batches
 
 
 class User(AbstractUser):
@@ -75,27 +85,84 @@ class AbstractModelMeta(ABCMeta, type(models.Model)):
 class AbstractEsModel(models.Model, metaclass=AbstractModelMeta):
     """Abstract base model for models related to ES Documents."""
 
+    # Time of the last change, to reindex only the recently modified rows and
+    # to version the ES documents, see `search.helpers.add_version`
+    modified = models.DateTimeField(auto_now=True, db_index=True)
+    # Fingerprint of the data in the ES document when it was last written, to
+    # skip the writes that don't change it. The models with descendants also
+    # declare an `es_descendants_fingerprint` field for the data returned by
+    # `get_es_descendants_data`.
+    es_fingerprint = models.CharField(max_length=40, blank=True)
+
     class Meta:
         abstract = True
 
     def save(self, update_es=True, *args, **kwargs):
-        """Extended save to optionally update related documents in ES."""
-        super(AbstractEsModel, self).save(*args, **kwargs)
+        """Extended save to optionally update related documents in ES.
+
+        The document is only written if its data changed since it was last
+        written, and the descendants are only updated if the data they hold
+        from the instance changed. With the `ES_OUTBOX` setting enabled, the ES
+        operations are recorded in the outbox in the same transaction and
+        applied in the background.
+        """
         if not update_es:
-            return
-        # Use refresh to reflect the changes in the index in the same request
-        self.to_es_doc().save(refresh=True)
+            return super(AbstractEsModel, self).save(*args, **kwargs)
+        with transaction.atomic():
+            super(AbstractEsModel, self).save(*args, **kwargs)
+            fingerprints = self.get_changed_es_fingerprints()
+            if settings.ES_OUTBOX:
+                if "es_fingerprint" in fingerprints:
+                    EsOutbox.add(self, EsOutbox.SYNC)
+                if "es_descendants_fingerprint" in fingerprints:
+                    EsOutbox.add(self, EsOutbox.UPDATE_DESCENDANTS)
+                self._save_es_fingerprints(fingerprints)
+                return
+        if "es_fingerprint" in fingerprints:
+            # Use refresh to reflect the changes in the index in the same request
+            self.save_es_doc()
         # Update descendant DigitalFiles if needed
-        if self.requires_es_descendants_update():
-            # Launch async. task by name to avoid circular imports
-            # or to import the task within this function.
-            celery_app.send_task(
-                "search.tasks.update_es_descendants",
-                args=(self.__class__.__name__, self.pk),
-            )
+        if "es_descendants_fingerprint" in fingerprints:
+            request_descendants_update(self.__class__.__name__, self.pk)
+        self._save_es_fingerprints(fingerprints)
+
+    def get_changed_es_fingerprints(self):
+        """Get the fingerprints of the ES data that changed since last written.
+
+        Returns a dictionary with the new `es_fingerprint` if the document data
+        changed and the new `es_descendants_fingerprint` if the data held by
+        the descendants changed and they require an update.
+        """
+        fingerprints = {}
+        fingerprint = get_fingerprint(self.get_es_data())
+        if fingerprint != self.es_fingerprint:
+            fingerprints["es_fingerprint"] = fingerprint
+        data = self.get_es_descendants_data()
+        if data is not None:
+            fingerprint = get_fingerprint(data)
+            if (
+                fingerprint != self.es_descendants_fingerprint
+                and self.requires_es_descendants_update()
+            ):
+                fingerprints["es_descendants_fingerprint"] = fingerprint
+        return fingerprints
+
+    def _save_es_fingerprints(self, fingerprints):
+        """Store the fingerprints without changing the modification time."""
+        if not fingerprints:
+            return
+        self.__class__.objects.filter(pk=self.pk).update(**fingerprints)
+        for name, fingerprint in fingerprints.items():
+            setattr(self, name, fingerprint)
 
     def delete(self, *args, **kwargs):
         """Extended delete to remove related documents in ES."""
+        if settings.ES_OUTBOX:
+            with transaction.atomic():
+                EsOutbox.add(self, EsOutbox.SYNC)
+                if self.requires_es_descendants_delete():
+                    EsOutbox.add(self, EsOutbox.DELETE_DESCENDANTS)
+                return super(AbstractEsModel, self).delete(*args, **kwargs)
         self.delete_es_doc()
         # Delete descendants if needed
         if self.requires_es_descendants_delete():
@@ -122,14 +189,93 @@ class AbstractEsModel(models.Model, metaclass=AbstractModelMeta):
     def requires_es_descendants_update(self):
         """Checks if descendants need to be updated in ES."""
 
+    def get_es_descendants_data(self):
+        """Data held by the descendants ES documents, `None` without them."""
+        return None
+
     @abstractmethod
     def requires_es_descendants_delete(self):
         """Checks if descendants need to be updated in ES."""
 
+    @classmethod
+    def iter_es_data(cls, queryset=None):
+        """Yield the ES data of the instances from a QuerySet, or all of them."""
+        if queryset is None:
+            queryset = cls.objects.all()
+        for instance in queryset.iterator():
+            yield instance.get_es_data()
+
+    @classmethod
+    def iter_es_sync_data(cls, pks):
+        """Yield the ES data of the rows with the given pks.
+
+        A delete action is yielded instead for the pks without row.
+        """
+        missing = {str(pk) for pk in pks}
+        for data in cls.iter_es_data(cls.objects.filter(pk__in=pks)):
+            missing.discard(str(data["_id"]))
+            yield data
+        for pk in missing:
+            yield {"_op_type": "delete", "_id": pk}
+
+    @classmethod
+    def iter_changed_es_data(cls, queryset, fingerprints):
+        """Yield the ES data of the rows changed since they were last written.
+
+        The fingerprints of the data are compared with the stored ones in
+        batches. The new fingerprints of the yielded data are added to the
+        `fingerprints` dictionary by pk, to store them with
+        `update_es_fingerprints` once the documents have been written.
+        """
+        rows = queryset.values_list("pk", "es_fingerprint").iterator()
+        for batch in iter_batches(rows, settings.IMPORT_BATCH_SIZE):
+            stored = dict(batch)
+            for data in cls.iter_es_data(cls.objects.filter(pk__in=stored)):
+                fingerprint = get_fingerprint(data)
+                if fingerprint != stored[data["_id"]]:
+                    fingerprints[data["_id"]] = fingerprint
+                    yield data
+
+    @classmethod
+    def update_es_fingerprints(cls, fingerprints):
+        """Store the fingerprints from a dictionary by pk in bulk."""
+        cls.objects.bulk_update(
+            [cls(pk=pk, es_fingerprint=value) for pk, value in fingerprints.items()],
+            ["es_fingerprint"],
+            batch_size=settings.IMPORT_BATCH_SIZE,
+        )
+
+    @classmethod
+    def wait_for_es(cls, pk):
+        """Write the document of a row now and wait until it's searchable.
+
+        With the `ES_OUTBOX` setting enabled, views can call this to show a
+        change in the following request. Only the affected document is
+        indexed, or deleted if the row doesn't exist, and the request waits
+        for the next scheduled refresh of the index instead of forcing one.
+        Does nothing otherwise, as the document is written on save.
+        """
+        if not settings.ES_OUTBOX:
+            return
+        write_documents(
+            cls.es_doc._index._name, cls.iter_es_sync_data([pk]), refresh="wait_for"
+        )
+
     def to_es_doc(self):
         """Model transformation to related ES Document."""
         data = self.get_es_data()
-        return self.es_doc(meta={"id": data.pop("_id")}, **data)
+        meta = {"id": data.pop("_id")}
+        if "_version" in data:
+            meta["version"] = data.pop("_version")
+            meta["version_type"] = data.pop("_version_type")
+        return self.es_doc(meta=meta, **data)
+
+    def save_es_doc(self, refresh=True):
+        """Call to index the related document, unless a newer one is indexed.
+
+        Returns `False` if the document was not written.
+        """
+        return save_document(self.to_es_doc(), refresh=refresh)
 
     def delete_es_doc(self):
         """Call to remove related document from the ES index."""
@@ -234,6 +380,7 @@ class DublinCore(models.Model):
 class Collection(AbstractEsModel):
     link = models.URLField(_("finding aid"), blank=True)
     dc = models.OneToOneField(DublinCore, null=True, on_delete=models.SET_NULL)
+    es_descendants_fingerprint = models.CharField(max_length=40, blank=True)
 
     def __str__(self):
         return str(self.dc) or str(self.pk)
@@ -242,6 +389,7 @@ class Collection(AbstractEsModel):
 
     def get_es_data(self):
         data = {"_id": self.pk}
+        add_version(data, self.modified)
 
         if self.dc:
             data["dc"] = self.dc.get_es_inner_data()
@@ -255,6 +403,9 @@ class Collection(AbstractEsModel):
             add_if_not_empty(data, "title", self.dc.title)
         return data
 
+    def get_es_descendants_data(self):
+        return self.get_es_data_for_files()
+
     def requires_es_descendants_update(self):
         # No metadata needs to be updated in descandant DIPs
         count = DigitalFile.objects.filter(dip__collection__pk=self.pk).count()
@@ -281,11 +432,16 @@ class DIP(AbstractEsModel):
     dc = models.OneToOneField(DublinCore, null=True, on_delete=models.SET_NULL)
     import_status = models.CharField(max_length=7, null=True)
     import_error = models.TextField(blank=True, null=True)
+    # Insert, update, unchanged and delete counts of the last import
+    import_counts = JSONField(blank=True, null=True)
+    # Stage and progress of the checkpointed import
+    import_progress = JSONField(blank=True, null=True)
     # Storage Service
     ss_uuid = models.CharField(max_length=36, blank=True, null=True, unique=True)
     ss_dir_name = models.CharField(max_length=500, blank=True, null=True)
     ss_host_url = models.CharField(max_length=500, blank=True, null=True)
     ss_download_url = models.CharField(max_length=500, blank=True, null=True)
+    es_descendants_fingerprint = models.CharField(max_length=40, blank=True)
 
     # Import statuses
     IMPORT_PENDING = "PENDING"
@@ -308,13 +464,14 @@ class DIP(AbstractEsModel):
 
     def get_es_data(self):
         data = {"_id": self.pk}
+        add_version(data, self.modified)
         add_if_not_empty(data, "import_status", self.import_status)
 
         if self.dc:
             data["dc"] = self.dc.get_es_inner_data()
 
-        if self.collection:
-            data["collection"] = {"id": self.collection.pk}
+        if self.collection_id:
+            data["collection"] = {"id": self.collection_id}
 
         return data
 
@@ -326,9 +483,50 @@ class DIP(AbstractEsModel):
             add_if_not_empty(data, "title", self.dc.title)
         return data
 
+    def get_es_descendants_data(self):
+        # The Collection data is updated in the descendants on its own save
+        return {
+            "dip": self.get_es_data_for_files(),
+            "collection_id": self.collection_id,
+        }
+
     def requires_es_descendants_update(self):
         return self.digital_files.count() > 0
 
+    def index_digital_files(self, uuids=None, deleted_uuids=(), refresh=True):
+        """Index the related DigitalFiles in ES in bulk.
+
+        Sends the documents in chunks and refreshes the index only once,
+        after all of them have been indexed, unless `refresh` is `False` to
+        index multiple sets of DigitalFiles before a single refresh. All the
+        DigitalFiles are indexed unless a list of `uuids` is given, and the
+        documents from the `deleted_uuids` are removed in the same requests.
+        The documents whose data didn't change since they were last written
+        are skipped.
+        """
+        fingerprints = {}
+
+        def get_documents():
+            if uuids is None:
+                yield from DigitalFile.iter_changed_es_data(
+                    self.digital_files.all(), fingerprints
+                )
+            else:
+                for chunk in iter_batches(uuids, settings.IMPORT_BATCH_SIZE):
+                    yield from DigitalFile.iter_changed_es_data(
+                        self.digital_files.filter(uuid__in=chunk), fingerprints
+                    )
+            for uuid in deleted_uuids:
+                yield {"_op_type": "delete", "_id": uuid}
+
+        index = DigitalFile.es_doc._index._name
+        if refresh:
+            count = bulk_index_documents(index, get_documents())
+        else:
+            count = write_documents(index, get_documents())
+        DigitalFile.update_es_fingerprints(fingerprints)
+        return count
+
     def requires_es_descendants_delete(self):
         return self.requires_es_descendants_update()
 
@@ -374,6 +572,11 @@ class DigitalFile(AbstractEsModel):
     hashtype = models.CharField(max_length=7)
     hashvalue = models.CharField(max_length=128)
     dip = models.ForeignKey(DIP, related_name="digital_files", on_delete=models.CASCADE)
+    # Access copy member in the uploaded DIP file, with the offset of its data
+    # when it's stored without compression, to download it on its own.
+    dip_member = models.TextField(blank=True)
+    dip_member_offset = models.BigIntegerField(blank=True, null=True)
+    dip_member_size = models.BigIntegerField(blank=True, null=True)
 
     def __str__(self):
         return self.uuid
@@ -392,14 +595,91 @@ class DigitalFile(AbstractEsModel):
         # the TIME_ZONE setting is not considered.
         add_if_not_empty(data, "datemodified", self.datemodified)
 
-        # Ancestors data
+        # Ancestors data, the document is versioned after the latest change
+        # of the DigitalFile and its ancestors.
+        modified = [self.modified]
         if self.dip:
             data["dip"] = self.dip.get_es_data_for_files()
+            modified.append(self.dip.modified)
             if self.dip.collection:
                 data["collection"] = self.dip.collection.get_es_data_for_files()
+                modified.append(self.dip.collection.modified)
+        add_version(data, *modified)
 
         return data
 
+    @classmethod
+    def iter_es_data(cls, queryset=None):
+        """Yield the ES data of the DigitalFiles from a QuerySet.
+
+        Equivalent to `get_es_data` for each DigitalFile, without creating the
+        model instances or querying the ancestors for each of them. The files
+        are queried as `values()` rows joined with the DIP and Collection data
+        and the ancestors data is built once per DIP. The ancestors data
+        dictionaries are shared by the documents of the same DIP.
+        """
+        if queryset is None:
+            queryset = cls.objects.all()
+        rows = queryset.values(
+            "uuid",
+            "filepath",
+            "fileformat",
+            "size_bytes",
+            "datemodified",
+            "modified",
+            "dip_id",
+            "dip__modified",
+            "dip__import_status",
+            "dip__dc__identifier",
+            "dip__dc__title",
+            "dip__collection_id",
+            "dip__collection__modified",
+            "dip__collection__dc__identifier",
+            "dip__collection__dc__title",
+        )
+        ancestors = {}
+        for row in rows.iterator():
+            data = {
+                "_id": row["uuid"],
+                "uuid": row["uuid"],
+                "filepath": row["filepath"],
+                "fileformat": row["fileformat"],
+                "size_bytes": row["size_bytes"],
+            }
+            add_if_not_empty(data, "datemodified", row["datemodified"])
+            add_version(
+                data,
+                row["modified"],
+                row["dip__modified"],
+                row["dip__collection__modified"],
+            )
+            if row["dip_id"] not in ancestors:
+                ancestors[row["dip_id"]] = cls._get_ancestors_es_data(row)
+            data.update(ancestors[row["dip_id"]])
+            yield data
+
+    @staticmethod
+    def _get_ancestors_es_data(row):
+        """Build the ancestors ES data from a `values()` row.
+
+        Matches the `get_es_data_for_files` data of the DIP and Collection.
+        """
+        dip_data = {"id": row["dip_id"]}
+        add_if_not_empty(dip_data, "import_status", row["dip__import_status"])
+        add_if_not_empty(dip_data, "identifier", row["dip__dc__identifier"])
+        add_if_not_empty(dip_data, "title", row["dip__dc__title"])
+        data = {"dip": dip_data}
+        if row["dip__collection_id"]:
+            collection_data = {"id": row["dip__collection_id"]}
+            add_if_not_empty(
+                collection_data, "identifier", row["dip__collection__dc__identifier"]
+            )
+            add_if_not_empty(
+                collection_data, "title", row["dip__collection__dc__title"]
+            )
+            data["collection"] = collection_data
+        return data
+
     def requires_es_descendants_update(self):
         return False
 
@@ -407,6 +687,42 @@ class DigitalFile(AbstractEsModel):
         return False
 
 
+class EsOutbox(models.Model):
+    """ES operations pending after the changes made in the database.
+
+    Recorded in the same transaction as the changes, with the `ES_OUTBOX`
+    setting enabled, and applied in bulk by the `drain_es_outbox` task, which
+    is launched when the transaction is committed.
+    """
+
+    created = models.DateTimeField(auto_now_add=True)
+    model_name = models.CharField(max_length=20)
+    object_id = models.CharField(max_length=36)
+    operation = models.CharField(max_length=20)
+
+    # Operations. The documents are indexed or deleted depending on
+    # the existence of the row when the outbox is drained.
+    SYNC = "sync"
+    UPDATE_DESCENDANTS = "update_descendants"
+    DELETE_DESCENDANTS = "delete_descendants"
+
+    def __str__(self):
+        return "%s %s [id: %s]" % (self.operation, self.model_name, self.object_id)
+
+    @classmethod
+    def add(cls, instance, operation):
+        """Record an operation and drain the outbox after the commit."""
+        cls.objects.create(
+            model_name=instance.__class__.__name__,
+            object_id=str(instance.pk),
+            operation=operation,
+        )
+        # Launch async. task by name to avoid circular imports
+        transaction.on_commit(
+            lambda: celery_app.send_task("search.tasks.drain_es_outbox")
+        )
+
+
 class PREMISEvent(models.Model):
     uuid = models.CharField(max_length=36, primary_key=True)
     eventtype = models.CharField(max_length=200, blank=True)
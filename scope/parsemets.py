@@ -1,101 +1,607 @@
+import gzip
+import json
 import os
+import re
+import tempfile
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
 from datetime import timezone
+from itertools import chain
 
+from django.conf import settings
 from django.core.exceptions import ValidationError
+from django.db import transaction
 from lxml import etree
-from lxml import objectify
 
+from search.helpers import delete_document
+from search.helpers import refresh_index
+
+from .archives import get_access_copy_members
+from .archives import open_member
+from .helpers import SHA256Reader
 from .helpers import convert_size
+from .helpers import get_in_bulk
+from .helpers import iter_batches
 from .helpers import update_instance_from_dict
 from .models import DIP
 from .models import Collection
 from .models import DigitalFile
 from .models import PREMISEvent
 
+METS_RE = re.compile(r".*METS.[0-9a-f\-]{36}.*$")
+METS_NS = "http://www.loc.gov/METS/"
+NAMESPACES = {
+    "fits": "http://hul.harvard.edu/ois/xml/ns/fits/fits_output",
+    "mets": METS_NS,
+    "premis": "http://www.loc.gov/premis/v3",
+    "premisv2": "info:lc/xmlns/premis-v2",
+}
+
+
+def _compile_xpath(xpath):
+    """Compile an XPath expression matching both PREMIS v3 and v2 elements."""
+    if "premis:" in xpath:
+        xpath = "%s | %s" % (xpath, xpath.replace("premis:", "premisv2:"))
+    return etree.XPath(xpath, namespaces=NAMESPACES)
+
 
 class METSError(Exception):
     """Exception raised when there is a problem in the METS parsing process"""
 
 
+@contextmanager
+def open_mets(dip_path):
+    """Open the METS file from a tar or zip DIP without extracting it.
+
+    The DIP is read until the first member matching `METS_RE` (check
+    `open_member`). Yields the member name and size and a binary file object,
+    which can only be read within the context. Raises `ValueError` if the DIP
+    is not a tar or a zip file or `FileNotFoundError` if the METS file is not
+    found.
+    """
+    with open_member(dip_path, METS_RE.match, "METS file") as member:
+        yield member
+
+
 class METS:
     """Class for METS file parsing methods."""
 
     # Fields and xpaths for DigitalFile
     FILE_ELEMENTS = [
-        ("filepath", "./techMD/mdWrap/xmlData/object/originalName"),
+        (
+            "filepath",
+            "./mets:techMD/mets:mdWrap/mets:xmlData/premis:object/premis:originalName",
+        ),
         (
             "uuid",
-            "./techMD/mdWrap/xmlData/object/objectIdentifier/objectIdentifierValue",
+            "./mets:techMD/mets:mdWrap/mets:xmlData/premis:object/premis:objectIdentifier/premis:objectIdentifierValue",
         ),
         (
             "hashtype",
-            "./techMD/mdWrap/xmlData/object/objectCharacteristics/fixity/messageDigestAlgorithm",
+            "./mets:techMD/mets:mdWrap/mets:xmlData/premis:object/premis:objectCharacteristics/premis:fixity/premis:messageDigestAlgorithm",
         ),
         (
             "hashvalue",
-            "./techMD/mdWrap/xmlData/object/objectCharacteristics/fixity/messageDigest",
+            "./mets:techMD/mets:mdWrap/mets:xmlData/premis:object/premis:objectCharacteristics/premis:fixity/premis:messageDigest",
+        ),
+        (
+            "size_bytes",
+            "./mets:techMD/mets:mdWrap/mets:xmlData/premis:object/premis:objectCharacteristics/premis:size",
         ),
-        ("size_bytes", "./techMD/mdWrap/xmlData/object/objectCharacteristics/size"),
         (
             "fileformat",
-            "./techMD/mdWrap/xmlData/object/objectCharacteristics/format/formatDesignation/formatName",
+            "./mets:techMD/mets:mdWrap/mets:xmlData/premis:object/premis:objectCharacteristics/premis:format/premis:formatDesignation/premis:formatName",
         ),
         (
             "formatversion",
-            "./techMD/mdWrap/xmlData/object/objectCharacteristics/format/formatDesignation/formatVersion",
+            "./mets:techMD/mets:mdWrap/mets:xmlData/premis:object/premis:objectCharacteristics/premis:format/premis:formatDesignation/premis:formatVersion",
         ),
         (
             "puid",
-            "./techMD/mdWrap/xmlData/object/objectCharacteristics/format/formatRegistry/formatRegistryKey",
+            "./mets:techMD/mets:mdWrap/mets:xmlData/premis:object/premis:objectCharacteristics/premis:format/premis:formatRegistry/premis:formatRegistryKey",
         ),
         (
             "datemodified",
-            './techMD/mdWrap/xmlData/object/objectCharacteristics/objectCharacteristicsExtension/fits/fileinfo/fslastmodified[@toolname="OIS File Information"]',
+            './mets:techMD/mets:mdWrap/mets:xmlData/premis:object/premis:objectCharacteristics/premis:objectCharacteristicsExtension/fits:fits/fits:fileinfo/fits:fslastmodified[@toolname="OIS File Information"]',
         ),
     ]
     # Fields and xpaths for PREMISEvent
     PREMIS_ELEMENTS = [
-        ("uuid", "./xmlData/event/eventIdentifier/eventIdentifierValue"),
-        ("eventtype", ".xmlData/event/eventType"),
-        ("datetime", "./xmlData/event/eventDateTime"),
-        ("detail", "./xmlData/event//eventDetail"),
-        ("outcome", "./xmlData/event/eventOutcomeInformation/eventOutcome"),
+        (
+            "uuid",
+            "./mets:xmlData/premis:event/premis:eventIdentifier/premis:eventIdentifierValue",
+        ),
+        ("eventtype", "./mets:xmlData/premis:event/premis:eventType"),
+        ("datetime", "./mets:xmlData/premis:event/premis:eventDateTime"),
+        ("detail", "./mets:xmlData/premis:event//premis:eventDetail"),
+        (
+            "outcome",
+            "./mets:xmlData/premis:event/premis:eventOutcomeInformation/premis:eventOutcome",
+        ),
         (
             "detailnote",
-            "./xmlData/event/eventOutcomeInformation/eventOutcomeDetail/eventOutcomeDetailNote",
+            "./mets:xmlData/premis:event/premis:eventOutcomeInformation/premis:eventOutcomeDetail/premis:eventOutcomeDetailNote",
         ),
     ]
 
-    def __init__(self, path, dip_id):
-        self.path = os.path.abspath(path)
+    # Pre-compiled XPath expressions to reuse them for each file
+    FILE_XPATHS = [(key, _compile_xpath(xpath)) for key, xpath in FILE_ELEMENTS]
+    PREMIS_XPATHS = [(key, _compile_xpath(xpath)) for key, xpath in PREMIS_ELEMENTS]
+    PREMIS_EVENTS_XPATH = _compile_xpath(
+        ".//mets:digiprovMD/mets:mdWrap[@MDTYPE='PREMIS:EVENT']"
+    )
+    ORIGINAL_FILES_XPATH = _compile_xpath(".//mets:fileGrp[@USE='original']/mets:file")
+
+    def __init__(self, path, dip_id, streaming=None, from_dip=False, client=None):
+        """Prepare the METS file for parsing.
+
+        The whole file is loaded into memory unless `streaming` is enabled, in
+        which case the file is read incrementally and only a small amount of
+        data is kept between passes. If `streaming` is not set, it's enabled for
+        files bigger than the `METS_STREAMING_MIN_SIZE` setting or with unknown
+        size. With `from_dip`, `path` is a tar or zip DIP and the METS file is
+        read from it on each pass, without extracting it (check `open_mets`).
+        With `client`, `path` is the URL of the METS file in the Storage
+        Service, requested with the given `StorageServiceClient` on each pass
+        and parsed as it's received. The SHA-256 hash of the METS file is
+        computed in the first pass and kept in `sha256`.
+        """
+        self.path = path if client else os.path.abspath(path)
         self.dip_id = dip_id
-        self.mets_root = self._get_mets_root()
-
-    def _get_mets_root(self):
-        """Open XML and return the root element with all namespaces stripped."""
-        tree = etree.parse(self.path)
-        root = tree.getroot()
-        for elem in root.getiterator():
-            if hasattr(elem.tag, "find"):
-                i = elem.tag.find("}")
-                if i >= 0:
-                    elem.tag = elem.tag[i + 1 :]
-        objectify.deannotate(root, cleanup_namespaces=True)
-        return root
-
-    def parse_mets(self):
-        """Parse METS and save data to DIP, DigitalFile, and PremisEvent models."""
-        # Get DIP object
-        dip = DIP.objects.get(pk=self.dip_id)
+        self.from_dip = from_dip
+        self.client = client
+        self.mets_root = None
+        with self._open() as (size, mets_file):
+            if streaming is None:
+                streaming = size is None or size >= settings.METS_STREAMING_MIN_SIZE
+            self.streaming = streaming
+            mets_file = SHA256Reader(mets_file)
+            if self.streaming:
+                self._scan_mets(mets_file)
+            else:
+                self.mets_root = etree.parse(mets_file).getroot()
+                self._amdsecs = self._get_amdsecs_index()
+            self.sha256 = mets_file.hexdigest()
+
+    @contextmanager
+    def _open(self):
+        """Open the METS file, yielding its size and a binary file object."""
+        if self.client:
+            with self.client.open(self.path) as (size, mets_file):
+                yield size, mets_file
+        elif self.from_dip:
+            with open_mets(self.path) as (_, size, mets_file):
+                yield size, mets_file
+        else:
+            with open(self.path, "rb") as mets_file:
+                yield os.fstat(mets_file.fileno()).st_size, mets_file
+
+    def _get_amdsecs_index(self):
+        """Map amdSec ids to their elements in a single pass over the tree."""
+        index = {}
+        for amdsec in self.mets_root.iter("{%s}amdSec" % METS_NS):
+            index.setdefault(amdsec.get("ID"), []).append(amdsec)
+        return index
+
+    def _iterparse(self, tags, events=("end",), mets_file=None):
+        """Incrementally parse the METS file, yielding the given METS elements.
+
+        The yielded elements are cleared after the end event has been processed,
+        together with their previous siblings, to keep memory usage flat. The
+        METS file is opened again if `mets_file` is not given.
+        """
+        if mets_file is None:
+            with self._open() as (_, mets_file):
+                yield from self._iterparse(tags, events, mets_file)
+            return
+        context = etree.iterparse(
+            mets_file, events=events, tag=["{%s}%s" % (METS_NS, t) for t in tags]
+        )
+        for event, elem in context:
+            yield event, elem
+            if event == "end":
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+        del context
+
+    def _scan_mets(self, mets_file):
+        """Gather the data required to parse the METS file incrementally.
+
+        Collects the original files amdSec ids, the Dublin Core dmdSecs and the
+        SIP DMD ids, which are placed at different points of the METS file.
+        """
+        self._original_amdsec_ids = []
+        self._dc_dmdsecs = []
+        self._sip_dmdids = None
+        sip_div_found = False
+        div_depth = 0
+        tags = ("dmdSec", "amdSec", "fileGrp", "file", "structMap", "div")
+        for event, elem in self._iterparse(tags, ("start", "end"), mets_file):
+            tag = etree.QName(elem).localname
+            if tag == "structMap":
+                div_depth = 0
+            elif tag == "div":
+                # Look for the first `structMap/div/div` objects directory
+                if event == "end":
+                    div_depth -= 1
+                    continue
+                div_depth += 1
+                if (
+                    div_depth == 2
+                    and not sip_div_found
+                    and elem.get("TYPE") == "Directory"
+                    and elem.get("LABEL") == "objects"
+                ):
+                    sip_div_found = True
+                    self._sip_dmdids = elem.get("DMDID")
+            elif event == "start":
+                continue
+            elif tag == "file":
+                parent = elem.getparent()
+                if (
+                    parent.tag == "{%s}fileGrp" % METS_NS
+                    and parent.get("USE") == "original"
+                    and elem.get("ADMID")
+                ):
+                    self._original_amdsec_ids.append(elem.get("ADMID"))
+            elif tag == "dmdSec" and elem.getparent().getparent() is None:
+                xpath = "mets:mdWrap[@MDTYPE='DC']"
+                if not elem.xpath(xpath, namespaces={"mets": METS_NS}):
+                    continue
+                dc_xml = elem.find(
+                    "{%s}mdWrap/{%s}xmlData/{*}dublincore" % (METS_NS, METS_NS)
+                )
+                dc_elements = None
+                if dc_xml is not None:
+                    dc_elements = [
+                        (etree.QName(child).localname, child.text)
+                        for child in dc_xml
+                        if isinstance(child.tag, str)
+                    ]
+                self._dc_dmdsecs.append(
+                    (elem.get("CREATED", ""), elem.get("ID", ""), dc_elements)
+                )
 
-        # Gather info for each file in filegroup "original"
-        for file_ in self.mets_root.findall(".//fileGrp[@USE='original']/file"):
+    def parse_mets(self, update_es=True):
+        """Parse METS and save data to DIP, DigitalFile, and PremisEvent models.
+
+        The original files and their events are saved in batches, with the size
+        from the `IMPORT_BATCH_SIZE` setting, and all the changes are made in a
+        single transaction. When the METS file is imported again, only the new
+        and changed rows are saved and the DigitalFiles no longer present in
+        the METS file are deleted. The insert, update, unchanged and delete
+        counts of the DigitalFiles are saved in the DIP `import_counts` and the
+        UUIDs of the changed and deleted DigitalFiles are kept in the
+        `changed_files` and `deleted_files` attributes. The changed documents
+        are saved and the deleted ones removed from ES one by one, unless
+        `update_es` is `False`, to allow updating them in bulk with
+        `DIP.index_digital_files` afterwards.
+        """
+        with transaction.atomic():
+            # Get DIP object
+            dip = DIP.objects.get(pk=self.dip_id)
+            importer = DIPImporter(dip, update_es=update_es)
+
+            # Gather info for each file in filegroup "original"
+            imported_files = set()
+            for batch in iter_batches(
+                self._iter_file_metadata(), settings.IMPORT_BATCH_SIZE
+            ):
+                for digitalfiles in importer.save_files(batch):
+                    imported_files.update(file_.uuid for file_ in digitalfiles)
+
+            importer.delete_missing_files(imported_files)
+            importer.update_dc(self._parse_dc())
+            importer.save_counts()
+
+        self.changed_files = importer.changed_files
+        self.deleted_files = importer.deleted_files
+        return dip
+
+    def write_parsed_data(self, path):
+        """Write the parsed metadata to a gzip compressed JSON lines file.
+
+        The first line contains the Dublin Core metadata and each of the
+        following lines the metadata and events of an original file, to be
+        read with `read_parsed_dc` and `iter_parsed_files`. The file is
+        written with a temporary name and renamed at the end, so concurrent
+        writers of the same file don't interfere.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with gzip.open(os.fdopen(fd, "wb"), "wt", compresslevel=6) as data_file:
+                data_file.write(self._dump_line({"dc": self._parse_dc()}))
+                for file_data, events in self._iter_file_metadata():
+                    data_file.write(
+                        self._dump_line({"file": file_data, "events": events})
+                    )
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _dump_line(self, data):
+        return json.dumps(data, separators=(",", ":")) + "\n"
+
+    def _iter_file_metadata(self):
+        """Yield metadata and events for each file in filegroup "original"."""
+        if self.streaming:
+            yield from self._iterparse_file_metadata()
+            return
+        for file_ in self.ORIGINAL_FILES_XPATH(self.mets_root):
             amdsec_id = file_.get("ADMID")
             if not amdsec_id:
                 continue
+            yield self._parse_file_metadata(amdsec_id)
+
+    def _iterparse_file_metadata(self):
+        """Incrementally parse the amdSecs from the original files.
+
+        The amdSecs are processed in document order and the iteration stops
+        when all the original files have been found, as the amdSecs are
+        placed before the fileSec and structMap sections.
+        """
+        pending_ids = set(self._original_amdsec_ids)
+        if not pending_ids:
+            return
+        tags = ("amdSec", "fileGrp", "file", "div")
+        for _, elem in self._iterparse(tags):
+            amdsec_id = elem.get("ID")
+            if etree.QName(elem).localname != "amdSec" or amdsec_id not in pending_ids:
+                continue
+            pending_ids.discard(amdsec_id)
+            data = {"amdsec": amdsec_id}
+            events = list()
+            self._parse_amdsec(elem, data, events)
+            yield (data, events)
+            if not pending_ids:
+                break
+        # Keep the same output for original files without amdSec
+        for amdsec_id in self._original_amdsec_ids:
+            if amdsec_id in pending_ids:
+                pending_ids.discard(amdsec_id)
+                yield ({"amdsec": amdsec_id}, [])
+
+    def _parse_file_metadata(self, amdsec_id):
+        """Parse file metadata into a dict and an events list."""
+        # Create new dictionary for this item's info, including
+        # the amdSec id, and new list of dicts for premis events.
+        data = {"amdsec": amdsec_id}
+        events = list()
+
+        # Parse amdSec
+        for amdsec in self._amdsecs.get(amdsec_id, []):
+            self._parse_amdsec(amdsec, data, events)
+
+        return (data, events)
+
+    def _parse_amdsec(self, amdsec, data, events):
+        """Add file metadata and events from an amdSec to the given containers."""
+        # Iterate over elements and write key, value
+        # for each to data dictionary.
+        for key, xpath in self.FILE_XPATHS:
+            data[key] = self._get_text(amdsec, xpath)
+
+        # Parse premis events related to file
+        for premis_event in self.PREMIS_EVENTS_XPATH(amdsec):
+            # Iterate over elements and write key, value
+            # for each to event dictionary.
+            event = dict()
+            for key, xpath in self.PREMIS_XPATHS:
+                event[key] = self._get_text(premis_event, xpath)
+            events.append(event)
+
+    def _get_text(self, elem, xpath):
+        """Get the text of the first match or an empty string if none found."""
+        results = xpath(elem)
+        if not results:
+            return ""
+        return results[0].text
+
+    def _parse_dc(self):
+        """Parse SIP-level Dublin Core metadata into dc_model dictionary.
+
+        Based on `parse_dc` from Archivematica parse_mets_to_db.py script
+        (src/MCPClient/lib/clientScripts/parse_mets_to_db.py).
+        """
+        if self.streaming:
+            return self._parse_scanned_dc()
+
+        # Find DMD sections and return if none is found
+        xpath = 'mets:dmdSec/mets:mdWrap[@MDTYPE="DC"]/parent::*'
+        dmds = self.mets_root.xpath(xpath, namespaces=NAMESPACES)
+        if len(dmds) == 0:
+            return
+
+        # Find SIP DMD ids, not file, and return if none is found
+        xpath = 'mets:structMap/mets:div/mets:div[@TYPE="Directory"][@LABEL="objects"]'
+        divs = self.mets_root.find(xpath, namespaces=NAMESPACES)
+        dmdids = divs.get("DMDID")
+        if dmdids is None:
+            return
+
+        # Sort by date and loop over reversed DMD sections, check SIP
+        # DMD ids to get the last updated SIP's Dublin Core metadata.
+        dmdids = dmdids.split()
+        dmds = sorted(dmds, key=lambda e: e.get("CREATED", ""))
+        for dmd in dmds[::-1]:
+            if dmd.get("ID", "") in dmdids:
+                xpath = "mets:mdWrap/mets:xmlData/{*}dublincore"
+                dc_xml = dmd.find(xpath, namespaces=NAMESPACES)
+                if dc_xml is not None and len(dc_xml):
+                    break
+
+        return self._get_dc_model(
+            (etree.QName(elem).localname, elem.text)
+            for elem in dc_xml
+            if isinstance(elem.tag, str)
+        )
+
+    def _parse_scanned_dc(self):
+        """Get the Dublin Core metadata gathered in `_scan_mets`.
+
+        Follows the same steps as `_parse_dc` over the scanned data.
+        """
+        if not self._dc_dmdsecs or self._sip_dmdids is None:
+            return
+
+        dmdids = self._sip_dmdids.split()
+        dmds = sorted(self._dc_dmdsecs, key=lambda dmd: dmd[0])
+        dc_elements = None
+        for _, dmd_id, elements in dmds[::-1]:
+            if dmd_id in dmdids:
+                dc_elements = elements
+                if dc_elements:
+                    break
+        if dc_elements is None:
+            return
+
+        return self._get_dc_model(dc_elements)
+
+    def _get_dc_model(self, dc_elements):
+        """Get dc_model dictionary from an iterable of key, value pairs."""
+        # Parse all DC elements to a dictionary. Initiate all fields with
+        # empty strings as no one can be null.
+        dc_model = {
+            "identifier": "",
+            "title": "",
+            "creator": "",
+            "subject": "",
+            "description": "",
+            "publisher": "",
+            "contributor": "",
+            "date": "",
+            "type": "",
+            "format": "",
+            "source": "",
+            "language": "",
+            "coverage": "",
+            "rights": "",
+            "isPartOf": "",
+            "relation": "",
+        }
+        for key, value in dc_elements:
+            if key in dc_model and value:
+                dc_model[key] = str(value)
+
+        return dc_model
+
+
+def read_parsed_dc(path):
+    """Read the Dublin Core metadata from a file written by `METS`."""
+    with gzip.open(path, "rt") as data_file:
+        return json.loads(next(data_file))["dc"]
+
 
-            file_data, premis_events = self._parse_file_metadata(amdsec_id)
+def iter_parsed_files(path):
+    """Yield the metadata and events of each file written by `METS`."""
+    with gzip.open(path, "rt") as data_file:
+        next(data_file)
+        for line in data_file:
+            data = json.loads(line)
+            yield (data["file"], data["events"])
+
+
+class DIPImporter:
+    """Save the metadata parsed from a METS file in a DIP.
+
+    Keeps the insert, update, unchanged and delete counts of the DigitalFiles
+    in `counts`, and the UUIDs of the changed and deleted DigitalFiles in
+    `changed_files` and `deleted_files`. The changed documents are saved and
+    the deleted ones removed from ES one by one, unless `update_es` is `False`.
+    """
+
+    def __init__(self, dip, update_es=True):
+        self.dip = dip
+        self.update_es = update_es
+        self.counts = OrderedDict(
+            [("inserted", 0), ("updated", 0), ("unchanged", 0), ("deleted", 0)]
+        )
+        self.changed_files = []
+        self.deleted_files = []
+
+    def validate_files(self, batches):
+        """Validate batches of original files metadata without saving them.
+
+        Makes the same checks as `save_files` for each batch, and checks that
+        the PREMISEvents UUIDs are not repeated across batches, raising
+        METSError on the first error found. Used to check all the files before
+        saving the first batch, as each batch is saved in its own transaction.
+        """
+        event_files = {}
+        for batch in batches:
+            for file_data, premis_events in batch:
+                file_uuid = file_data.get("uuid")
+                for event in premis_events:
+                    uuid = event.get("uuid")
+                    if uuid and event_files.setdefault(uuid, file_uuid) != file_uuid:
+                        raise METSError(
+                            "A PREMISEvent in this METS file has the same "
+                            "UUID as an existing one from another DIP "
+                            "(%s)." % uuid
+                        )
+            self._prepare_files(batch)
+
+    def save_files(self, batch):
+        """Save a batch of original files metadata and their PREMIS events.
+
+        Existing DigitalFiles and PREMISEvents are fetched with a query per
+        chunk of UUIDs and all the instances are validated before saving. Only
+        the new instances and the ones with changes are saved, in bulk, and the
+        existing events no longer related to the files are deleted. Returns the
+        new, updated and unchanged DigitalFiles in separate lists.
+        """
+        (
+            new_files,
+            updated_files,
+            unchanged_files,
+            new_events,
+            updated_events,
+            deleted_events,
+        ) = self._prepare_files(batch)
+        batch_size = settings.IMPORT_BATCH_SIZE
+
+        # Save all changes in bulk, `bulk_update` doesn't set `auto_now` fields
+        modified = datetime.now(timezone.utc)
+        for digitalfile in updated_files:
+            digitalfile.modified = modified
+        DigitalFile.objects.bulk_create(new_files, batch_size=batch_size)
+        DigitalFile.objects.bulk_update(
+            updated_files, self._update_fields(DigitalFile), batch_size=batch_size
+        )
+        for uuids in iter_batches(deleted_events, batch_size):
+            PREMISEvent.objects.filter(uuid__in=uuids).delete()
+        PREMISEvent.objects.bulk_create(new_events, batch_size=batch_size)
+        PREMISEvent.objects.bulk_update(
+            updated_events, self._update_fields(PREMISEvent), batch_size=batch_size
+        )
+
+        self.counts["inserted"] += len(new_files)
+        self.counts["updated"] += len(updated_files)
+        self.counts["unchanged"] += len(unchanged_files)
+        for digitalfile in new_files + updated_files:
+            self.changed_files.append(digitalfile.uuid)
+            if self.update_es:
+                # Use refresh to reflect the changes in the index right away
+                digitalfile.save_es_doc()
+
+        return new_files, updated_files, unchanged_files
+
+    def _prepare_files(self, batch):
+        """Build and validate the instances to save from a batch.
+
+        Returns the new, updated and unchanged DigitalFiles, the new and
+        updated PREMISEvents and the UUIDs of the PREMISEvents to delete.
+        """
+        dip = self.dip
+        batch_size = settings.IMPORT_BATCH_SIZE
+
+        # Gather file and events data by file UUID
+        files_data = OrderedDict()
+        for file_data, premis_events in batch:
             file_data = self._transform_file_metadata(file_data)
 
             # Check mandatory UUID field
@@ -104,33 +610,40 @@ class METS:
                 raise METSError(
                     "An original file in this METS file is missing its UUID."
                 )
-            # Get existing DigitalFile by UUID
-            try:
-                digitalfile = DigitalFile.objects.get(uuid=uuid)
-                # Don't update DigitalFile from other DIP
-                if digitalfile.dip.pk != dip.pk:
-                    raise METSError(
-                        "An original file in this METS file has the same UUID "
-                        "as an existing one from another DIP "
-                        "(%s)." % uuid
-                    )
-            except DigitalFile.DoesNotExist:
+            _, events = files_data.get(uuid, (None, []))
+            files_data[uuid] = (file_data, events + premis_events)
+
+        # Get existing DigitalFiles by UUID
+        existing_files = get_in_bulk(DigitalFile, files_data.keys(), batch_size)
+        new_files, updated_files, unchanged_files = [], [], []
+        for uuid, (file_data, _) in files_data.items():
+            digitalfile = existing_files.get(uuid)
+            if digitalfile is None:
                 # Create DigitalFIle if it doesn't exist
                 digitalfile = DigitalFile(uuid=uuid)
+                new_files.append(digitalfile)
+            elif digitalfile.dip_id != dip.pk:
+                # Don't update DigitalFile from other DIP
+                raise METSError(
+                    "An original file in this METS file has the same UUID "
+                    "as an existing one from another DIP "
+                    "(%s)." % uuid
+                )
+            values = self._get_values(digitalfile)
             # Add/update instance fields with file_data values
             digitalfile = update_instance_from_dict(digitalfile, file_data)
             digitalfile.dip = dip
-            # Validate
-            try:
-                digitalfile.full_clean()
-            except ValidationError as e:
-                message = "A DigitalFile could not be created:"
-                for field, errors in e.message_dict.items():
-                    message += "\n- %s: %s" % (field, " ".join(errors))
-                raise METSError(message)
-            digitalfile.save()
-
-            # Add premis events data to PREMISEvent model
+            self._validate(digitalfile, "A DigitalFile could not be created:")
+            if uuid not in existing_files:
+                continue
+            if self._get_values(digitalfile) != values:
+                updated_files.append(digitalfile)
+            else:
+                unchanged_files.append(digitalfile)
+
+        # Gather events data by UUID with the related file UUID
+        events_data = OrderedDict()
+        for file_uuid, (_, premis_events) in files_data.items():
             for event in premis_events:
                 # Check mandatory UUID field
                 uuid = event.pop("uuid", None)
@@ -138,35 +651,81 @@ class METS:
                     raise METSError(
                         "A PREMISEvent in this METS file is missing its UUID."
                     )
-                # Get existing PREMISEvent by UUID
-                try:
-                    premisevent = PREMISEvent.objects.get(uuid=uuid)
-                    # Don't update PREMISEvent from other DigitalFile
-                    if premisevent.digitalfile.uuid != digitalfile.uuid:
-                        raise METSError(
-                            "A PREMISEvent in this METS file has the same "
-                            "UUID as an existing one from another DIP "
-                            "(%s)." % uuid
-                        )
-                except PREMISEvent.DoesNotExist:
-                    # Create PREMISEvent if it doesn't exist
-                    premisevent = PREMISEvent(uuid=uuid)
-                # Add/update instance fields with event values
-                premisevent = update_instance_from_dict(premisevent, event)
-                premisevent.digitalfile = digitalfile
-                # Validate
-                try:
-                    premisevent.full_clean()
-                except ValidationError as e:
-                    message = "A PREMISEvent could not be created:"
-                    for field, errors in e.message_dict.items():
-                        message += "\n- %s: %s" % (field, " ".join(errors))
-                    raise METSError(message)
-                premisevent.save()
-
-        # Gather Dublin Core metadata from most recent
-        # dmdSec and update DIP DublinCore object.
-        dc_data = self._parse_dc()
+                if uuid in events_data and events_data[uuid][1] != file_uuid:
+                    raise METSError(
+                        "A PREMISEvent in this METS file has the same "
+                        "UUID as an existing one from another DIP "
+                        "(%s)." % uuid
+                    )
+                events_data[uuid] = (event, file_uuid)
+
+        # Get existing PREMISEvents from the existing DigitalFiles and
+        # by UUID for the remaining events, to check their relations.
+        existing_events = {}
+        for uuids in iter_batches(existing_files.keys(), batch_size):
+            for premisevent in PREMISEvent.objects.filter(digitalfile_id__in=uuids):
+                existing_events[premisevent.uuid] = premisevent
+        deleted_events = [
+            uuid for uuid in existing_events.keys() if uuid not in events_data
+        ]
+        other_events = [
+            uuid for uuid in events_data.keys() if uuid not in existing_events
+        ]
+        existing_events.update(get_in_bulk(PREMISEvent, other_events, batch_size))
+        new_events, updated_events = [], []
+        for uuid, (event, file_uuid) in events_data.items():
+            premisevent = existing_events.get(uuid)
+            if premisevent is None:
+                # Create PREMISEvent if it doesn't exist
+                premisevent = PREMISEvent(uuid=uuid)
+                new_events.append(premisevent)
+            elif premisevent.digitalfile_id != file_uuid:
+                # Don't update PREMISEvent from other DigitalFile
+                raise METSError(
+                    "A PREMISEvent in this METS file has the same "
+                    "UUID as an existing one from another DIP "
+                    "(%s)." % uuid
+                )
+            values = self._get_values(premisevent)
+            # Add/update instance fields with event values
+            premisevent = update_instance_from_dict(premisevent, event)
+            premisevent.digitalfile_id = file_uuid
+            self._validate(premisevent, "A PREMISEvent could not be created:")
+            if uuid in existing_events and self._get_values(premisevent) != values:
+                updated_events.append(premisevent)
+
+        return (
+            new_files,
+            updated_files,
+            unchanged_files,
+            new_events,
+            updated_events,
+            deleted_events,
+        )
+
+    def delete_missing_files(self, uuids):
+        """Delete the DIP DigitalFiles not included in the given UUIDs.
+
+        The related PREMISEvents are also deleted. Returns the UUIDs of the
+        deleted DigitalFiles.
+        """
+        existing_files = self.dip.digital_files.values_list("uuid", flat=True)
+        deleted_files = sorted(set(existing_files) - set(uuids))
+        for chunk in iter_batches(deleted_files, settings.IMPORT_BATCH_SIZE):
+            DigitalFile.objects.filter(uuid__in=chunk).delete()
+        self.counts["deleted"] += len(deleted_files)
+        self.deleted_files.extend(deleted_files)
+        if self.update_es:
+            for uuid in deleted_files:
+                delete_document(index=DigitalFile.es_doc._index._name, id=uuid)
+        return deleted_files
+
+    def update_dc(self, dc_data):
+        """Update DIP DublinCore and Collection from the METS metadata.
+
+        The Dublin Core metadata comes from the most recent SIP dmdSec.
+        """
+        dip = self.dip
         if dc_data:
             # The `isPartOf` and `relation` values are only used to find a
             # related Collection, giving priority to the `isPartOf` value.
@@ -201,40 +760,58 @@ class METS:
             dip.dc = update_instance_from_dict(dip.dc, dc_data)
             dip.dc.save()
 
-        return dip
+    def update_dip_members(self, members):
+        """Save the access copy member of each DigitalFile in the DIP file.
 
-    def _parse_file_metadata(self, amdsec_id):
-        """Parse file metadata into a dict and an events list."""
-        # Create new dictionary for this item's info, including
-        # the amdSec id, and new list of dicts for premis events.
-        data = {"amdsec": amdsec_id}
-        events = list()
+        The member name, data offset and size from `get_access_copy_members`
+        are saved to download the access copies without the rest of the DIP.
+        The DigitalFiles without member are located by UUID on download.
+        """
+        fields = ["dip_member", "dip_member_offset", "dip_member_size"]
+        updated_files = []
+        for digital_file in self.dip.digital_files.only("uuid", *fields).iterator():
+            values = members.get(digital_file.uuid, ["", None, None])
+            if [getattr(digital_file, field) for field in fields] == values:
+                continue
+            for field, value in zip(fields, values):
+                setattr(digital_file, field, value)
+            updated_files.append(digital_file)
+        DigitalFile.objects.bulk_update(
+            updated_files, fields, batch_size=settings.IMPORT_BATCH_SIZE
+        )
 
-        # Parse amdSec
-        amdsec_xpath = ".//amdSec[@ID='{}']".format(amdsec_id)
-        for amdsec in self.mets_root.findall(amdsec_xpath):
-            # Iterate over elements and write key, value
-            # for each to data dictionary.
-            for key, xpath in self.FILE_ELEMENTS:
-                try:
-                    data[key] = amdsec.find(xpath).text
-                except AttributeError:
-                    data[key] = ""
-
-            # Parse premis events related to file
-            premis_event_xpath = ".//digiprovMD/mdWrap[@MDTYPE='PREMIS:EVENT']"
-            for premis_event in amdsec.findall(premis_event_xpath):
-                # Iterate over elements and write key, value
-                # for each to event dictionary.
-                event = dict()
-                for key, xpath in self.PREMIS_ELEMENTS:
-                    try:
-                        event[key] = premis_event.find(xpath).text
-                    except AttributeError:
-                        event[key] = ""
-                events.append(event)
+    def save_counts(self):
+        """Save the import counts in the DIP."""
+        self.dip.import_counts = self.counts
+        self.dip.save(update_es=False)
 
-        return (data, events)
+    def _validate(self, instance, message):
+        """Validate model instance, raising METSError with the given message.
+
+        Uniqueness and relations are not validated to avoid a query per
+        instance, as they are checked before and set during the import.
+        """
+        relations = [
+            field.name for field in instance._meta.concrete_fields if field.is_relation
+        ]
+        try:
+            instance.full_clean(exclude=relations, validate_unique=False)
+        except ValidationError as e:
+            for field, errors in e.message_dict.items():
+                message += "\n- %s: %s" % (field, " ".join(errors))
+            raise METSError(message)
+
+    def _get_values(self, instance):
+        """Get the values of the instance fields to find changes."""
+        return [
+            getattr(instance, field.attname) for field in instance._meta.concrete_fields
+        ]
+
+    def _update_fields(self, model):
+        """Get the names of the fields to set in bulk updates."""
+        return [
+            field.name for field in model._meta.concrete_fields if not field.primary_key
+        ]
 
     def _transform_file_metadata(self, data):
         """Transform file metadata to be saved in DigitalFile fields."""
@@ -258,58 +835,202 @@ class METS:
 
         return data
 
-    def _parse_dc(self):
-        """Parse SIP-level Dublin Core metadata into dc_model dictionary.
 
-        Based on `parse_dc` from Archivematica parse_mets_to_db.py script
-        (src/MCPClient/lib/clientScripts/parse_mets_to_db.py).
-        """
-        # Find DMD sections and return if none is found
-        xpath = 'dmdSec/mdWrap[@MDTYPE="DC"]/parent::*'
-        dmds = self.mets_root.xpath(xpath)
-        if len(dmds) == 0:
-            return
+class METSImport:
+    """Import a METS file in checkpointed stages.
 
-        # Find SIP DMD ids, not file, and return if none is found
-        xpath = 'structMap/div/div[@TYPE="Directory"][@LABEL="objects"]'
-        divs = self.mets_root.find(xpath)
-        dmdids = divs.get("DMDID")
-        if dmdids is None:
+    - parse: the METS file is parsed to an intermediate file, named after the
+      METS SHA-256 hash computed while parsing it, and removed after. Writing
+      the intermediate file is skipped if the one from an identical METS file
+      already exists. Then, all the files metadata is validated against the
+      database, so the import fails before saving anything if the METS file
+      is not valid. With `from_dip`, the METS file is read from the tar or zip
+      DIP at `mets_path` without extracting it and the DIP is not removed.
+      With `client`, the METS file is parsed as it's received from the Storage
+      Service URL at `mets_path`, so only the intermediate file is written to
+      disk.
+    - save: the parsed data is saved in the database in batches, with the size
+      from the `IMPORT_BATCH_SIZE` setting, each one in its own transaction.
+      The import is not atomic: the batches saved before a failure are kept,
+      and searchable once indexed, until the import is resumed. Only changes
+      made meanwhile to the same UUIDs by other imports can make a validated
+      batch fail with METSError.
+      The DigitalFiles missing from the METS file are deleted and the DIP
+      metadata updated at the end, with the position of the access copies in
+      the DIP file when it's imported `from_dip`, read before the transaction
+      and only from uncompressed tar and zip files.
+    - index: the new, changed and deleted DigitalFiles are updated in ES in
+      batches of the same size, and the index is refreshed once at the end.
+
+    The progress is saved in the DIP `import_progress` after each stage and
+    batch, so running the import again after a failure resumes from the last
+    completed batch. All the stages are idempotent and the UUIDs of the
+    changed and deleted DigitalFiles are written to a second file before the
+    database changes are committed, which may lead to index some unchanged
+    DigitalFiles again when a batch is retried. The intermediate files are
+    kept for the seconds set in the `IMPORT_DATA_MAX_AGE` setting after their
+    last use.
+    """
+
+    def __init__(self, mets_path, dip_id, from_dip=False, client=None):
+        self.mets_path = mets_path
+        self.dip_id = dip_id
+        self.from_dip = from_dip
+        self.client = client
+        # Only the METS files extracted or downloaded for the import are removed
+        self.remove_mets = not (from_dip or client)
+        self.data_dir = os.path.join(settings.MEDIA_ROOT, "imports")
+        self.data_path = None
+        self.changes_path = os.path.join(self.data_dir, "%s.changes.jsonl" % dip_id)
+
+    def run(self):
+        """Run the pending stages of the import and return the DIP."""
+        dip = DIP.objects.get(pk=self.dip_id)
+        progress = dip.import_progress or {"stage": "parse"}
+        if "sha256" in progress:
+            self.data_path = self._get_data_path(progress["sha256"])
+        if progress["stage"] == "parse":
+            progress = self._parse(dip)
+        if progress["stage"] == "save":
+            progress = self._save(dip, progress)
+        if progress["stage"] == "index":
+            progress = self._index(dip, progress)
+        return dip
+
+    def clean(self):
+        """Remove the METS file, the changes file and the expired parsed data."""
+        paths = [self.changes_path]
+        if self.remove_mets:
+            paths.append(self.mets_path)
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+        if not os.path.isdir(self.data_dir):
             return
+        expiration = time.time() - settings.IMPORT_DATA_MAX_AGE
+        for name in os.listdir(self.data_dir):
+            path = os.path.join(self.data_dir, name)
+            if name.endswith(".jsonl.gz") and os.path.getmtime(path) < expiration:
+                os.remove(path)
 
-        # Sort by date and loop over reversed DMD sections, check SIP
-        # DMD ids to get the last updated SIP's Dublin Core metadata.
-        dmdids = dmdids.split()
-        dmds = sorted(dmds, key=lambda e: e.get("CREATED", ""))
-        for dmd in dmds[::-1]:
-            if dmd.get("ID", "") in dmdids:
-                dc_xml = dmd.find("mdWrap/xmlData/dublincore")
-                if dc_xml is not None and len(dc_xml):
-                    break
+    def _get_data_path(self, sha256):
+        return os.path.join(self.data_dir, "%s.jsonl.gz" % sha256)
 
-        # Parse all DC elements to a dictionary. Initiate all fields with
-        # empty strings as no one can be null.
-        dc_model = {
-            "identifier": "",
-            "title": "",
-            "creator": "",
-            "subject": "",
-            "description": "",
-            "publisher": "",
-            "contributor": "",
-            "date": "",
-            "type": "",
-            "format": "",
-            "source": "",
-            "language": "",
-            "coverage": "",
-            "rights": "",
-            "isPartOf": "",
-            "relation": "",
-        }
-        for elem in dc_xml:
-            key = str(elem.tag)
-            if key in dc_model and elem.text:
-                dc_model[key] = str(elem.text)
+    def _parse(self, dip):
+        os.makedirs(self.data_dir, exist_ok=True)
+        # The METS file is hashed in the first parsing pass
+        mets = METS(
+            self.mets_path, self.dip_id, from_dip=self.from_dip, client=self.client
+        )
+        sha256 = mets.sha256
+        self.data_path = self._get_data_path(sha256)
+        if os.path.exists(self.data_path):
+            # Identical METS file already parsed, update the modification
+            # time to keep it for another period.
+            os.utime(self.data_path)
+        else:
+            mets.write_parsed_data(self.data_path)
+        DIPImporter(dip).validate_files(
+            iter_batches(iter_parsed_files(self.data_path), settings.IMPORT_BATCH_SIZE)
+        )
+        # Start with an empty changes file
+        open(self.changes_path, "w").close()
+        progress = self._save_progress(
+            dip,
+            {
+                "stage": "save",
+                "sha256": sha256,
+                "files": 0,
+                "counts": DIPImporter(dip).counts,
+            },
+        )
+        if self.remove_mets:
+            os.remove(self.mets_path)
+        return progress
 
-        return dc_model
+    def _save(self, dip, progress):
+        importer = DIPImporter(dip, update_es=False)
+        importer.counts.update(progress["counts"])
+        imported_files = set()
+        batches = iter_batches(
+            iter_parsed_files(self.data_path), settings.IMPORT_BATCH_SIZE
+        )
+        done = 0
+        for batch in batches:
+            imported_files.update(file_data.get("uuid") for file_data, _ in batch)
+            done += len(batch)
+            if done <= progress["files"]:
+                # Saved in a previous run
+                continue
+            with transaction.atomic():
+                new_files, updated_files, _ = importer.save_files(batch)
+                self._write_changes("changed", new_files + updated_files)
+                progress["files"] = done
+                progress["counts"] = importer.counts
+                self._save_progress(dip, progress)
+
+        members = None
+        if self.from_dip:
+            # Read the DIP file outside of the transaction
+            members = get_access_copy_members(self.mets_path)
+        with transaction.atomic():
+            importer.delete_missing_files(imported_files)
+            self._write_changes("deleted", importer.deleted_files)
+            importer.update_dc(read_parsed_dc(self.data_path))
+            if members is not None:
+                importer.update_dip_members(members)
+            importer.save_counts()
+            progress = self._save_progress(
+                dip, {"stage": "index", "sha256": progress["sha256"], "files": 0}
+            )
+        return progress
+
+    def _index(self, dip, progress):
+        changed_files, deleted_files = OrderedDict(), OrderedDict()
+        with open(self.changes_path) as changes_file:
+            for line in changes_file:
+                changes = json.loads(line)
+                for uuid in changes.get("changed", []):
+                    changed_files[uuid] = None
+                for uuid in changes.get("deleted", []):
+                    deleted_files[uuid] = None
+
+        files = chain(
+            ((uuid, False) for uuid in changed_files),
+            ((uuid, True) for uuid in deleted_files),
+        )
+        done = 0
+        for batch in iter_batches(files, settings.IMPORT_BATCH_SIZE):
+            done += len(batch)
+            if done <= progress["files"]:
+                # Indexed in a previous run
+                continue
+            dip.index_digital_files(
+                [uuid for uuid, deleted in batch if not deleted],
+                [uuid for uuid, deleted in batch if deleted],
+                refresh=False,
+            )
+            progress["files"] = done
+            self._save_progress(dip, progress)
+        if done:
+            # Make all the batches visible at once, before the import is done
+            refresh_index(DigitalFile.es_doc._index._name)
+
+        progress = self._save_progress(dip, {"stage": "done"})
+        self.clean()
+        return progress
+
+    def _write_changes(self, key, files):
+        """Append the UUIDs of the changed or deleted files to the changes file."""
+        uuids = [getattr(file_, "uuid", file_) for file_ in files]
+        if not uuids:
+            return
+        with open(self.changes_path, "a") as changes_file:
+            changes_file.write(json.dumps({key: uuids}) + "\n")
+            changes_file.flush()
+            os.fsync(changes_file.fileno())
+
+    def _save_progress(self, dip, progress):
+        dip.import_progress = progress
+        dip.save(update_es=False, update_fields=["import_progress"])
+        return progress
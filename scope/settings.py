@@ -161,11 +161,24 @@ NPM_FILE_PATTERNS = {
     "typeface-roboto": ["files/roboto-latin-400.*"],
 }
 
+# METS import
+
+# Size in bytes from which the METS files are parsed incrementally,
+# keeping memory usage flat at the cost of reading the file twice.
+METS_STREAMING_MIN_SIZE = env.int("METS_STREAMING_MIN_SIZE", default=52428800)
+# Number of files and events written to the database in each bulk operation.
+IMPORT_BATCH_SIZE = env.int("IMPORT_BATCH_SIZE", default=500)
+# Seconds to keep the parsed METS data after its last use, to skip the
+# parsing of identical METS files.
+IMPORT_DATA_MAX_AGE = env.int("IMPORT_DATA_MAX_AGE", default=604800)
+
 # Media
 
 MEDIA_URL = "/media/"
 MEDIA_ROOT = os.path.join(BASE_DIR, "media")
 FILE_UPLOAD_PERMISSIONS = 0o640
+# Maximum number of files included in the zip downloads.
+DOWNLOAD_ZIP_MAX_FILES = env.int("DOWNLOAD_ZIP_MAX_FILES", default=1000)
 
 # Authentication
 
@@ -186,6 +199,21 @@ ES_INDEXES_SETTINGS = {
     "number_of_shards": env.int("ES_INDEXES_SHARDS", default=1),
     "number_of_replicas": env.int("ES_INDEXES_REPLICAS", default=0),
 }
+# Update the descendant DigitalFiles with a single update by query request,
+# checking the ES background task every given seconds.
+ES_UPDATE_BY_QUERY = env.bool("ES_UPDATE_BY_QUERY", default=False)
+ES_TASK_CHECK_INTERVAL = env.int("ES_TASK_CHECK_INTERVAL", default=10)
+# Delay the updates of the descendant DigitalFiles by the given seconds,
+# dropping the updates of the same ancestor requested meanwhile.
+ES_DESCENDANTS_UPDATE_DELAY = env.int("ES_DESCENDANTS_UPDATE_DELAY", default=0)
+# Compare the indexes with the database every given seconds, fixing the
+# differences found if enabled. Requires Celery beat, disabled by default.
+ES_RECONCILE_INTERVAL = env.int("ES_RECONCILE_INTERVAL", default=0)
+ES_RECONCILE_FIX = env.bool("ES_RECONCILE_FIX", default=False)
+# Record the ES operations in an outbox table with the model changes, to apply
+# them in bulk in the background, draining it also every given seconds.
+ES_OUTBOX = env.bool("ES_OUTBOX", default=False)
+ES_OUTBOX_DRAIN_INTERVAL = env.int("ES_OUTBOX_DRAIN_INTERVAL", default=60)
 
 # Celery
 
@@ -196,6 +224,18 @@ CELERY_BROKER_TRANSPORT_OPTIONS = {
 CELERY_ACCEPT_CONTENT = ["application/json"]
 CELERY_TASK_SERIALIZER = "json"
 CELERY_TIMEZONE = TIME_ZONE
+CELERY_BEAT_SCHEDULE = {}
+if ES_RECONCILE_INTERVAL:
+    CELERY_BEAT_SCHEDULE["reconcile-es"] = {
+        "task": "search.tasks.reconcile_es",
+        "schedule": ES_RECONCILE_INTERVAL,
+        "kwargs": {"fix": ES_RECONCILE_FIX},
+    }
+if ES_OUTBOX:
+    CELERY_BEAT_SCHEDULE["drain-es-outbox"] = {
+        "task": "search.tasks.drain_es_outbox",
+        "schedule": ES_OUTBOX_DRAIN_INTERVAL,
+    }
 
 # REST Framework
 
@@ -211,3 +251,18 @@ REST_FRAMEWORK = {
 SS_HOSTS = env(
     "SS_HOSTS", cast=list, subcast=str, postprocessor=ss_hosts_parser, default=[]
 )
+# Seconds to wait to establish a connection and between bytes received.
+SS_CONNECT_TIMEOUT = env.int("SS_CONNECT_TIMEOUT", default=10)
+SS_READ_TIMEOUT = env.int("SS_READ_TIMEOUT", default=60)
+# Retries for failed connections and server errors, with exponential backoff.
+SS_MAX_RETRIES = env.int("SS_MAX_RETRIES", default=3)
+# Connections kept alive per SS host in each process.
+SS_POOL_SIZE = env.int("SS_POOL_SIZE", default=10)
+# Size in bytes of the chunks streamed in the DIP downloads from the SS.
+SS_DOWNLOAD_CHUNK_SIZE = env.int("SS_DOWNLOAD_CHUNK_SIZE", default=1048576)
+# Nginx internal location to hand off the DIP downloads from the SS.
+SS_DOWNLOAD_ACCEL_PREFIX = env("SS_DOWNLOAD_ACCEL_PREFIX", default="")
+# Size in bytes of the local cache of DIPs downloaded from the SS, disabled
+# with 0, and whether to fill it right after the DIPs are imported.
+SS_DIP_CACHE_SIZE = env.int("SS_DIP_CACHE_SIZE", default=0)
+SS_DIP_CACHE_PREFETCH = env.bool("SS_DIP_CACHE_PREFETCH", default=False)
@@ -0,0 +1,114 @@
+"""Storage Service HTTP client.
+
+A client is created per SS host in each process and reused in the following
+requests, keeping the connections alive in a pool. Failed connections and
+server errors are retried with exponential backoff and all the requests use
+separate connect and read timeouts. The `ss_request_finished` signal is sent
+after each request to collect metrics.
+"""
+
+import logging
+import threading
+from contextlib import contextmanager
+
+import requests
+from django.conf import settings
+from django.dispatch import Signal
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger("scope.storage_service")
+
+# Sent with the `host_url`, `method`, `url`, `status_code`, `elapsed` (seconds
+# until the response headers were parsed) and `retries` arguments.
+ss_request_finished = Signal()
+
+# Status codes retried for idempotent requests
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+class StorageServiceClient:
+    """Pooled and retrying HTTP client for a Storage Service host."""
+
+    def __init__(self, host_url, user, secret):
+        self.host_url = host_url
+        self.timeout = (settings.SS_CONNECT_TIMEOUT, settings.SS_READ_TIMEOUT)
+        self.session = requests.Session()
+        self.session.headers["Authorization"] = "ApiKey %s:%s" % (user, secret)
+        retry = Retry(
+            total=settings.SS_MAX_RETRIES,
+            backoff_factor=0.5,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+            # Return the last response instead of raising when the retries
+            # are exhausted, to handle it with `raise_for_status`.
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=settings.SS_POOL_SIZE, max_retries=retry
+        )
+        self.session.mount(host_url, adapter)
+        self.session.hooks["response"].append(self._send_metrics)
+
+    def get(self, url, **kwargs):
+        """Send a GET request to the SS host using the default timeouts."""
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.get(url, **kwargs)
+
+    @contextmanager
+    def open(self, url):
+        """Stream the body of a GET request to the SS host.
+
+        Yields the body size, from the `Content-Length` header or `None`, and a
+        binary file object with the decoded body, which can only be read within
+        the context. Raises `requests.HTTPError` for error responses.
+        """
+        with self.get(url, stream=True) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            size = response.headers.get("Content-Length")
+            yield int(size) if size else None, response.raw
+
+    def _send_metrics(self, response, **kwargs):
+        retries = getattr(response.raw, "retries", None)
+        retries = len(retries.history) if retries else 0
+        elapsed = response.elapsed.total_seconds()
+        logger.debug(
+            "%s %s: %s in %.3f s (%d retries)"
+            % (
+                response.request.method,
+                response.url,
+                response.status_code,
+                elapsed,
+                retries,
+            )
+        )
+        ss_request_finished.send(
+            sender=self.__class__,
+            host_url=self.host_url,
+            method=response.request.method,
+            url=response.url,
+            status_code=response.status_code,
+            elapsed=elapsed,
+            retries=retries,
+        )
+
+
+def get_client(host_url):
+    """Get the client of a SS host, creating it if needed.
+
+    Raises `RuntimeError` if the host is not configured in the `SS_HOSTS`
+    setting. The clients are cached by host URL and credentials.
+    """
+    if host_url not in settings.SS_HOSTS.keys():
+        raise RuntimeError("Configuration not found for SS host: %s" % host_url)
+    user = settings.SS_HOSTS[host_url]["user"]
+    secret = settings.SS_HOSTS[host_url]["secret"]
+    key = (host_url, user, secret)
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = StorageServiceClient(host_url, user, secret)
+        return _clients[key]
@@ -1,8 +1,5 @@
 import os
-import re
 import shutil
-import tarfile
-import zipfile
 
 import requests
 from celery import shared_task
@@ -10,30 +7,22 @@ from django.conf import settings
 from django.db.utils import DatabaseError
 from elasticsearch.exceptions import TransportError
 
+from . import dip_cache
 from .models import DIP
-from .parsemets import METS
+from .parsemets import METSImport
+from .parsemets import open_mets
+from .storage_service import get_client
 
-METS_RE = re.compile(r".*METS.[0-9a-f\-]{36}.*$")
 
+def _get_mets_url(dip, client):
+    """Get the URL to extract a DIP's METS file from the SS.
 
-@shared_task(autoretry_for=(TransportError,), max_retries=10, default_retry_delay=30)
-def download_mets(dip_id):
-    """Downloads a DIP's METS file from the SS."""
-    # Check the SS host is still configured in the settings
-    dip = DIP.objects.get(pk=dip_id)
-    if dip.ss_host_url not in settings.SS_HOSTS.keys():
-        raise RuntimeError("Configuration not found for SS host: %s" % dip.ss_host_url)
+    Saves the DIP directory name from the package information.
+    """
     # We should have the full DIP download URL, but we'll try to download
     # only the METS file before. Build package info URL:
     info_url = "%s/api/v2/file/%s?format=json" % (dip.ss_host_url, dip.ss_uuid)
-    headers = {
-        "Authorization": "ApiKey %s:%s"
-        % (
-            settings.SS_HOSTS[dip.ss_host_url]["user"],
-            settings.SS_HOSTS[dip.ss_host_url]["secret"],
-        )
-    }
-    response = requests.get(info_url, headers=headers, timeout=10)
+    response = client.get(info_url)
     response.raise_for_status()
     data = response.json()
     # At this point the `related_packages` may be empty in the
@@ -47,15 +36,30 @@ def download_mets(dip_id):
     # Save DIP directory name to form the filename for downloads
     dip.ss_dir_name = dip_dir
     dip.save(update_es=False)
-    # Stream METS file to media folder
-    mets_url = (
-        "%s/api/v2/file/%s/extract_file/?relative_path_to_file=%s/METS.%s.xml"
-        % (dip.ss_host_url, dip.ss_uuid, dip_dir, aip_uuid)
+    return "%s/api/v2/file/%s/extract_file/?relative_path_to_file=%s/METS.%s.xml" % (
+        dip.ss_host_url,
+        dip.ss_uuid,
+        dip_dir,
+        aip_uuid,
     )
+
+
+# `download_mets` and `extract_mets` are no longer used by the imports, which
+# run `import_ss_mets` or `parse_mets` with `from_dip` instead. They are kept
+# registered so the chains queued by previous versions can still be consumed
+# after an upgrade, and can be removed in a later release.
+@shared_task(autoretry_for=(TransportError,), max_retries=10, default_retry_delay=30)
+def download_mets(dip_id):
+    """Downloads a DIP's METS file from the SS."""
+    dip = DIP.objects.get(pk=dip_id)
+    # Raises if the SS host is not configured in the settings anymore
+    client = get_client(dip.ss_host_url)
+    mets_url = _get_mets_url(dip, client)
+    # Stream METS file to media folder
     mets_path = os.path.abspath(
         os.path.join(settings.MEDIA_ROOT, "METS.%s.xml" % dip.ss_uuid)
     )
-    with requests.get(mets_url, headers=headers, stream=True) as response:
+    with client.get(mets_url, stream=True) as response:
         response.raise_for_status()
         with open(mets_path, "wb") as mets_file:
             shutil.copyfileobj(response.raw, mets_file)
@@ -68,53 +72,84 @@ def extract_mets(dip_path):
 
     Raises `ValueError` if the DIP is not a tar or a zip file or `FileNotFoundError`
     if the METS file is not found in the DIP. Returns the absolute path to the
-    extracted METS file on success.
+    extracted METS file on success. `parse_mets` can also read the METS file
+    directly from the DIP, without extracting it, using `from_dip`.
     """
-    metsfile = None
-    if tarfile.is_tarfile(dip_path):
-        with tarfile.open(dip_path) as dip:
-            for member in dip.getmembers():
-                if METS_RE.match(member.name):
-                    member.name = os.path.basename(member.name)
-                    # The extract() method doesn't take care of extraction issues
-                    dip.extractall(settings.MEDIA_ROOT, members=[member])
-                    metsfile = os.path.join(settings.MEDIA_ROOT, member.name)
-    elif zipfile.is_zipfile(dip_path):
-        with zipfile.ZipFile(dip_path) as dip:
-            for info in dip.infolist():
-                if METS_RE.match(info.filename):
-                    info.filename = os.path.basename(info.filename)
-                    metsfile = dip.extract(info, settings.MEDIA_ROOT)
-    else:
-        raise ValueError(
-            "DIP is not a tar or a zip file: %s" % os.path.basename(dip_path)
-        )
-
-    if not metsfile:
-        raise FileNotFoundError("METS file not found in DIP file.")
+    with open_mets(dip_path) as (name, _, mets_file):
+        metsfile = os.path.join(settings.MEDIA_ROOT, os.path.basename(name))
+        with open(metsfile, "wb") as f:
+            shutil.copyfileobj(mets_file, f)
 
     return metsfile
 
 
 @shared_task(
+    bind=True,
     autoretry_for=(TransportError, DatabaseError),
     max_retries=10,
     default_retry_delay=30,
 )
-def parse_mets(mets_path, dip_id):
+def parse_mets(self, mets_path, dip_id, from_dip=False):
     """Parses a METS file updating a DIP and creating the children DigitalFiles.
 
-    Deletes the METS file and marks the import as finished as it's the last task
-    in both imports processes.
+    Marks the import as finished as it's the last task in both imports processes.
+    The import is made in checkpointed stages (check `METSImport`), so a retry
+    resumes from the last completed batch. The METS file is deleted once it's
+    parsed, or on error if the task is not going to be retried, and the import
+    is only marked as finished when all the DigitalFiles have been indexed.
+    With `from_dip`, `mets_path` is a tar or zip DIP and the METS file is read
+    from it without extracting it, keeping the DIP file.
+    """
+    _run_import(self, METSImport(mets_path, dip_id, from_dip=from_dip))
+
+
+@shared_task(
+    bind=True,
+    autoretry_for=(TransportError, DatabaseError),
+    max_retries=10,
+    default_retry_delay=30,
+)
+def import_ss_mets(self, dip_id):
+    """Imports a DIP's METS file from the SS without writing it to disk.
+
+    Combines `download_mets` and `parse_mets` in a single task, parsing the
+    METS file as it's received from the SS. Only the parsed data is written
+    to disk, to resume the import from the last completed batch on retries.
+    """
+    dip = DIP.objects.get(pk=dip_id)
+    # Raises if the SS host is not configured in the settings anymore
+    client = get_client(dip.ss_host_url)
+    mets_url = _get_mets_url(dip, client)
+    _run_import(self, METSImport(mets_url, dip_id, client=client))
+    if settings.SS_DIP_CACHE_SIZE and settings.SS_DIP_CACHE_PREFETCH:
+        cache_ss_dip.delay(dip_id)
+
+
+def _run_import(task, mets_import):
+    """Run a METS import and mark the DIP import as finished.
+
+    The intermediate files are removed on error if the task is not going to
+    be retried.
     """
     try:
-        mets = METS(mets_path, dip_id)
-        dip = mets.parse_mets()
-        dip.import_status = DIP.IMPORT_SUCCESS
-        dip.save()
-    finally:
-        # Remove METS file on error too
-        os.remove(mets_path)
+        dip = mets_import.run()
+    except Exception as e:
+        retry = isinstance(e, task.autoretry_for)
+        if not retry or task.request.retries >= task.max_retries:
+            # Remove METS and intermediate files on error too
+            mets_import.clean()
+        raise
+    dip.import_status = DIP.IMPORT_SUCCESS
+    dip.save()
+
+
+@shared_task(autoretry_for=(requests.RequestException,), max_retries=3)
+def cache_ss_dip(dip_id):
+    """Downloads a DIP from the SS to the local DIP cache.
+
+    Does nothing if the DIP is cached or being cached by another task.
+    """
+    dip_cache.fill(DIP.objects.get(pk=dip_id))
 
 
 @shared_task()
@@ -18,9 +18,9 @@ class DIPStoredWebhookTest(APITestCase):
         admin = User.objects.create_superuser("admin", "admin@example.com", "admin")
         self.admin_token = Token.objects.create(user=admin)
 
-    @patch("scope.api_views.chain")
+    @patch("scope.api_views.import_ss_mets")
     @patch("elasticsearch_dsl.Document.save")
-    def test_dip_stored_webhook_success(self, mock_es_save, mock_chain):
+    def test_dip_stored_webhook_success(self, mock_es_save, mock_import):
         self.client.credentials(HTTP_AUTHORIZATION="Token %s" % self.admin_token.key)
         origin = "http://192.168.1.128:62081"
         headers = {"HTTP_ORIGIN": origin}
@@ -36,7 +36,7 @@ class DIPStoredWebhookTest(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
         self.assertIn(str(self.dip_uuid), response.data["message"])
         self.assertTrue(dip)
-        mock_chain.assert_called()
+        mock_import.s.assert_called_with(dip.pk)
 
     def test_dip_stored_webhook_no_authorization(self):
         response = self.client.post(self.url)
@@ -0,0 +1,148 @@
+import io
+import os
+import tarfile
+import tempfile
+import zipfile
+
+from django.test import SimpleTestCase
+
+from scope.archives import get_access_copy_members
+from scope.archives import get_access_copy_uuid
+from scope.archives import iter_members
+from scope.archives import iter_open_members
+from scope.archives import iter_zip
+from scope.archives import open_member
+
+UUID = "3a78a45c-28be-47d8-a839-fbe208b90a63"
+ACCESS_COPY = "DIP/objects/%s-Landing_zone.jpg" % UUID
+
+
+class ArchivesTests(SimpleTestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = tmp_dir.name
+        self.members = [("DIP/METS.xml", b"<mets/>"), (ACCESS_COPY, b"jpeg " * 100)]
+
+    def _write_tar(self, name, mode):
+        path = os.path.join(self.tmp_dir, name)
+        with tarfile.open(path, mode) as dip:
+            for member_name, data in self.members:
+                info = tarfile.TarInfo(member_name)
+                info.size = len(data)
+                dip.addfile(info, io.BytesIO(data))
+        return path
+
+    def _write_zip(self, name, compression):
+        path = os.path.join(self.tmp_dir, name)
+        with zipfile.ZipFile(path, "w", compression) as dip:
+            dip.writestr("DIP/objects/", b"")
+            for member_name, data in self.members:
+                dip.writestr(member_name, data)
+        return path
+
+    def _read(self, path, offset, size):
+        with open(path, "rb") as dip_file:
+            dip_file.seek(offset)
+            return dip_file.read(size)
+
+    def test_get_access_copy_uuid(self):
+        self.assertEqual(get_access_copy_uuid(ACCESS_COPY), UUID)
+        self.assertEqual(get_access_copy_uuid("objects/%s-file.txt" % UUID), UUID)
+        self.assertIsNone(get_access_copy_uuid("DIP/thumbnails/%s.jpg" % UUID))
+        self.assertIsNone(get_access_copy_uuid("DIP/METS.xml"))
+
+    def test_get_access_copy_members(self):
+        path = self._write_zip("DIP.zip", zipfile.ZIP_DEFLATED)
+        self.assertEqual(
+            get_access_copy_members(path), {UUID: [ACCESS_COPY, None, 500]}
+        )
+
+    def test_iter_members_stored(self):
+        for path in [
+            self._write_tar("DIP.tar", "w"),
+            self._write_zip("DIP.zip", zipfile.ZIP_STORED),
+        ]:
+            members = list(iter_members(path))
+            self.assertEqual(
+                [name for name, _, _ in members], ["DIP/METS.xml", ACCESS_COPY]
+            )
+            for (name, offset, size), (_, data) in zip(members, self.members):
+                self.assertEqual(size, len(data))
+                self.assertEqual(self._read(path, offset, size), data)
+
+    def test_iter_members_compressed(self):
+        path = self._write_zip("DIP.zip", zipfile.ZIP_DEFLATED)
+        self.assertEqual(
+            list(iter_members(path)),
+            [("DIP/METS.xml", None, 7), (ACCESS_COPY, None, 500)],
+        )
+        # Compressed tar files are not decompressed to list their members
+        path = self._write_tar("DIP.tar.gz", "w:gz")
+        self.assertEqual(list(iter_members(path)), [])
+
+    def test_iter_members_wrong_format(self):
+        path = os.path.join(self.tmp_dir, "DIP.7z")
+        with open(path, "wb") as dip_file:
+            dip_file.write(b"Not a tar or a zip file")
+        with self.assertRaises(ValueError):
+            list(iter_members(path))
+
+    def test_open_member(self):
+        for path in [
+            self._write_tar("DIP.tar.gz", "w:gz"),
+            self._write_zip("DIP.zip", zipfile.ZIP_DEFLATED),
+        ]:
+            with open_member(path, lambda name: name.endswith(".jpg")) as member:
+                name, size, member_file = member
+                self.assertEqual(name, ACCESS_COPY)
+                self.assertEqual(size, 500)
+                self.assertEqual(member_file.read(), b"jpeg " * 100)
+            with self.assertRaises(FileNotFoundError) as exc:
+                with open_member(path, lambda name: False, "Access copy"):
+                    pass
+            self.assertEqual(str(exc.exception), "Access copy not found in DIP file.")
+
+    def test_iter_open_members_stream(self):
+        class Stream(io.RawIOBase):
+            """Non-seekable binary stream."""
+
+            def __init__(self, path):
+                self.file = open(path, "rb")
+
+            def readinto(self, buffer):
+                return self.file.readinto(buffer)
+
+            def close(self):
+                self.file.close()
+                super().close()
+
+        with Stream(self._write_tar("DIP.tar.gz", "w:gz")) as stream:
+            members = [
+                (name, size, member_file.read())
+                for name, size, member_file in iter_open_members(stream, bool)
+            ]
+        self.assertEqual(
+            members, [(name, len(data), data) for name, data in self.members]
+        )
+        with Stream(self._write_zip("DIP.zip", zipfile.ZIP_STORED)) as stream:
+            with self.assertRaises(ValueError):
+                list(iter_open_members(stream, bool))
+
+    def test_iter_zip(self):
+        date_time = (2020, 1, 2, 3, 4, 6)
+        members = [
+            (name, len(data), date_time, io.BytesIO(data + b"extra"))
+            for name, data in self.members
+        ]
+        chunks = list(iter_zip(members, chunk_size=64))
+        # The data is yielded as it's read, in chunks besides the headers
+        self.assertGreater(len(chunks), 8)
+        self.assertLessEqual(max(len(chunk) for chunk in chunks), 128)
+        with zipfile.ZipFile(io.BytesIO(b"".join(chunks))) as zip_file:
+            self.assertIsNone(zip_file.testzip())
+            for name, data in self.members:
+                info = zip_file.getinfo(name)
+                self.assertEqual(info.date_time, date_time)
+                self.assertEqual(info.compress_type, zipfile.ZIP_STORED)
+                self.assertEqual(zip_file.read(name), data)
@@ -0,0 +1,42 @@
+from unittest.mock import patch
+
+from django.core.management import call_command
+from django.test import TestCase
+
+from scope.models import DIP
+from scope.models import DigitalFile
+
+
+class BenchmarkMetsTests(TestCase):
+    @patch("scope.management.commands.benchmark_mets.print")
+    def test_benchmark(self, mock_print):
+        call_command("benchmark_mets", sizes=[1, 3])
+        call_command("benchmark_mets", sizes=[1, 3], streaming=True, events=2)
+        self.assertEqual(mock_print.call_count, 4)
+        for call, count in zip(mock_print.call_args_list, [1, 3, 1, 3]):
+            output = call[0][0]
+            self.assertTrue(output.startswith("synthetic, %d files: " % count))
+            self.assertIn("[init ", output)
+            self.assertNotIn(", index ", output)
+            self.assertIn("peak RSS ", output)
+        # The imports are rolled back
+        self.assertFalse(DIP.objects.exists())
+        self.assertFalse(DigitalFile.objects.exists())
+
+    @patch("scope.management.commands.benchmark_mets.print")
+    def test_benchmark_existing_mets(self, mock_print):
+        call_command(
+            "benchmark_mets", mets=["scope/tests/fixtures/mets/full.xml"], repeat=2
+        )
+        mock_print.assert_called_once()
+        self.assertTrue(mock_print.call_args[0][0].startswith("full.xml, 2 files: "))
+
+    @patch("scope.management.commands.benchmark_mets.delete_es_descendants")
+    @patch("scope.models.bulk_index_documents", return_value=3)
+    @patch("scope.management.commands.benchmark_mets.print")
+    def test_benchmark_index(self, mock_print, mock_bulk_index, mock_es_delete):
+        call_command("benchmark_mets", sizes=[3], index=True)
+        mock_bulk_index.assert_called_once()
+        mock_es_delete.assert_called_once()
+        self.assertEqual(mock_es_delete.call_args[0][0], "DIP")
+        self.assertIn(", index ", mock_print.call_args[0][0])
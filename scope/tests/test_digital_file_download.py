@@ -0,0 +1,233 @@
+import io
+import os
+import tarfile
+import tempfile
+import zipfile
+from contextlib import contextmanager
+from unittest.mock import Mock
+from unittest.mock import patch
+
+from django.test import TestCase
+from django.test import override_settings
+from django.urls import reverse
+
+from scope.archives import iter_members
+from scope.models import DIP
+from scope.models import DigitalFile
+from scope.models import DublinCore
+from scope.models import User
+from scope.views import _get_zip_member
+
+UUID = "3a78a45c-28be-47d8-a839-fbe208b90a63"
+ACCESS_COPY = "DIP/objects/%s-Landing_zone.jpg" % UUID
+DATA = b"0123456789"
+SS_UUID = "7e74a044-02e5-432b-8ba7-7fd60b9f68b8"
+SS_DATA = b"SS access copy"
+
+
+class DigitalFileDownloadTests(TestCase):
+    @patch("elasticsearch_dsl.Document.save")
+    def setUp(self, mock_es_save):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.media_root = tmp_dir.name
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        User.objects.create_superuser("admin", "admin@example.com", "admin")
+        self.client.login(username="admin", password="admin")
+        self.dip = DIP.objects.create(
+            dc=DublinCore.objects.create(identifier="A"), objectszip="DIP.zip"
+        )
+        self.digital_file = DigitalFile.objects.create(
+            uuid=UUID, dip=self.dip, size_bytes=len(DATA)
+        )
+        self.url = reverse("download_digital_file", kwargs={"pk": UUID})
+
+    def _write_dip(self, compression=zipfile.ZIP_STORED):
+        path = os.path.join(self.media_root, "DIP.zip")
+        with zipfile.ZipFile(path, "w", compression) as dip:
+            dip.writestr("DIP/METS.xml", b"<mets/>")
+            dip.writestr(ACCESS_COPY, DATA)
+        return path
+
+    def _save_member(self, path):
+        for name, offset, size in iter_members(path):
+            if name == ACCESS_COPY:
+                self.digital_file.dip_member = name
+                self.digital_file.dip_member_offset = offset
+                self.digital_file.dip_member_size = size
+        self.digital_file.save(update_es=False)
+
+    def test_download_no_objectszip(self):
+        DIP.objects.filter(pk=self.dip.pk).update(objectszip="")
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 404)
+
+    def test_download_dip_file_not_found(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 404)
+
+    def test_download_member_not_found(self):
+        path = os.path.join(self.media_root, "DIP.zip")
+        with zipfile.ZipFile(path, "w") as dip:
+            dip.writestr("DIP/METS.xml", b"<mets/>")
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 404)
+
+    def test_download_stored_member(self):
+        self._save_member(self._write_dip())
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Length"], str(len(DATA)))
+        self.assertEqual(response["Content-Type"], "image/jpeg")
+        self.assertEqual(response["Accept-Ranges"], "bytes")
+        self.assertEqual(
+            response["Content-Disposition"],
+            'attachment; filename="%s-Landing_zone.jpg"' % UUID,
+        )
+        self.assertEqual(b"".join(response.streaming_content), DATA)
+
+    def test_download_stored_member_range(self):
+        self._save_member(self._write_dip())
+        response = self.client.get(self.url, HTTP_RANGE="bytes=2-5")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response["Content-Length"], "4")
+        self.assertEqual(response["Content-Range"], "bytes 2-5/10")
+        self.assertEqual(b"".join(response.streaming_content), b"2345")
+        response = self.client.get(self.url, HTTP_RANGE="bytes=-3")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b"".join(response.streaming_content), b"789")
+
+    def test_download_stored_member_range_not_satisfiable(self):
+        self._save_member(self._write_dip())
+        for header in ["bytes=10-", "bytes=-0"]:
+            response = self.client.get(self.url, HTTP_RANGE=header)
+            self.assertEqual(response.status_code, 416)
+            self.assertEqual(response["Content-Range"], "bytes */10")
+
+    def test_download_compressed_member(self):
+        self._save_member(self._write_dip(zipfile.ZIP_DEFLATED))
+        self.assertIsNone(self.digital_file.dip_member_offset)
+        # Range requests are not supported and the whole file is sent
+        response = self.client.get(self.url, HTTP_RANGE="bytes=2-5")
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("Accept-Ranges", response)
+        self.assertEqual(b"".join(response.streaming_content), DATA)
+
+    @patch("elasticsearch_dsl.Document.save")
+    def test_download_member_by_uuid(self, mock_es_save):
+        # DIPs imported before the members were saved
+        self.dip.objectszip = "DIP.tar.gz"
+        self.dip.save(update_es=False)
+        path = os.path.join(self.media_root, "DIP.tar.gz")
+        with tarfile.open(path, "w:gz") as dip:
+            info = tarfile.TarInfo(ACCESS_COPY)
+            info.size = len(DATA)
+            dip.addfile(info, io.BytesIO(DATA))
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Length"], str(len(DATA)))
+        self.assertEqual(b"".join(response.streaming_content), DATA)
+
+    @patch("elasticsearch_dsl.Document.save")
+    def _create_ss_dip(self, mock_es_save):
+        ss_dip = DIP.objects.create(
+            dc=DublinCore.objects.create(identifier="B/1"),
+            ss_uuid="041576bb-befb-4206-a4fb-f62b547c71ef",
+            ss_host_url="http://ss.example.com",
+            ss_download_url="http://ss.example.com/api/v2/file/1/download/",
+        )
+        DigitalFile.objects.create(
+            uuid=SS_UUID,
+            dip=ss_dip,
+            filepath="objects/folder/document.doc",
+            size_bytes=len(SS_DATA),
+        )
+        # Only the access copies are read from the download
+        path = os.path.join(self.media_root, "SS.tar")
+        with tarfile.open(path, "w") as dip:
+            for name, data in [
+                ("SS/objects/%s-document.pdf" % SS_UUID, SS_DATA),
+                ("SS/thumbnails/%s.jpg" % SS_UUID, b"thumbnail"),
+            ]:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                dip.addfile(info, io.BytesIO(data))
+
+        @contextmanager
+        def open_download(url):
+            with open(path, "rb") as stream:
+                yield os.path.getsize(path), stream
+
+        return open_download
+
+    def _get_zip(self, response):
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "application/zip")
+        self.assertRegex(
+            response["Content-Disposition"], r'^attachment; filename="scope-\d+\.zip"$'
+        )
+        data = b"".join(response.streaming_content)
+        zip_file = zipfile.ZipFile(io.BytesIO(data))
+        return {info.filename: zip_file.read(info) for info in zip_file.infolist()}
+
+    @patch("scope.views.get_client")
+    def test_download_files_by_uuid(self, mock_get_client):
+        self._save_member(self._write_dip())
+        DigitalFile.objects.filter(uuid=UUID).update(filepath="objects/image.tif")
+        mock_get_client.return_value.open = self._create_ss_dip()
+        url = reverse("download_digital_files")
+        response = self.client.get(url, {"uuid": [UUID, SS_UUID, "missing"]})
+        self.assertEqual(
+            self._get_zip(response),
+            {
+                "A/objects/Landing_zone.jpg": DATA,
+                "B_1/objects/folder/document.pdf": SS_DATA,
+            },
+        )
+        mock_get_client.assert_called_with("http://ss.example.com")
+
+    @patch("scope.views.get_client")
+    def test_download_files_dip_not_found(self, mock_get_client):
+        # The uploaded DIP file doesn't exist
+        mock_get_client.return_value.open = self._create_ss_dip()
+        url = reverse("download_digital_files")
+        response = self.client.get(url, {"uuid": [UUID, SS_UUID]})
+        with self.assertLogs("scope.views", "WARNING"):
+            files = self._get_zip(response)
+        self.assertEqual(files, {"B_1/objects/folder/document.pdf": SS_DATA})
+
+    @override_settings(DOWNLOAD_ZIP_MAX_FILES=5)
+    @patch("elasticsearch_dsl.Search.execute", autospec=True)
+    def test_download_files_by_search(self, mock_es_execute):
+        self._save_member(self._write_dip(zipfile.ZIP_DEFLATED))
+        mock_es_execute.return_value = [Mock(meta=Mock(id=UUID))]
+        url = reverse("download_digital_files")
+        response = self.client.get(url, {"query": "Landing"})
+        self.assertEqual(self._get_zip(response), {"A/Landing_zone.jpg": DATA})
+        search = mock_es_execute.call_args[0][0].to_dict()
+        self.assertEqual(search["size"], 5)
+        self.assertFalse(search["_source"])
+        self.assertIn("Landing", str(search["query"]))
+
+    def test_zip_member_paths(self):
+        paths = set()
+        self.digital_file.filepath = "objects/image.tif"
+        for expected in ["A/objects/Landing_zone.jpg", "A/objects/Landing_zone_2.jpg"]:
+            path = _get_zip_member(self.digital_file, ACCESS_COPY, 1, None, paths)[0]
+            self.assertEqual(path, expected)
+        # The DIP UUID or id is used without DublinCore
+        self.dip.dc = None
+        path = _get_zip_member(self.digital_file, ACCESS_COPY, 1, None, paths)[0]
+        self.assertEqual(path, "%s/objects/Landing_zone.jpg" % self.dip.pk)
+        self.dip.ss_uuid = SS_UUID
+        path = _get_zip_member(self.digital_file, ACCESS_COPY, 1, None, paths)[0]
+        self.assertEqual(path, "%s/objects/Landing_zone.jpg" % SS_UUID)
+
+    def test_download_files_not_visible(self):
+        DIP.objects.filter(pk=self.dip.pk).update(import_status=DIP.IMPORT_PENDING)
+        self._write_dip()
+        url = reverse("download_digital_files")
+        response = self.client.get(url, {"uuid": UUID})
+        self.assertEqual(response.status_code, 404)
@@ -0,0 +1,152 @@
+import fcntl
+import io
+import os
+import tempfile
+from contextlib import contextmanager
+from unittest.mock import patch
+
+from django.test import TestCase
+from django.test import override_settings
+
+from scope import dip_cache
+from scope.models import DIP
+from scope.models import DublinCore
+
+
+class DipCacheTests(TestCase):
+    @patch("elasticsearch_dsl.Document.save")
+    def setUp(self, mock_es_save):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.cache_dir = os.path.join(tmp_dir.name, "ss_dips")
+        settings_override = override_settings(
+            MEDIA_ROOT=tmp_dir.name, SS_DIP_CACHE_SIZE=10
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.dips = [
+            DIP.objects.create(
+                ss_uuid=ss_uuid,
+                ss_host_url="http://ss.example.com",
+                ss_download_url="http://ss.example.com/api/v2/file/%s/download/"
+                % ss_uuid,
+                dc=DublinCore.objects.create(identifier=ss_uuid),
+            )
+            for ss_uuid in [
+                "041576bb-befb-4206-a4fb-f62b547c71ef",
+                "ab028cb0-9942-4f26-a966-7197d7a2e15a",
+            ]
+        ]
+        patcher = patch("scope.dip_cache.get_client")
+        self.mock_client = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+        self.downloads = []
+
+        @contextmanager
+        def open_download(url, size=4):
+            self.downloads.append(url)
+            yield size, io.BytesIO(b"data")
+
+        self.mock_client.open = open_download
+
+    def test_fill_and_get_cached_name(self):
+        dip = self.dips[0]
+        self.assertIsNone(dip_cache.get_cached_name(dip))
+        self.assertTrue(dip_cache.fill(dip))
+        self.assertTrue(dip_cache.fill(dip))
+        # Only the first fill downloads the DIP
+        self.assertEqual(self.downloads, [dip.ss_download_url])
+        name = dip_cache.get_cached_name(dip)
+        self.assertEqual(name, "ss_dips/%s.tar" % dip.ss_uuid)
+        with open(os.path.join(self.cache_dir, "%s.tar" % dip.ss_uuid), "rb") as f:
+            self.assertEqual(f.read(), b"data")
+        with override_settings(SS_DIP_CACHE_SIZE=0):
+            self.assertIsNone(dip_cache.get_cached_name(dip))
+
+    def test_fill_in_progress(self):
+        dip = self.dips[0]
+        os.makedirs(self.cache_dir)
+        lock_path = os.path.join(self.cache_dir, "%s.tar.lock" % dip.ss_uuid)
+        with open(lock_path, "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self.assertFalse(dip_cache.fill(dip))
+        self.assertEqual(self.downloads, [])
+        self.assertIsNone(dip_cache.get_cached_name(dip))
+
+    def test_fill_too_big(self):
+        with override_settings(SS_DIP_CACHE_SIZE=3):
+            self.assertFalse(dip_cache.fill(self.dips[0]))
+        # The lock file is removed
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    @override_settings(SS_DIP_CACHE_SIZE=6)
+    def test_fill_too_big_without_size(self):
+        self.assertTrue(dip_cache.fill(self.dips[0]))
+
+        @contextmanager
+        def open_download(url):
+            yield None, io.BytesIO(b"more data")
+
+        self.mock_client.open = open_download
+        self.assertFalse(dip_cache.fill(self.dips[1]))
+        # The download is discarded without evicting the cached DIPs
+        self.assertEqual(os.listdir(self.cache_dir), ["%s.tar" % self.dips[0].ss_uuid])
+
+    def test_fill_incomplete_download(self):
+        @contextmanager
+        def open_download(url):
+            yield 8, io.BytesIO(b"data")
+
+        self.mock_client.open = open_download
+        with self.assertRaises(IOError):
+            dip_cache.fill(self.dips[0])
+        self.assertIsNone(dip_cache.get_cached_name(self.dips[0]))
+        self.assertFalse(
+            any(name.endswith(".part") for name in os.listdir(self.cache_dir))
+        )
+
+    def test_least_recently_used_eviction(self):
+        with override_settings(SS_DIP_CACHE_SIZE=8):
+            self.assertTrue(dip_cache.fill(self.dips[0]))
+            self.assertTrue(dip_cache.fill(self.dips[1]))
+            for dip, mtime in zip(self.dips, [0, 1]):
+                path = os.path.join(self.cache_dir, "%s.tar" % dip.ss_uuid)
+                os.utime(path, (mtime, mtime))
+            # Using the first DIP makes the second one the least recently used
+            self.assertIsNotNone(dip_cache.get_cached_name(self.dips[0]))
+            with override_settings(SS_DIP_CACHE_SIZE=4):
+                dip_cache.evict()
+            self.assertIsNotNone(dip_cache.get_cached_name(self.dips[0]))
+            self.assertIsNone(dip_cache.get_cached_name(self.dips[1]))
+
+    @override_settings(SS_DIP_CACHE_SIZE=6)
+    def test_eviction_keeps_new_dip(self):
+        self.assertTrue(dip_cache.fill(self.dips[0]))
+        path = os.path.join(self.cache_dir, "%s.tar" % self.dips[0].ss_uuid)
+        # Even if the existing DIP was used later
+        os.utime(path, (2**32, 2**32))
+        self.assertTrue(dip_cache.fill(self.dips[1]))
+        self.assertIsNone(dip_cache.get_cached_name(self.dips[0]))
+        self.assertIsNotNone(dip_cache.get_cached_name(self.dips[1]))
+
+    def test_eviction_removes_unused_lock_files(self):
+        os.makedirs(self.cache_dir)
+        lock_paths = [
+            os.path.join(self.cache_dir, "%s.tar.lock" % dip.ss_uuid)
+            for dip in self.dips
+        ]
+        for lock_path in lock_paths:
+            open(lock_path, "w").close()
+        # The lock file of a download in progress is kept
+        with open(lock_paths[1], "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            dip_cache.evict()
+        self.assertEqual(os.listdir(self.cache_dir), [os.path.basename(lock_paths[1])])
+
+    @patch("scope.models.celery_app.send_task")
+    @patch("scope.models.delete_document")
+    def test_dip_delete_removes_cached_dip(self, mock_es_delete, mock_send_task):
+        dip = self.dips[0]
+        self.assertTrue(dip_cache.fill(dip))
+        dip.delete()
+        self.assertEqual(os.listdir(self.cache_dir), [])
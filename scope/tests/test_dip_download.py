@@ -1,5 +1,6 @@
 import os
 from contextlib import contextmanager
+from unittest.mock import Mock
 from unittest.mock import patch
 
 import vcr
@@ -145,3 +146,98 @@ class DipDownloadTests(TestCase):
             response["Content-Disposition"],
             'attachment; filename="%s.tar"' % self.ss_dip.ss_dir_name,
         )
+
+    @override_settings(SS_DOWNLOAD_CHUNK_SIZE=4)
+    @patch("scope.views.get_client")
+    def test_ss_dip_download_range(self, mock_get_client):
+        stream = Mock(
+            status_code=206,
+            headers={
+                "Content-Type": "application/x-tar",
+                "Content-Length": "4",
+                "Content-Range": "bytes 4-7/8",
+                "Accept-Ranges": "bytes",
+            },
+        )
+        stream.iter_content.return_value = iter([b"data"])
+        mock_get_client.return_value.get.return_value = stream
+        url = reverse("download_dip", kwargs={"pk": self.ss_dip.pk})
+        response = self.client.get(url, HTTP_RANGE="bytes=4-")
+        mock_get_client.return_value.get.assert_called_with(
+            self.ss_dip.ss_download_url, headers={"Range": "bytes=4-"}, stream=True
+        )
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response["Content-Range"], "bytes 4-7/8")
+        self.assertEqual(response["Accept-Ranges"], "bytes")
+        self.assertEqual(response["X-Accel-Buffering"], "no")
+        self.assertEqual(b"".join(response.streaming_content), b"data")
+        stream.iter_content.assert_called_with(4)
+        # The SS connection is released after the download
+        stream.close.assert_called_once()
+
+    @patch("scope.views.get_client")
+    def test_ss_dip_download_range_not_satisfiable(self, mock_get_client):
+        stream = Mock(status_code=416, headers={"Content-Range": "bytes */8"})
+        mock_get_client.return_value.get.return_value = stream
+        url = reverse("download_dip", kwargs={"pk": self.ss_dip.pk})
+        response = self.client.get(url, HTTP_RANGE="bytes=10-")
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response["Content-Range"], "bytes */8")
+        stream.close.assert_called_once()
+
+    @override_settings(
+        SS_HOSTS={"http://192.168.1.128:62081": {"user": "test", "secret": "test"}},
+        SS_DOWNLOAD_ACCEL_PREFIX="/ss-download/",
+    )
+    def test_ss_dip_download_accel_redirect(self):
+        url = reverse("download_dip", kwargs={"pk": self.ss_dip.pk})
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response["X-Accel-Redirect"],
+            "/ss-download/http/192.168.1.128:62081/api/v2/file/%s/download/"
+            % self.ss_dip.ss_uuid,
+        )
+        # The credentials are added by Nginx
+        self.assertNotIn("ApiKey", str(response.serialize_headers()))
+        self.assertEqual(
+            response["Content-Disposition"],
+            'attachment; filename="%s.tar"' % self.ss_dip.ss_dir_name,
+        )
+
+    @override_settings(SS_DIP_CACHE_SIZE=1024)
+    @patch("scope.views.cache_ss_dip.delay")
+    @patch("scope.views.dip_cache.get_cached_name")
+    @patch("scope.views.get_client")
+    def test_ss_dip_download_cached(
+        self, mock_get_client, mock_get_cached_name, mock_cache_ss_dip
+    ):
+        mock_get_cached_name.return_value = "ss_dips/%s.tar" % self.ss_dip.ss_uuid
+        url = reverse("download_dip", kwargs={"pk": self.ss_dip.pk})
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response["X-Accel-Redirect"], "/media/ss_dips/%s.tar" % self.ss_dip.ss_uuid
+        )
+        self.assertEqual(
+            response["Content-Disposition"],
+            'attachment; filename="%s.tar"' % self.ss_dip.ss_dir_name,
+        )
+        mock_cache_ss_dip.assert_not_called()
+        mock_get_client.assert_not_called()
+
+    @override_settings(SS_DIP_CACHE_SIZE=1024)
+    @patch("scope.views.cache_ss_dip.delay")
+    @patch("scope.views.dip_cache.get_cached_name", return_value=None)
+    @patch("scope.views.get_client")
+    def test_ss_dip_download_not_cached(
+        self, mock_get_client, mock_get_cached_name, mock_cache_ss_dip
+    ):
+        stream = Mock(status_code=200, headers={"Content-Length": "4"})
+        stream.iter_content.return_value = [b"data"]
+        mock_get_client.return_value.get.return_value = stream
+        url = reverse("download_dip", kwargs={"pk": self.ss_dip.pk})
+        response = self.client.get(url)
+        # Proxied from the SS while the cache is filled in the background
+        self.assertEqual(b"".join(response.streaming_content), b"data")
+        mock_cache_ss_dip.assert_called_with(self.ss_dip.pk)
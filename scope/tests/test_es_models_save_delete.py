@@ -1,11 +1,13 @@
 from unittest.mock import patch
 
 from django.test import TestCase
+from django.test import override_settings
 
 from scope.models import DIP
 from scope.models import Collection
 from scope.models import DigitalFile
 from scope.models import DublinCore
+from scope.models import EsOutbox
 from search.documents import CollectionDoc
 from search.documents import DigitalFileDoc
 from search.documents import DIPDoc
@@ -27,35 +29,53 @@ class EsModelsSaveDeleteTests(TestCase):
     @patch("scope.models.celery_app.send_task")
     @patch.object(CollectionDoc, "save")
     def test_collection_save(self, mock_es_save, mock_send_task):
+        self.collection.dc.title = "Title"
         self.collection.save(update_es=False)
         mock_es_save.assert_not_called()
         mock_send_task.assert_not_called()
         self.collection.save()
-        mock_es_save.assert_called()
-        mock_send_task.assert_called_with(
+        mock_es_save.assert_called_once()
+        mock_send_task.assert_called_once_with(
             "search.tasks.update_es_descendants", args=("Collection", 1)
         )
+        # Nothing is updated without changes in the ES data
+        self.collection.link = "http://example.com"
+        self.collection.save()
+        mock_es_save.assert_called_once()
+        mock_send_task.assert_called_once()
+        # The descendants are not updated if their data doesn't change
+        self.collection.dc.description = "Description"
+        self.collection.save()
+        self.assertEqual(mock_es_save.call_count, 2)
+        mock_send_task.assert_called_once()
 
     @patch("scope.models.celery_app.send_task")
     @patch.object(DIPDoc, "save")
     def test_dip_save(self, mock_es_save, mock_send_task):
+        self.dip.import_status = DIP.IMPORT_SUCCESS
         self.dip.save(update_es=False)
         mock_es_save.assert_not_called()
         mock_send_task.assert_not_called()
         self.dip.save()
-        mock_es_save.assert_called()
-        mock_send_task.assert_called_with(
+        mock_es_save.assert_called_once()
+        mock_send_task.assert_called_once_with(
             "search.tasks.update_es_descendants", args=("DIP", 1)
         )
+        self.dip.save()
+        mock_es_save.assert_called_once()
+        mock_send_task.assert_called_once()
 
     @patch("scope.models.celery_app.send_task")
     @patch.object(DigitalFileDoc, "save")
     def test_digital_file_save(self, mock_es_save, mock_send_task):
+        self.digital_file.filepath = "path"
         self.digital_file.save(update_es=False)
         mock_es_save.assert_not_called()
         mock_send_task.assert_not_called()
         self.digital_file.save()
-        mock_es_save.assert_called()
+        mock_es_save.assert_called_once()
+        self.digital_file.save()
+        mock_es_save.assert_called_once()
         mock_send_task.assert_not_called()
 
     @patch("scope.models.celery_app.send_task")
@@ -87,3 +107,97 @@ class EsModelsSaveDeleteTests(TestCase):
         mock_send_task.assert_called_with(
             "search.tasks.delete_es_descendants", args=("Collection", 1)
         )
+
+    @patch("scope.models.bulk_index_documents")
+    @patch("elasticsearch_dsl.Document.save")
+    def test_dip_index_digital_files(self, mock_es_save, mock_bulk_index):
+        documents = []
+
+        def bulk_index(index, new_documents):
+            documents.extend(new_documents)
+            return len(documents)
+
+        mock_bulk_index.side_effect = bulk_index
+        DigitalFile.objects.create(uuid="fake-uuid-2", dip=self.dip, size_bytes=1)
+        DigitalFile.objects.update(es_fingerprint="")
+        # Only the DigitalFiles are queried, the DIP and ancestors are reused,
+        # and their fingerprints are stored after indexing.
+        with self.assertNumQueries(3):
+            self.assertEqual(self.dip.index_digital_files(), 2)
+        index = mock_bulk_index.call_args[0][0]
+        self.assertEqual(index, DigitalFileDoc._index._name)
+        self.assertEqual(
+            sorted(document["_id"] for document in documents),
+            ["fake-uuid", "fake-uuid-2"],
+        )
+        for document in documents:
+            self.assertEqual(document["dip"]["id"], self.dip.pk)
+            self.assertEqual(document["collection"]["id"], self.collection.pk)
+        self.assertFalse(DigitalFile.objects.filter(es_fingerprint="").exists())
+        # The unchanged DigitalFiles are skipped
+        documents.clear()
+        self.assertEqual(self.dip.index_digital_files(), 0)
+
+    @patch("scope.models.bulk_index_documents", return_value=2)
+    @patch("elasticsearch_dsl.Document.save")
+    def test_dip_index_digital_files_changes(self, mock_es_save, mock_bulk_index):
+        DigitalFile.objects.create(uuid="fake-uuid-2", dip=self.dip, size_bytes=1)
+        DigitalFile.objects.update(es_fingerprint="")
+        self.dip.index_digital_files(["fake-uuid-2"], ["fake-uuid-3"])
+        documents = list(mock_bulk_index.call_args[0][1])
+        self.assertEqual(len(documents), 2)
+        self.assertEqual(documents[0]["_id"], "fake-uuid-2")
+        self.assertEqual(documents[1], {"_op_type": "delete", "_id": "fake-uuid-3"})
+        # Written without refreshing the index
+        with patch("scope.models.write_documents", return_value=1) as mock_write:
+            DigitalFile.objects.update(es_fingerprint="")
+            self.dip.index_digital_files(["fake-uuid-2"], refresh=False)
+        mock_bulk_index.assert_called_once()
+        self.assertEqual(len(list(mock_write.call_args[0][1])), 1)
+
+    @override_settings(ES_OUTBOX=True)
+    @patch("scope.models.transaction.on_commit")
+    @patch("scope.models.delete_document")
+    @patch.object(CollectionDoc, "save")
+    def test_outbox(self, mock_es_save, mock_es_delete, mock_on_commit):
+        self.collection.dc.title = "Title"
+        self.collection.save()
+        self.dip.delete()
+        # The operations are recorded instead of sent to ES
+        mock_es_save.assert_not_called()
+        mock_es_delete.assert_not_called()
+        self.assertEqual(
+            list(
+                EsOutbox.objects.order_by("pk").values_list(
+                    "model_name", "object_id", "operation"
+                )
+            ),
+            [
+                ("Collection", "1", EsOutbox.SYNC),
+                ("Collection", "1", EsOutbox.UPDATE_DESCENDANTS),
+                ("DIP", "1", EsOutbox.SYNC),
+                ("DIP", "1", EsOutbox.DELETE_DESCENDANTS),
+            ],
+        )
+        self.assertEqual(mock_on_commit.call_count, 4)
+
+    @patch("scope.models.write_documents")
+    def test_wait_for_es(self, mock_write_documents):
+        DIP.wait_for_es(self.dip.pk)
+        mock_write_documents.assert_not_called()
+        with override_settings(ES_OUTBOX=True):
+            DIP.wait_for_es(self.dip.pk)
+        self.assertEqual(mock_write_documents.call_args[0][0], DIP.es_doc._index._name)
+        self.assertEqual(
+            list(mock_write_documents.call_args[0][1]), [self.dip.get_es_data()]
+        )
+        self.assertEqual(mock_write_documents.call_args[1], {"refresh": "wait_for"})
+
+    def test_iter_es_sync_data(self):
+        self.assertEqual(
+            list(DigitalFile.iter_es_sync_data(["fake-uuid", "deleted-uuid"])),
+            [
+                self.digital_file.get_es_data(),
+                {"_op_type": "delete", "_id": "deleted-uuid"},
+            ],
+        )
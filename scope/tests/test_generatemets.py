@@ -0,0 +1,60 @@
+import os
+import tempfile
+from unittest.mock import patch
+
+from django.core.management import call_command
+from django.test import TestCase
+
+from scope.generatemets import event_uuid
+from scope.generatemets import file_uuid
+from scope.generatemets import write_mets
+from scope.models import DIP
+from scope.models import DigitalFile
+from scope.models import DublinCore
+from scope.models import PREMISEvent
+from scope.parsemets import METS
+
+
+class GenerateMetsTests(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "METS.xml")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    @patch("elasticsearch_dsl.Document.save")
+    def test_write_mets(self, mock_es_save):
+        write_mets(self.path, 3, events=9, dmdsecs=2)
+        dip = DIP.objects.create(dc=DublinCore.objects.create(identifier="A"))
+        for streaming in [False, True]:
+            dip = METS(self.path, dip.pk, streaming=streaming).parse_mets()
+            self.assertEqual(DigitalFile.objects.count(), 3)
+            self.assertEqual(PREMISEvent.objects.count(), 27)
+            # The last dmdSec is used
+            self.assertEqual(dip.dc.identifier, "synthetic-2")
+            self.assertEqual(dip.dc.title, "Synthetic DIP (2)")
+        digitalfile = DigitalFile.objects.get(uuid=file_uuid(2))
+        self.assertEqual(digitalfile.filepath, "objects/file_2.jpg")
+        self.assertEqual(digitalfile.size_bytes, 1026)
+        self.assertEqual(digitalfile.puid, "fmt/43")
+        self.assertIsNotNone(digitalfile.datemodified)
+        event = PREMISEvent.objects.get(uuid=event_uuid(2, 8))
+        self.assertEqual(event.digitalfile, digitalfile)
+        self.assertEqual(event.eventtype, "message digest calculation")
+
+    def test_write_mets_without_dmdsecs(self):
+        write_mets(self.path, 1, events=0, dmdsecs=0)
+        mets = METS(self.path, None)
+        self.assertEqual(len(list(mets._iter_file_metadata())), 1)
+        self.assertIsNone(mets._parse_dc())
+
+    @patch("scope.management.commands.generate_mets.print")
+    def test_command(self, mock_print):
+        call_command("generate_mets", self.path, files=2, events=1, dmdsecs=1)
+        self.assertTrue(os.path.isfile(self.path))
+        self.assertTrue(
+            mock_print.call_args[0][0].startswith(
+                "%s: 2 files, 1 events per file, 1 dmdSecs" % self.path
+            )
+        )
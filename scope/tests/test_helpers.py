@@ -1,9 +1,12 @@
+import hashlib
 from unittest.mock import patch
 
 from django.test import TestCase
 
 from scope import helpers
+from scope.models import DIP
 from scope.models import DigitalFile
+from scope.models import DublinCore
 
 
 class HelpersTests(TestCase):
@@ -94,6 +97,35 @@ class HelpersTests(TestCase):
         self.assertEqual(digitalfile.formatversion, "fake_version")
         self.assertEqual(digitalfile.size_bytes, "fake_size")
 
+    def test_iter_batches(self):
+        self.assertEqual(list(helpers.iter_batches([], 2)), [])
+        self.assertEqual(list(helpers.iter_batches(range(5), 2)), [[0, 1], [2, 3], [4]])
+        self.assertEqual(list(helpers.iter_batches(iter("ab"), 2)), [["a", "b"]])
+
+    @patch("elasticsearch_dsl.Document.save")
+    def test_get_in_bulk(self, mock_es_save):
+        dip = DIP.objects.create(dc=DublinCore.objects.create(identifier="A"))
+        for uuid in ["a", "b", "c"]:
+            DigitalFile.objects.create(uuid=uuid, dip=dip, size_bytes=1)
+        with self.assertNumQueries(2):
+            instances = helpers.get_in_bulk(DigitalFile, ["a", "c", "d"], 2)
+        self.assertEqual(sorted(instances.keys()), ["a", "c"])
+        self.assertEqual(instances["a"].pk, "a")
+
+    def test_get_sha256(self):
+        path = "scope/tests/fixtures/mets/full.xml"
+        with open(path, "rb") as f:
+            expected = hashlib.sha256(f.read()).hexdigest()
+        self.assertEqual(helpers.get_sha256(path), expected)
+        self.assertEqual(helpers.get_sha256(path, chunk_size=100), expected)
+        with open(path, "rb") as f:
+            self.assertEqual(helpers.get_sha256(f), expected)
+        with open(path, "rb") as f:
+            reader = helpers.SHA256Reader(f)
+            self.assertEqual(len(reader.read(100)), 100)
+            # The rest of the file is read to get the digest
+            self.assertEqual(reader.hexdigest(), expected)
+
     def test_get_sort_params_default_values(self):
         sort_option, sort_dir = helpers.get_sort_params(
             {}, self.SORT_OPTIONS, self.SORT_DEFAULT
@@ -117,6 +149,26 @@ class HelpersTests(TestCase):
         self.assertEqual(sort_option, "format")
         self.assertEqual(sort_dir, "desc")
 
+    def test_parse_range_header(self):
+        self.assertIsNone(helpers.parse_range_header(None, 10))
+        self.assertEqual(helpers.parse_range_header("bytes=2-5", 10), (2, 5))
+        self.assertEqual(helpers.parse_range_header("bytes=2-", 10), (2, 9))
+        self.assertEqual(helpers.parse_range_header("bytes=2-20", 10), (2, 9))
+        self.assertEqual(helpers.parse_range_header("bytes=-4", 10), (6, 9))
+        self.assertEqual(helpers.parse_range_header("bytes=-20", 10), (0, 9))
+        # Malformed and multiple ranges are ignored
+        for header in [
+            "bytes=5-2",
+            "bytes=-",
+            "bytes=a-b",
+            "items=1-2",
+            "bytes=1-2,4-5",
+        ]:
+            self.assertIsNone(helpers.parse_range_header(header, 10))
+        for header in ["bytes=10-", "bytes=-0"]:
+            with self.assertRaises(ValueError):
+                helpers.parse_range_header(header, 10)
+
     @patch("elasticsearch_dsl.Search.count", autospec=True, return_value=100)
     def test_get_page_from_search_es_defaults(self, mock_es_count):
         # Elasticsearch search
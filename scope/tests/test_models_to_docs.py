@@ -17,6 +17,8 @@ class ModelsToDocsTests(TestCase):
         collection = Collection.objects.get(pk=1)
         doc_dict = {
             "_id": 1,
+            "_version": 1577836800000000,
+            "_version_type": "external_gte",
             "dc": {
                 "identifier": "123",
                 "title": "Example collection",
@@ -30,6 +32,8 @@ class ModelsToDocsTests(TestCase):
         with patch.object(Collection, "get_es_data", return_value=doc_dict):
             doc = collection.to_es_doc()
             self.assertEqual(collection.pk, doc.meta.id)
+            self.assertEqual(doc.meta.version, 1577836800000000)
+            self.assertEqual(doc.meta.version_type, "external_gte")
             self.assertEqual(repr(doc), "CollectionDoc(id=1)")
 
     def test_dip(self):
@@ -37,6 +41,8 @@ class ModelsToDocsTests(TestCase):
         dip = DIP.objects.get(pk=1)
         doc_dict = {
             "_id": 1,
+            "_version": 1577836800000000,
+            "_version_type": "external_gte",
             "import_status": DIP.IMPORT_SUCCESS,
             "dc": {
                 "identifier": "ABC",
@@ -61,6 +67,8 @@ class ModelsToDocsTests(TestCase):
         )
         doc_dict = {
             "_id": "07263cdf-d11f-4d24-9e16-ef46f002d037",
+            "_version": 1577836800000000,
+            "_version_type": "external_gte",
             "uuid": "07263cdf-d11f-4d24-9e16-ef46f002d037",
             "filepath": "objects/example.ai",
             "fileformat": "Adobe Illustrator",
@@ -75,6 +83,11 @@ class ModelsToDocsTests(TestCase):
             "collection": {"id": 1, "identifier": "123", "title": "Example collection"},
         }
         self.assertEqual(doc_dict, digital_file.get_es_data())
+        # The version follows the latest change of the ancestors
+        modified = datetime(2021, 1, 1, tzinfo=timezone.utc)
+        Collection.objects.filter(pk=1).update(modified=modified)
+        digital_file.refresh_from_db()
+        self.assertEqual(digital_file.get_es_data()["_version"], 1609459200000000)
 
         # Verify Document creation, avoid already tested transformation
         with patch.object(DigitalFile, "get_es_data", return_value=doc_dict):
@@ -83,3 +96,22 @@ class ModelsToDocsTests(TestCase):
             self.assertEqual(
                 repr(doc), "DigitalFileDoc(id='07263cdf-d11f-4d24-9e16-ef46f002d037')"
             )
+
+    @patch("elasticsearch_dsl.Document.save")
+    def test_digital_file_iter_es_data(self, mock_es_save):
+        # Orphan DIP without DublinCore and files without optional fields
+        dip = DIP.objects.create(import_status=DIP.IMPORT_PENDING)
+        for uuid in ["a", "b"]:
+            DigitalFile.objects.create(uuid=uuid, dip=dip, size_bytes=1)
+        expected = [
+            digital_file.get_es_data()
+            for digital_file in DigitalFile.objects.order_by("uuid")
+        ]
+        self.assertEqual(len(expected), 3)
+        # A single query is made for all the files and their ancestors
+        with self.assertNumQueries(1):
+            documents = list(
+                DigitalFile.iter_es_data(DigitalFile.objects.order_by("uuid"))
+            )
+        self.assertEqual(documents, expected)
+        self.assertIs(documents[1]["dip"], documents[2]["dip"])
@@ -1,15 +1,26 @@
+import os
+import shutil
+import tarfile
+import tempfile
 from unittest.mock import patch
 
+from django.db.utils import DatabaseError
 from django.forms.models import model_to_dict
 from django.test import TestCase
+from django.test import override_settings
 
+from scope.helpers import get_sha256
 from scope.models import DIP
 from scope.models import Collection
 from scope.models import DigitalFile
 from scope.models import DublinCore
 from scope.models import PREMISEvent
 from scope.parsemets import METS
+from scope.parsemets import DIPImporter
 from scope.parsemets import METSError
+from scope.parsemets import METSImport
+from scope.parsemets import iter_parsed_files
+from scope.parsemets import read_parsed_dc
 
 
 class ParsemetsTests(TestCase):
@@ -146,3 +157,285 @@ class ParsemetsTests(TestCase):
         mets.parse_mets()
         for event in PREMISEvent.objects.all():
             self.assertEqual(event.detail, "fake event detail")
+
+    def test_streaming_same_results(self):
+        mets_paths = [
+            "scope/tests/fixtures/mets/basic.xml",
+            "scope/tests/fixtures/mets/duplicated_event.xml",
+            "scope/tests/fixtures/mets/empty_identifier.xml",
+            "scope/tests/fixtures/mets/event_detail.xml",
+            "scope/tests/fixtures/mets/full.xml",
+            "scope/tests/fixtures/mets/metadata.xml",
+            "scope/tests/fixtures/mets/no_amdsec.xml",
+            "scope/tests/fixtures/mets/updated.xml",
+        ]
+        for path in mets_paths:
+            mets = METS(path, self.dip.pk, streaming=False)
+            streaming_mets = METS(path, self.dip.pk, streaming=True)
+            self.assertIsNone(streaming_mets.mets_root)
+            self.assertEqual(
+                sorted(mets._iter_file_metadata(), key=lambda f: f[0]["amdsec"]),
+                sorted(
+                    streaming_mets._iter_file_metadata(), key=lambda f: f[0]["amdsec"]
+                ),
+            )
+            self.assertEqual(mets._parse_dc(), streaming_mets._parse_dc())
+
+    def test_mets_from_dip(self):
+        mets_path = "scope/tests/fixtures/mets/metadata.xml"
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dip_path = os.path.join(tmp_dir, "DIP.tar.gz")
+            with tarfile.open(dip_path, "w:gz") as dip:
+                dip.add(mets_path, "DIP/METS.ab028cb0-9942-4f26-a966-7197d7a2e15a.xml")
+            expected = list(METS(mets_path, self.dip.pk)._iter_file_metadata())
+            for streaming in [False, True]:
+                mets = METS(dip_path, self.dip.pk, streaming=streaming, from_dip=True)
+                self.assertEqual(list(mets._iter_file_metadata()), expected)
+                self.assertEqual(
+                    mets._parse_dc(), METS(mets_path, self.dip.pk)._parse_dc()
+                )
+
+    @override_settings(METS_STREAMING_MIN_SIZE=0)
+    @patch("elasticsearch_dsl.Document.save")
+    def test_streaming_parse_mets(self, mock_es_save):
+        mets = METS("scope/tests/fixtures/mets/full.xml", self.dip.pk)
+        self.assertTrue(mets.streaming)
+        mets.parse_mets()
+        self.assertEqual(DigitalFile.objects.all().count(), 2)
+        self.assertEqual(PREMISEvent.objects.all().count(), 13)
+
+    @override_settings(METS_STREAMING_MIN_SIZE=0)
+    @patch("elasticsearch_dsl.Document.save")
+    def test_streaming_malformed_mets(self, mock_es_save):
+        mets_paths = [
+            "scope/tests/fixtures/mets/no_file_uuid.xml",
+            "scope/tests/fixtures/mets/no_file_format.xml",
+            "scope/tests/fixtures/mets/no_event_uuid.xml",
+            "scope/tests/fixtures/mets/long_event_date.xml",
+            "scope/tests/fixtures/mets/duplicated_event.xml",
+        ]
+        for path in mets_paths:
+            mets = METS(path, self.dip.pk)
+            self.assertRaises(METSError, mets.parse_mets)
+
+    @override_settings(IMPORT_BATCH_SIZE=1)
+    @patch("elasticsearch_dsl.Document.save")
+    def test_import_in_multiple_batches(self, mock_es_save):
+        mets = METS("scope/tests/fixtures/mets/full.xml", self.dip.pk)
+        mets.parse_mets()
+        self.assertEqual(DigitalFile.objects.all().count(), 2)
+        self.assertEqual(PREMISEvent.objects.all().count(), 13)
+        # Duplicated event UUIDs in different batches
+        mets = METS("scope/tests/fixtures/mets/duplicated_event.xml", self.dip.pk)
+        self.assertRaises(METSError, mets.parse_mets)
+
+    @patch("elasticsearch_dsl.Document.save")
+    def test_import_rollback_on_error(self, mock_es_save):
+        mets = METS("scope/tests/fixtures/mets/duplicated_event.xml", self.dip.pk)
+        self.assertRaises(METSError, mets.parse_mets)
+        self.assertEqual(DigitalFile.objects.all().count(), 0)
+        self.assertEqual(PREMISEvent.objects.all().count(), 0)
+
+    @patch("elasticsearch_dsl.Document.save")
+    def test_reimport_updates_existing(self, mock_es_save):
+        mets = METS("scope/tests/fixtures/mets/full.xml", self.dip.pk)
+        mets.parse_mets()
+        DigitalFile.objects.update(fileformat="Unknown")
+        PREMISEvent.objects.update(eventtype="Unknown")
+        mets = METS("scope/tests/fixtures/mets/full.xml", self.dip.pk)
+        mets.parse_mets()
+        self.assertEqual(DigitalFile.objects.all().count(), 2)
+        self.assertEqual(PREMISEvent.objects.all().count(), 13)
+        self.assertFalse(DigitalFile.objects.filter(fileformat="Unknown").exists())
+        self.assertFalse(PREMISEvent.objects.filter(eventtype="Unknown").exists())
+
+    @patch("elasticsearch_dsl.Document.save")
+    def test_reimport_unchanged(self, mock_es_save):
+        mets = METS("scope/tests/fixtures/mets/full.xml", self.dip.pk)
+        dip = mets.parse_mets()
+        self.assertEqual(
+            dip.import_counts,
+            {"inserted": 2, "updated": 0, "unchanged": 0, "deleted": 0},
+        )
+        self.assertEqual(len(mets.changed_files), 2)
+        mock_es_save.reset_mock()
+        mets = METS("scope/tests/fixtures/mets/full.xml", self.dip.pk)
+        # Savepoint, DIP, DIP files, existing files and events, DIP
+        # import counts and savepoint release, without inserts or updates.
+        with self.assertNumQueries(7):
+            dip = mets.parse_mets()
+        self.assertEqual(
+            dip.import_counts,
+            {"inserted": 0, "updated": 0, "unchanged": 2, "deleted": 0},
+        )
+        self.assertEqual(mets.changed_files, [])
+        self.assertEqual(mets.deleted_files, [])
+        mock_es_save.assert_not_called()
+
+    @patch("scope.parsemets.delete_document")
+    @patch("elasticsearch_dsl.Document.save")
+    def test_reimport_changes(self, mock_es_save, mock_es_delete):
+        mets = METS("scope/tests/fixtures/mets/full.xml", self.dip.pk)
+        mets.parse_mets()
+        updated_file = DigitalFile.objects.first()
+        updated_file.hashvalue = "fake-hash"
+        updated_file.save(update_es=False)
+        updated_event = updated_file.premis_events.first()
+        updated_event.outcome = "fake-outcome"
+        updated_event.save()
+        deleted_event = PREMISEvent.objects.create(
+            uuid="fake-event-uuid", digitalfile=updated_file
+        )
+        deleted_file = DigitalFile.objects.create(
+            uuid="fake-uuid", dip=self.dip, size_bytes=1
+        )
+        PREMISEvent.objects.create(uuid="fake-event-uuid-2", digitalfile=deleted_file)
+        mock_es_save.reset_mock()
+        mets = METS("scope/tests/fixtures/mets/full.xml", self.dip.pk)
+        dip = mets.parse_mets()
+        self.assertEqual(
+            dip.import_counts,
+            {"inserted": 0, "updated": 1, "unchanged": 1, "deleted": 1},
+        )
+        self.assertEqual(mets.changed_files, [updated_file.uuid])
+        self.assertEqual(mets.deleted_files, [deleted_file.uuid])
+        mock_es_save.assert_called_once()
+        mock_es_delete.assert_called_once_with(
+            index=DigitalFile.es_doc._index._name, id=deleted_file.uuid
+        )
+        updated_file.refresh_from_db()
+        self.assertNotEqual(updated_file.hashvalue, "fake-hash")
+        updated_event.refresh_from_db()
+        self.assertNotEqual(updated_event.outcome, "fake-outcome")
+        self.assertFalse(PREMISEvent.objects.filter(uuid=deleted_event.uuid).exists())
+        self.assertFalse(DigitalFile.objects.filter(uuid=deleted_file.uuid).exists())
+        self.assertEqual(DigitalFile.objects.all().count(), 2)
+        self.assertEqual(PREMISEvent.objects.all().count(), 13)
+
+    @patch("elasticsearch_dsl.Document.save")
+    def test_import_query_count(self, mock_es_save):
+        # Savepoint, DIP, DIP files, existing files and events, bulk file and
+        # event inserts, DIP DublinCore for the ES documents, import counts
+        # and savepoint release.
+        mets = METS("scope/tests/fixtures/mets/full.xml", self.dip.pk)
+        with self.assertNumQueries(10):
+            mets.parse_mets()
+
+    def test_parsed_data(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "data.jsonl.gz")
+            for mets_path in [
+                "scope/tests/fixtures/mets/metadata.xml",
+                "scope/tests/fixtures/mets/no_amdsec.xml",
+            ]:
+                mets = METS(mets_path, self.dip.pk)
+                mets.write_parsed_data(path)
+                self.assertEqual(read_parsed_dc(path), mets._parse_dc())
+                self.assertEqual(
+                    list(iter_parsed_files(path)), list(mets._iter_file_metadata())
+                )
+
+    @override_settings(IMPORT_BATCH_SIZE=1)
+    @patch("scope.parsemets.refresh_index")
+    @patch("scope.models.write_documents")
+    @patch("elasticsearch_dsl.Document.save")
+    def test_mets_import_resume(self, mock_es_save, mock_write, mock_refresh):
+        save_files = DIPImporter.save_files
+        batches = []
+
+        def fail_second_batch(importer, batch):
+            batches.append(batch)
+            if len(batches) == 2:
+                raise DatabaseError
+            return save_files(importer, batch)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            mets_path = os.path.join(tmp_dir, "METS.xml")
+            shutil.copy("scope/tests/fixtures/mets/full.xml", mets_path)
+            with override_settings(MEDIA_ROOT=tmp_dir):
+                mets_import = METSImport(mets_path, self.dip.pk)
+                with patch.object(
+                    DIPImporter,
+                    "save_files",
+                    autospec=True,
+                    side_effect=fail_second_batch,
+                ):
+                    self.assertRaises(DatabaseError, mets_import.run)
+                self.dip.refresh_from_db()
+                self.assertEqual(self.dip.import_progress["stage"], "save")
+                self.assertEqual(self.dip.import_progress["files"], 1)
+                self.assertEqual(DigitalFile.objects.count(), 1)
+                self.assertFalse(os.path.exists(mets_path))
+
+                # Resume from the second batch
+                with patch.object(
+                    DIPImporter, "save_files", autospec=True, side_effect=save_files
+                ) as mock_save_files:
+                    dip = mets_import.run()
+                mock_save_files.assert_called_once()
+            # Only the parsed data is kept
+            self.assertEqual(
+                os.listdir(os.path.join(tmp_dir, "imports")),
+                ["%s.jsonl.gz" % get_sha256("scope/tests/fixtures/mets/full.xml")],
+            )
+        self.assertEqual(dip.import_progress, {"stage": "done"})
+        self.assertEqual(
+            dip.import_counts,
+            {"inserted": 2, "updated": 0, "unchanged": 0, "deleted": 0},
+        )
+        self.assertEqual(DigitalFile.objects.count(), 2)
+        self.assertEqual(PREMISEvent.objects.count(), 13)
+        # Indexed in batches with a single refresh at the end
+        self.assertEqual(mock_write.call_count, 2)
+        mock_refresh.assert_called_once_with(DigitalFile.es_doc._index._name)
+        # Nothing to do after the import is done
+        self.assertEqual(METSImport(mets_path, self.dip.pk).run(), dip)
+
+    @patch("scope.parsemets.refresh_index")
+    @patch("scope.models.write_documents")
+    @patch("elasticsearch_dsl.Document.save")
+    def test_mets_import_identical_mets(self, mock_es_save, mock_write, mock_refresh):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            mets_path = os.path.join(tmp_dir, "METS.xml")
+            with override_settings(MEDIA_ROOT=tmp_dir):
+                shutil.copy("scope/tests/fixtures/mets/full.xml", mets_path)
+                METSImport(mets_path, self.dip.pk).run()
+                # Import the same METS file again after deleting the DIP
+                with patch("scope.models.delete_document"), patch(
+                    "scope.models.celery_app.send_task"
+                ):
+                    self.dip.delete()
+                other_dip = DIP.objects.create(
+                    dc=DublinCore.objects.create(identifier="B")
+                )
+                shutil.copy("scope/tests/fixtures/mets/full.xml", mets_path)
+                with patch.object(METS, "write_parsed_data") as mock_write:
+                    METSImport(mets_path, other_dip.pk).run()
+                mock_write.assert_not_called()
+                self.assertEqual(other_dip.digital_files.count(), 2)
+                self.assertEqual(len(os.listdir(os.path.join(tmp_dir, "imports"))), 1)
+                # Expired parsed data is removed
+                with override_settings(IMPORT_DATA_MAX_AGE=-1):
+                    METSImport(mets_path, other_dip.pk).clean()
+                self.assertEqual(os.listdir(os.path.join(tmp_dir, "imports")), [])
+
+    @override_settings(IMPORT_BATCH_SIZE=1)
+    @patch("elasticsearch_dsl.Document.save")
+    def test_mets_import_validates_before_saving(self, mock_es_save):
+        fixture_path = "scope/tests/fixtures/mets/full.xml"
+        files = list(METS(fixture_path, self.dip.pk)._iter_file_metadata())
+        # The second file exists in another DIP
+        other_dip = DIP.objects.create(dc=DublinCore.objects.create(identifier="B"))
+        DigitalFile.objects.create(
+            uuid=files[1][0]["uuid"], dip=other_dip, size_bytes=1
+        )
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            mets_path = os.path.join(tmp_dir, "METS.xml")
+            shutil.copy(fixture_path, mets_path)
+            with override_settings(MEDIA_ROOT=tmp_dir):
+                with self.assertRaises(METSError):
+                    METSImport(mets_path, self.dip.pk).run()
+        # The first batch is not saved
+        self.assertFalse(self.dip.digital_files.exists())
+        self.dip.refresh_from_db()
+        self.assertIsNone(self.dip.import_progress)
@@ -0,0 +1,100 @@
+import threading
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+
+from django.test import TestCase
+from django.test import override_settings
+
+from scope.storage_service import get_client
+from scope.storage_service import ss_request_finished
+
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    """Respond with a 503 status to every other request."""
+
+    requests = 0
+
+    def do_GET(self):
+        FlakyHandler.requests += 1
+        status = 503 if FlakyHandler.requests % 2 else 200
+        self.send_response(status)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *args):
+        pass
+
+
+class StorageServiceTests(TestCase):
+    def setUp(self):
+        FlakyHandler.requests = 0
+        self.server = HTTPServer(("127.0.0.1", 0), FlakyHandler)
+        self.host_url = "http://127.0.0.1:%d" % self.server.server_port
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_get_client_no_host(self):
+        with self.assertRaises(RuntimeError):
+            get_client("http://unknown.host")
+
+    def test_get_client_reused(self):
+        with override_settings(
+            SS_HOSTS={self.host_url: {"user": "test", "secret": "test"}}
+        ):
+            client = get_client(self.host_url)
+            self.assertIs(get_client(self.host_url), client)
+            self.assertEqual(
+                client.session.headers["Authorization"], "ApiKey test:test"
+            )
+        # A new client is created when the credentials change
+        with override_settings(
+            SS_HOSTS={self.host_url: {"user": "test", "secret": "other"}}
+        ):
+            self.assertIsNot(get_client(self.host_url), client)
+
+    @override_settings(SS_CONNECT_TIMEOUT=1, SS_READ_TIMEOUT=2, SS_MAX_RETRIES=1)
+    def test_retries_and_metrics(self):
+        metrics = []
+
+        def receiver(sender, **kwargs):
+            metrics.append(kwargs)
+
+        ss_request_finished.connect(receiver)
+        self.addCleanup(ss_request_finished.disconnect, receiver)
+        with override_settings(
+            SS_HOSTS={self.host_url: {"user": "test", "secret": "retries"}}
+        ):
+            client = get_client(self.host_url)
+            self.assertEqual(client.timeout, (1, 2))
+            response = client.get("%s/api/v2/file/" % self.host_url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(FlakyHandler.requests, 2)
+        self.assertEqual(len(metrics), 1)
+        self.assertEqual(metrics[0]["host_url"], self.host_url)
+        self.assertEqual(metrics[0]["method"], "GET")
+        self.assertEqual(metrics[0]["status_code"], 200)
+        self.assertEqual(metrics[0]["retries"], 1)
+
+    @override_settings(SS_MAX_RETRIES=0)
+    def test_retries_exhausted(self):
+        with override_settings(
+            SS_HOSTS={self.host_url: {"user": "test", "secret": "no-retries"}}
+        ):
+            response = get_client(self.host_url).get(self.host_url)
+        # The last response is returned to be handled by the caller
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(FlakyHandler.requests, 1)
+
+    def test_open(self):
+        with override_settings(
+            SS_HOSTS={self.host_url: {"user": "test", "secret": "open"}}
+        ):
+            client = get_client(self.host_url)
+        with client.open(self.host_url) as (size, body):
+            self.assertEqual(size, 2)
+            self.assertEqual(body.read(), b"ok")
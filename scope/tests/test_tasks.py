@@ -1,7 +1,10 @@
 import os
-from unittest.mock import ANY
-from unittest.mock import MagicMock
-from unittest.mock import Mock
+import shutil
+import tarfile
+import tempfile
+import zipfile
+from contextlib import contextmanager
+from functools import partial
 from unittest.mock import patch
 
 import requests
@@ -9,11 +12,16 @@ import vcr
 from django.conf import settings
 from django.test import TestCase
 from django.test import override_settings
+from elasticsearch.exceptions import TransportError
 
+from scope.helpers import get_sha256
 from scope.models import DIP
 from scope.models import DigitalFile
+from scope.parsemets import METS
+from scope.parsemets import METSError
 from scope.tasks import download_mets
 from scope.tasks import extract_mets
+from scope.tasks import import_ss_mets
 from scope.tasks import parse_mets
 from scope.tasks import save_import_error
 
@@ -62,85 +70,253 @@ class TasksTests(TestCase):
         self.assertTrue(os.path.isfile(self.mets_path))
         os.remove(self.mets_path)
 
-    @patch("scope.tasks.zipfile.is_zipfile", return_value=False)
-    @patch("scope.tasks.tarfile.is_tarfile", return_value=False)
-    def test_extract_mets_wrong_dip_format(self, mock_is_tarfile, mock_is_zipfile):
-        with self.assertRaises(ValueError) as exc:
-            extract_mets("/DIP.7z")
-            self.assertEqual(str(exc), "DIP is not a tar or a zip file: DIP.7z")
-
-    @patch("scope.tasks.tarfile.open", return_value=MagicMock())
-    @patch("scope.tasks.tarfile.is_tarfile", return_value=True)
-    def test_extract_mets_not_found_in_tar(self, mock_is_tarfile, mock_tarfile_open):
-        mock_tarfile_open.__enter__.return_value = None
-        with self.assertRaises(FileNotFoundError) as exc:
-            extract_mets("/DIP.tar")
-            self.assertEqual(str(exc), "METS file not found in DIP file.")
-
-    @patch("scope.tasks.zipfile.ZipFile.infolist", return_value=[])
-    @patch("scope.tasks.zipfile.ZipFile.__init__", return_value=None)
-    @patch("scope.tasks.zipfile.is_zipfile", return_value=True)
-    def test_extract_mets_not_found_in_zip(
-        self, mock_is_zipfile, mock_zip_init, mock_zip_info
-    ):
-        with self.assertRaises(FileNotFoundError) as exc:
-            extract_mets("/DIP.zip")
-            self.assertEqual(str(exc), "METS file not found in DIP file.")
-
-    @patch("scope.tasks.tarfile.open", return_value=MagicMock())
-    @patch("scope.tasks.tarfile.is_tarfile", return_value=True)
-    def test_extract_mets_found_in_tar(self, mock_is_tarfile, mock_tarfile_open):
-        mock_member = Mock()
-        mock_member.name = "relative/path/METS.ab028cb0-9942-4f26-a966-7197d7a2e15a.xml"
-        mock_tarfile = Mock()
-        mock_tarfile.getmembers.return_value = [mock_member]
-        mock_tarfile_open().__enter__.return_value = mock_tarfile
-        mets_path = extract_mets("/DIP.tar")
+    def _write_dip(self, path, members):
+        """Write a tar or zip DIP, based on the extension, with the given members.
+
+        Each member is a tuple with its name and the path of the file to add.
+        """
+        if path.endswith(".zip"):
+            with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as dip:
+                for name, file_path in members:
+                    dip.write(file_path, name)
+        else:
+            with tarfile.open(path, "w:gz") as dip:
+                for name, file_path in members:
+                    dip.add(file_path, name)
+
+    def test_extract_mets_wrong_dip_format(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dip_path = os.path.join(tmp_dir, "DIP.7z")
+            with open(dip_path, "w") as dip_file:
+                dip_file.write("Not a tar or a zip file")
+            with self.assertRaises(ValueError) as exc:
+                extract_mets(dip_path)
+        self.assertEqual(str(exc.exception), "DIP is not a tar or a zip file: DIP.7z")
+
+    def test_extract_mets_not_found(self):
+        members = [("DIP/objects/file.xml", "scope/tests/fixtures/mets/full.xml")]
+        for name in ["DIP.tar.gz", "DIP.zip"]:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                dip_path = os.path.join(tmp_dir, name)
+                self._write_dip(dip_path, members)
+                with self.assertRaises(FileNotFoundError) as exc:
+                    extract_mets(dip_path)
+            self.assertEqual(str(exc.exception), "METS file not found in DIP file.")
+
+    def test_extract_mets_found(self):
+        fixture_path = "scope/tests/fixtures/mets/full.xml"
+        mets_name = "METS.ab028cb0-9942-4f26-a966-7197d7a2e15a.xml"
+        members = [
+            ("DIP/objects/file.xml", fixture_path),
+            ("DIP/%s" % mets_name, fixture_path),
+        ]
+        for name in ["DIP.tar.gz", "DIP.zip"]:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                dip_path = os.path.join(tmp_dir, name)
+                self._write_dip(dip_path, members)
+                with override_settings(MEDIA_ROOT=tmp_dir):
+                    mets_path = extract_mets(dip_path)
+                self.assertEqual(mets_path, os.path.join(tmp_dir, mets_name))
+                with open(mets_path, "rb") as mets_file, open(
+                    fixture_path, "rb"
+                ) as fixture_file:
+                    self.assertEqual(mets_file.read(), fixture_file.read())
+
+    def test_extract_mets_stops_at_first_match(self):
+        fixture_path = "scope/tests/fixtures/mets/full.xml"
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dip_path = os.path.join(tmp_dir, "DIP.tar")
+            with tarfile.open(dip_path, "w") as dip:
+                dip.add(
+                    fixture_path, "DIP/METS.ab028cb0-9942-4f26-a966-7197d7a2e15a.xml"
+                )
+                dip.add(fixture_path, "DIP/objects/file.xml")
+            # Truncate the file in the middle of the second member
+            with open(dip_path, "r+b") as dip_file:
+                dip_file.truncate(os.path.getsize(fixture_path) + 2048)
+            with override_settings(MEDIA_ROOT=tmp_dir):
+                mets_path = extract_mets(dip_path)
+            self.assertTrue(os.path.isfile(mets_path))
+
+    @patch("scope.parsemets.refresh_index")
+    @patch("scope.models.write_documents")
+    @patch("scope.models.celery_app.send_task")
+    @patch("elasticsearch_dsl.Document.save")
+    def test_parse_mets(self, mock_es_save, mock_send_task, mock_write, mock_refresh):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            mets_path = os.path.join(tmp_dir, "METS.xml")
+            shutil.copy("scope/tests/fixtures/mets/full.xml", mets_path)
+            with override_settings(MEDIA_ROOT=tmp_dir):
+                parse_mets(mets_path, self.dip.pk)
+            # METS and changes files are removed, the parsed data is kept
+            self.assertEqual(
+                os.listdir(os.path.join(tmp_dir, "imports")),
+                ["%s.jsonl.gz" % get_sha256("scope/tests/fixtures/mets/full.xml")],
+            )
+            self.assertFalse(os.path.exists(mets_path))
+        self.dip.refresh_from_db()
+        self.assertEqual(self.dip.import_status, DIP.IMPORT_SUCCESS)
+        self.assertEqual(self.dip.import_progress, {"stage": "done"})
         self.assertEqual(
-            os.path.join(
-                settings.MEDIA_ROOT, "METS.ab028cb0-9942-4f26-a966-7197d7a2e15a.xml"
-            ),
-            mets_path,
+            self.dip.import_counts,
+            {"inserted": 2, "updated": 0, "unchanged": 0, "deleted": 1},
         )
+        # DigitalFiles are indexed and deleted in bulk instead of one by one
+        mock_es_save.assert_called_once()
+        mock_write.assert_called_once()
+        documents = list(mock_write.call_args[0][1])
+        self.assertEqual(len(documents), 3)
+        self.assertEqual(documents[-1], {"_op_type": "delete", "_id": "fake-uuid"})
+        mock_refresh.assert_called_once_with(DigitalFile.es_doc._index._name)
+        mock_send_task.assert_called()
 
-    @patch("scope.tasks.os.path.basename")
-    @patch("scope.tasks.zipfile.ZipFile.extract", return_value="/mets.xml")
-    @patch(
-        "scope.tasks.zipfile.ZipFile.infolist",
-        return_value=[
-            Mock(filename="relative/path/METS.ab028cb0-9942-4f26-a966-7197d7a2e15a.xml")
-        ],
-    )
-    @patch("scope.tasks.zipfile.ZipFile.__init__", return_value=None)
-    @patch("scope.tasks.zipfile.is_zipfile", return_value=True)
-    @patch("scope.tasks.tarfile.is_tarfile", return_value=False)
-    def test_extract_mets_found_in_zip(
+    @patch("scope.parsemets.refresh_index")
+    @patch("scope.models.write_documents")
+    @patch("scope.models.celery_app.send_task")
+    @patch("elasticsearch_dsl.Document.save")
+    @patch("scope.tasks._get_mets_url", return_value="http://ss/extract_file/")
+    @patch("scope.tasks.get_client")
+    @patch("scope.tasks.cache_ss_dip.delay")
+    def test_import_ss_mets(
         self,
-        mock_is_tarfile,
-        mock_is_zipfile,
-        mock_zip_init,
-        mock_zip_info,
-        mock_zip_extract,
-        mock_os_basename,
+        mock_cache_ss_dip,
+        mock_get_client,
+        mock_get_mets_url,
+        mock_es_save,
+        mock_send_task,
+        mock_write,
+        mock_refresh,
     ):
-        mets_path = extract_mets("/DIP.zip")
-        mock_os_basename.assert_called_with(
-            "relative/path/METS.ab028cb0-9942-4f26-a966-7197d7a2e15a.xml"
+        fixture_path = "scope/tests/fixtures/mets/full.xml"
+        opened = []
+
+        @contextmanager
+        def mock_open(url, size):
+            opened.append(url)
+            with open(fixture_path, "rb") as mets_file:
+                yield size, mets_file
+
+        # Parsed from a single request with a known size and from two requests
+        # with the streaming parser when the size is unknown. The DIP is only
+        # cached after the import when the prefetch is enabled.
+        for size, request_count, prefetch in [(1024, 1, False), (None, 2, True)]:
+            opened.clear()
+            mock_get_client.return_value.open = partial(mock_open, size=size)
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                with override_settings(
+                    MEDIA_ROOT=tmp_dir,
+                    SS_DIP_CACHE_SIZE=1024,
+                    SS_DIP_CACHE_PREFETCH=prefetch,
+                ):
+                    import_ss_mets(self.dip.pk)
+                    # An identical METS file is only requested once
+                    self.dip.import_progress = None
+                    self.dip.save(update_es=False)
+                    with patch.object(METS, "write_parsed_data") as mock_write:
+                        import_ss_mets(self.dip.pk)
+                    mock_write.assert_not_called()
+                # Only the parsed data is written to disk
+                self.assertEqual(
+                    os.listdir(os.path.join(tmp_dir, "imports")),
+                    ["%s.jsonl.gz" % get_sha256(fixture_path)],
+                )
+            self.assertEqual(opened, ["http://ss/extract_file/"] * (request_count + 1))
+            self.dip.refresh_from_db()
+            self.assertEqual(self.dip.import_status, DIP.IMPORT_SUCCESS)
+            self.assertEqual(self.dip.digital_files.count(), 2)
+            self.assertEqual(mock_cache_ss_dip.called, prefetch)
+            self.dip.import_progress = None
+            self.dip.save(update_es=False)
+
+    @patch("scope.parsemets.refresh_index")
+    @patch("scope.models.write_documents")
+    @patch("scope.models.celery_app.send_task")
+    @patch("elasticsearch_dsl.Document.save")
+    def test_parse_mets_from_dip(
+        self, mock_es_save, mock_send_task, mock_write, mock_refresh
+    ):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dip_path = os.path.join(tmp_dir, "DIP.zip")
+            self._write_dip(
+                dip_path,
+                [
+                    (
+                        "DIP/METS.ab028cb0-9942-4f26-a966-7197d7a2e15a.xml",
+                        "scope/tests/fixtures/mets/full.xml",
+                    ),
+                    (
+                        "DIP/objects/3a78a45c-28be-47d8-a839-fbe208b90a63-file.xml",
+                        "scope/tests/fixtures/mets/full.xml",
+                    ),
+                ],
+            )
+            with override_settings(MEDIA_ROOT=tmp_dir):
+                parse_mets(dip_path, self.dip.pk, from_dip=True)
+            # The METS file is not extracted and the DIP is kept
+            self.assertEqual(sorted(os.listdir(tmp_dir)), ["DIP.zip", "imports"])
+        self.dip.refresh_from_db()
+        self.assertEqual(self.dip.import_status, DIP.IMPORT_SUCCESS)
+        self.assertEqual(
+            self.dip.import_counts,
+            {"inserted": 2, "updated": 0, "unchanged": 0, "deleted": 1},
+        )
+        # The access copy members are saved, compressed ones without offset
+        digital_file = DigitalFile.objects.get(
+            uuid="3a78a45c-28be-47d8-a839-fbe208b90a63"
+        )
+        self.assertEqual(
+            digital_file.dip_member,
+            "DIP/objects/3a78a45c-28be-47d8-a839-fbe208b90a63-file.xml",
+        )
+        self.assertIsNone(digital_file.dip_member_offset)
+        self.assertEqual(
+            digital_file.dip_member_size,
+            os.path.getsize("scope/tests/fixtures/mets/full.xml"),
         )
-        mock_zip_extract.assert_called_with(ANY, settings.MEDIA_ROOT)
-        self.assertEqual("/mets.xml", mets_path)
 
+    @patch("scope.parsemets.refresh_index")
+    @patch("scope.models.write_documents", side_effect=[TransportError, 3])
     @patch("scope.models.celery_app.send_task")
-    @patch("scope.tasks.os.remove")
     @patch("elasticsearch_dsl.Document.save")
-    @patch("scope.tasks.METS")
-    def test_parse_mets(self, mock_mets, mock_es_save, mock_os_remove, mock_send_task):
-        mock_mets().return_value = None
-        mock_mets().parse_mets.return_value = self.dip
-        parse_mets("/mets.xml", self.dip.pk)
+    def test_parse_mets_retry(
+        self, mock_es_save, mock_send_task, mock_write, mock_refresh
+    ):
+        self.dip.import_status = DIP.IMPORT_PENDING
+        self.dip.save(update_es=False)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            mets_path = os.path.join(tmp_dir, "METS.xml")
+            shutil.copy("scope/tests/fixtures/mets/full.xml", mets_path)
+            with override_settings(MEDIA_ROOT=tmp_dir):
+                with self.assertRaises(TransportError):
+                    parse_mets(mets_path, self.dip.pk)
+                self.dip.refresh_from_db()
+                self.assertEqual(self.dip.import_status, DIP.IMPORT_PENDING)
+                self.assertEqual(self.dip.import_progress["stage"], "index")
+                # The METS file is not needed after the parse stage
+                self.assertFalse(os.path.exists(mets_path))
+                self.assertEqual(len(os.listdir(os.path.join(tmp_dir, "imports"))), 2)
+                # Resume from the index stage
+                parse_mets(mets_path, self.dip.pk)
+            self.assertEqual(len(os.listdir(os.path.join(tmp_dir, "imports"))), 1)
+        self.dip.refresh_from_db()
         self.assertEqual(self.dip.import_status, DIP.IMPORT_SUCCESS)
-        mock_send_task.assert_called()
-        mock_os_remove.assert_called_with("/mets.xml")
+        self.assertEqual(mock_write.call_count, 2)
+        mock_refresh.assert_called_once()
+
+    @patch("elasticsearch_dsl.Document.save")
+    def test_parse_mets_error_removes_mets(self, mock_es_save):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            mets_path = os.path.join(tmp_dir, "METS.xml")
+            shutil.copy("scope/tests/fixtures/mets/no_file_uuid.xml", mets_path)
+            with override_settings(MEDIA_ROOT=tmp_dir):
+                with self.assertRaises(METSError):
+                    parse_mets(mets_path, self.dip.pk)
+            self.assertFalse(os.path.exists(mets_path))
+            self.assertFalse(
+                os.path.exists(
+                    os.path.join(tmp_dir, "imports", "%s.changes.jsonl" % self.dip.pk)
+                )
+            )
 
     @patch("scope.models.celery_app.send_task")
     @patch("elasticsearch_dsl.Document.save")
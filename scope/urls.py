@@ -13,6 +13,7 @@ Including another URLconf
     1. Import the include() function: from django.conf.urls import url, include
     2. Add a URL to urlpatterns:  url(r'^blog/', include('blog.urls'))
 """
+
 from django.conf.urls import include
 from django.conf.urls import url
 from django.contrib.auth import views as auth_views
@@ -48,6 +49,16 @@ urlpatterns = [
     url(r"^folder/(?P<pk>\d+)/$", views.dip, name="dip"),
     url(r"^folder/(?P<pk>\d+)/download$", views.download_dip, name="download_dip"),
     url(r"^object/(?P<pk>[-\w-]+)$", views.digital_file, name="digital_file"),
+    url(
+        r"^object/(?P<pk>[-\w-]+)/download$",
+        views.download_digital_file,
+        name="download_digital_file",
+    ),
+    url(
+        r"^objects/download$",
+        views.download_digital_files,
+        name="download_digital_files",
+    ),
     url(r"^new_folder/", views.new_dip, name="new_dip"),
     url(r"^orphan_folders/", views.orphan_dips, name="orphan_dips"),
     url(r"^faq/", views.faq, name="faq"),
@@ -1,8 +1,14 @@
+import logging
+import mimetypes
+import os
 import zipfile
+from contextlib import ExitStack
+from contextlib import closing
+from contextlib import contextmanager
 from datetime import datetime
+from urllib.parse import urlparse
 
 import requests
-from celery import chain
 from django.conf import settings as django_settings
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
@@ -14,28 +20,41 @@ from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django.shortcuts import redirect
 from django.shortcuts import render
+from django.utils import timezone
 from django.utils.translation import gettext as _
 
 from search.helpers import add_digital_file_aggs
 from search.helpers import add_digital_file_filters
 from search.helpers import add_query_to_search
 
+from . import dip_cache
+from .archives import get_access_copy_uuid
+from .archives import iter_open_members
+from .archives import iter_zip
+from .archives import open_member
 from .forms import ContentForm
 from .forms import DeleteByDublinCoreForm
 from .forms import DublinCoreSettingsForm
 from .forms import UserForm
 from .helpers import get_page_from_search
 from .helpers import get_sort_params
+from .helpers import parse_range_header
 from .models import DIP
 from .models import Collection
 from .models import Content
 from .models import DigitalFile
 from .models import DublinCore
 from .models import User
-from .tasks import extract_mets
+from .storage_service import get_client
+from .tasks import cache_ss_dip
 from .tasks import parse_mets
 from .tasks import save_import_error
 
+logger = logging.getLogger("scope.views")
+
+# Size in bytes of the chunks read in the file downloads
+DOWNLOAD_CHUNK_SIZE = 1048576
+
 
 def _get_and_validate_digital_file_filters(request):
     """Process digital file filters.
@@ -231,6 +250,26 @@ def edit_user(request, pk):
     return render(request, "edit_user.html", {"form": form, "instance": instance})
 
 
+def _get_digital_file_search(request):
+    """Build the DigitalFiles search from the request query and filters.
+
+    Returns the search and the filters set, to maintain their value in the
+    templates.
+    """
+    search = DigitalFile.es_doc.search()
+    # Exclude DigitalFiles from orphan DIPS and from DIPs with 'PENDING' or 'FAILURE'
+    # import status when the user is not an editor or an administrator.
+    if not request.user.is_editor():
+        search = search.query("exists", field="collection.id").exclude(
+            "terms", **{"dip.import_status": [DIP.IMPORT_PENDING, DIP.IMPORT_FAILURE]}
+        )
+    fields = ["filepath", "fileformat", "collection.title"]
+    search = add_query_to_search(search, request.GET.get("query", ""), fields)
+    filters, valid_filters = _get_and_validate_digital_file_filters(request)
+    search = add_digital_file_filters(search, valid_filters)
+    return search, filters
+
+
 @login_required(login_url="/login/")
 def search(request):
     # Sort options
@@ -243,22 +282,12 @@ def search(request):
     sort_option, sort_dir = get_sort_params(request.GET, sort_options, "path")
     sort_field = sort_options.get(sort_option)
 
-    # Search
-    search = DigitalFile.es_doc.search()
-    # Exclude DigitalFiles from orphan DIPS and from DIPs with 'PENDING' or 'FAILURE'
-    # import status when the user is not an editor or an administrator.
-    if not request.user.is_editor():
-        search = search.query("exists", field="collection.id").exclude(
-            "terms", **{"dip.import_status": [DIP.IMPORT_PENDING, DIP.IMPORT_FAILURE]}
-        )
-    fields = ["filepath", "fileformat", "collection.title"]
-    search = add_query_to_search(search, request.GET.get("query", ""), fields)
+    # Search and filters
+    search, filters = _get_digital_file_search(request)
     search = search.sort({sort_field: {"order": sort_dir}})
 
-    # Aggregations and filters
+    # Aggregations
     search = add_digital_file_aggs(search)
-    filters, valid_filters = _get_and_validate_digital_file_filters(request)
-    search = add_digital_file_filters(search, valid_filters)
 
     # Pagination
     page = get_page_from_search(search, request.GET)
@@ -419,6 +448,230 @@ def digital_file(request, pk):
     return render(request, "digitalfile.html", {"digitalfile": digitalfile})
 
 
+@login_required(login_url="/login/")
+def download_digital_file(request, pk):
+    """Download the access copy of a DigitalFile from the uploaded DIP file.
+
+    Members stored without compression are read directly from their position
+    in the DIP file, supporting range requests. Otherwise, the member is
+    located in the DIP and decompressed as it's sent.
+    """
+    digitalfile = get_object_or_404(DigitalFile, pk=pk)
+    if not digitalfile.dip.objectszip or not digitalfile.dip.is_visible_by_user(
+        request.user
+    ):
+        raise Http404("File not found.")
+    stack = ExitStack()
+    try:
+        name, size, member_file = stack.enter_context(_open_access_copy(digitalfile))
+    except (FileNotFoundError, ValueError):
+        raise Http404("File not found.")
+    seekable = digitalfile.dip_member_offset is not None
+    first, last = 0, size - 1
+    byte_range = None
+    if seekable:
+        try:
+            byte_range = parse_range_header(request.META.get("HTTP_RANGE"), size)
+        except ValueError:
+            stack.close()
+            response = HttpResponse(status=416)
+            response["Content-Range"] = "bytes */%d" % size
+            return response
+        if byte_range:
+            first, last = byte_range
+            member_file.seek(first, os.SEEK_CUR)
+    response = StreamingHttpResponse(
+        _iter_file(member_file, last - first + 1, stack),
+        status=206 if byte_range else 200,
+    )
+    response["Content-Length"] = last - first + 1
+    response["Content-Type"] = (
+        mimetypes.guess_type(name)[0] or "application/octet-stream"
+    )
+    response["Content-Disposition"] = 'attachment; filename="%s"' % os.path.basename(
+        name
+    )
+    if seekable:
+        response["Accept-Ranges"] = "bytes"
+    if byte_range:
+        response["Content-Range"] = "bytes %d-%d/%d" % (first, last, size)
+    return response
+
+
+@contextmanager
+def _open_access_copy(digitalfile):
+    """Open the access copy of a DigitalFile in the uploaded DIP file.
+
+    Yields the member name and size and a binary file object at the start of
+    its data. The access copy is located by UUID if the DIP was imported
+    before its members were saved.
+    """
+    dip_path = digitalfile.dip.objectszip.path
+    if digitalfile.dip_member_offset is not None:
+        with open(dip_path, "rb") as dip_file:
+            dip_file.seek(digitalfile.dip_member_offset)
+            yield digitalfile.dip_member, digitalfile.dip_member_size, dip_file
+        return
+
+    def match(name):
+        if digitalfile.dip_member:
+            return name == digitalfile.dip_member
+        return get_access_copy_uuid(name) == digitalfile.uuid
+
+    with open_member(dip_path, match) as member:
+        yield member
+
+
+def _iter_file(file, length, stack):
+    """Iterate a file in chunks up to the given length.
+
+    The file contexts in the given `ExitStack` are closed at the end.
+    """
+    with stack:
+        while length > 0:
+            chunk = file.read(min(DOWNLOAD_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+@login_required(login_url="/login/")
+def download_digital_files(request):
+    """Download the access copies of multiple DigitalFiles in a zip file.
+
+    The DigitalFiles are selected by UUID with the `uuid` parameter or, if it's
+    not set, by the same parameters used in the search page, up to the number
+    of files set in the `DOWNLOAD_ZIP_MAX_FILES` setting. The zip file is built
+    while it's sent, reading the access copies from the uploaded DIP files or
+    the SS DIP downloads.
+    """
+    max_files = django_settings.DOWNLOAD_ZIP_MAX_FILES
+    uuids = request.GET.getlist("uuid")[:max_files]
+    if not uuids:
+        search, _filters = _get_digital_file_search(request)
+        search = search.source(False)[:max_files]
+        uuids = [hit.meta.id for hit in search.execute()]
+    digital_files_by_dip = {}
+    queryset = (
+        DigitalFile.objects.filter(uuid__in=uuids)
+        .select_related("dip__dc", "dip__collection")
+        .order_by("dip_id", "filepath")
+    )
+    for digital_file in queryset:
+        dip = digital_file.dip
+        if not (dip.objectszip or dip.ss_download_url):
+            continue
+        if dip.is_visible_by_user(request.user):
+            digital_files_by_dip.setdefault(dip, []).append(digital_file)
+    if not digital_files_by_dip:
+        raise Http404("Files not found.")
+    response = StreamingHttpResponse(
+        iter_zip(
+            _iter_access_copies(digital_files_by_dip.items()), DOWNLOAD_CHUNK_SIZE
+        ),
+        content_type="application/zip",
+    )
+    response["Content-Disposition"] = 'attachment; filename="%s.zip"' % (
+        "scope-%s" % datetime.now().strftime("%Y%m%d%H%M%S")
+    )
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+def _iter_access_copies(digital_files_by_dip):
+    """Yield the zip members with the access copies of DigitalFiles by DIP.
+
+    The indexed members stored without compression in uploaded DIPs are read
+    from their offset. The rest, and the members of SS DIPs, are read in a
+    single pass over the DIP file or download, which stops when all the access
+    copies are found. DIPs that can't be opened or read are logged and skipped.
+    """
+    # Paths already used in the zip file
+    paths = set()
+    for dip, digital_files in digital_files_by_dip:
+        with ExitStack() as stack:
+            try:
+                dip_file = stack.enter_context(_open_dip_file(dip))
+            except (OSError, RuntimeError, requests.RequestException) as error:
+                logger.warning("Could not open DIP %s: %s", dip.pk, error)
+                continue
+            pending = {}
+            for digital_file in digital_files:
+                if digital_file.dip_member_offset is None:
+                    pending[digital_file.uuid] = digital_file
+                    continue
+                dip_file.seek(digital_file.dip_member_offset)
+                yield _get_zip_member(
+                    digital_file,
+                    digital_file.dip_member,
+                    digital_file.dip_member_size,
+                    dip_file,
+                    paths,
+                )
+            if not pending:
+                continue
+            if dip_file.seekable():
+                dip_file.seek(0)
+
+            def match(name):
+                digital_file = pending.get(get_access_copy_uuid(name))
+                if digital_file is None:
+                    return False
+                return not digital_file.dip_member or name == digital_file.dip_member
+
+            members = stack.enter_context(closing(iter_open_members(dip_file, match)))
+            try:
+                for name, size, member_file in members:
+                    digital_file = pending.pop(get_access_copy_uuid(name))
+                    yield _get_zip_member(digital_file, name, size, member_file, paths)
+                    if not pending:
+                        break
+            except ValueError as error:
+                logger.warning("Could not read DIP %s: %s", dip.pk, error)
+
+
+@contextmanager
+def _open_dip_file(dip):
+    """Open the uploaded DIP file or stream the DIP download from the SS."""
+    if dip.objectszip:
+        with open(dip.objectszip.path, "rb") as dip_file:
+            yield dip_file
+    else:
+        client = get_client(dip.ss_host_url)
+        with client.open(dip.ss_download_url) as (_size, stream):
+            yield stream
+
+
+def _get_zip_member(digital_file, name, size, member_file, paths):
+    """Get the zip member for the access copy of a DigitalFile.
+
+    The access copy is placed in a folder named after the DIP identifier, or
+    its UUID or id without one, keeping the original file path with the access
+    copy name, without the UUID prefix, and modification date. A counter is
+    added to the name if the path is already in the `paths` set, which is
+    updated with the new path.
+    """
+    dip = digital_file.dip
+    folder = (dip.dc and dip.dc.identifier) or dip.ss_uuid or str(dip.pk)
+    access_copy_name = os.path.basename(name)[len(digital_file.uuid) + 1 :]
+    path = os.path.join(
+        folder.replace("/", "_"),
+        os.path.dirname(digital_file.filepath),
+        access_copy_name,
+    )
+    root, extension = os.path.splitext(path)
+    count = 1
+    while path in paths:
+        count += 1
+        path = "%s_%d%s" % (root, count, extension)
+    paths.add(path)
+    date = timezone.localtime(digital_file.datemodified or timezone.now())
+    if date.year < 1980:
+        date = timezone.localtime()
+    return path, size, date.timetuple()[:6], member_file
+
+
 @login_required(login_url="/login/")
 def new_collection(request):
     if not request.user.is_editor():
@@ -433,6 +686,8 @@ def new_collection(request):
         collection = collection_form.save(commit=False)
         collection.dc = dc_form.save()
         collection.save()
+        # Show the new Collection in the list when using the ES outbox
+        Collection.wait_for_es(collection.pk)
 
         return redirect("collections")
 
@@ -458,9 +713,10 @@ def new_dip(request):
         dip.dc = dc_form.save()
         dip.import_status = DIP.IMPORT_PENDING
         dip.save()
+        DIP.wait_for_es(dip.pk)
 
-        # Extract and parse METS file asynchronously
-        chain(extract_mets.s(dip.objectszip.path), parse_mets.s(dip.pk)).on_error(
+        # Parse METS file from the DIP asynchronously
+        parse_mets.s(dip.objectszip.path, dip.pk, from_dip=True).on_error(
             save_import_error.s(dip_id=dip.pk)
         ).delay()
 
@@ -497,6 +753,7 @@ def edit_collection(request, pk):
     if request.method == "POST" and collection_form.is_valid() and dc_form.is_valid():
         dc_form.save()
         collection_form.save()
+        Collection.wait_for_es(pk)
         if collection.requires_es_descendants_update():
             messages.info(
                 request,
@@ -533,6 +790,7 @@ def edit_dip(request, pk):
     if request.method == "POST" and dip_form.is_valid() and dc_form.is_valid():
         dc_form.save()
         dip_form.save()
+        DIP.wait_for_es(pk)
         if dip.requires_es_descendants_update():
             messages.info(
                 request,
@@ -570,6 +828,7 @@ def delete_collection(request, pk):
                 ),
             )
         collection.delete()
+        Collection.wait_for_es(pk)
         return redirect("collections")
 
     return render(
@@ -601,6 +860,7 @@ def delete_dip(request, pk):
                 ),
             )
         dip.delete()
+        DIP.wait_for_es(pk)
         return redirection
 
     return render(request, "delete_dip.html", {"form": form, "dip": dip})
@@ -666,28 +926,85 @@ def download_dip(request, pk):
             return response
         except FileNotFoundError:
             raise Http404("DIP file not found.")
+    # Serve from the local cache or fill it for the next downloads
+    if django_settings.SS_DIP_CACHE_SIZE:
+        cached_name = dip_cache.get_cached_name(dip)
+        if cached_name:
+            response = HttpResponse()
+            response["Content-Type"] = "application/x-tar"
+            response["Content-Disposition"] = (
+                'attachment; filename="%s.tar"' % dip.ss_dir_name
+            )
+            response["X-Accel-Redirect"] = "/media/%s" % cached_name
+            return response
+        cache_ss_dip.delay(dip.pk)
     # Proxy stream from the SS
-    if dip.ss_host_url not in django_settings.SS_HOSTS.keys():
-        raise RuntimeError("Configuration not found for SS host: %s" % dip.ss_host_url)
+    client = get_client(dip.ss_host_url)
+    if django_settings.SS_DOWNLOAD_ACCEL_PREFIX:
+        return _get_ss_download_accel_response(dip)
+    # Pass range requests to resume interrupted downloads
     headers = {
-        "Authorization": "ApiKey %s:%s"
-        % (
-            django_settings.SS_HOSTS[dip.ss_host_url]["user"],
-            django_settings.SS_HOSTS[dip.ss_host_url]["secret"],
-        )
+        header: request.META[key]
+        for header, key in [("Range", "HTTP_RANGE"), ("If-Range", "HTTP_IF_RANGE")]
+        if key in request.META
     }
-    stream = requests.get(dip.ss_download_url, headers=headers, stream=True)
-    if stream.status_code != requests.codes.ok:
+    stream = client.get(dip.ss_download_url, headers=headers, stream=True)
+    if stream.status_code == requests.codes.requested_range_not_satisfiable:
+        stream.close()
+        response = HttpResponse(status=stream.status_code)
+        if "Content-Range" in stream.headers:
+            response["Content-Range"] = stream.headers["Content-Range"]
+        return response
+    if stream.status_code not in [requests.codes.ok, requests.codes.partial_content]:
+        stream.close()
         raise Http404("DIP file not found.")
+    response = StreamingHttpResponse(
+        _iter_ss_download(stream), status=stream.status_code
+    )
     # So far, the SS only downloads DIPs as tar files
-    response = StreamingHttpResponse(stream)
     response["Content-Type"] = stream.headers.get("Content-Type", "application/x-tar")
     response["Content-Disposition"] = stream.headers.get(
         "Content-Disposition", 'attachment; filename="%s.tar"' % dip.ss_dir_name
     )
-    content_length = stream.headers.get("Content-Length")
-    if content_length:
-        response["Content-Length"] = content_length
+    for header in ["Content-Length", "Content-Range", "Accept-Ranges"]:
+        if stream.headers.get(header):
+            response[header] = stream.headers[header]
+    # Don't let Nginx buffer the response, so the SS is only read as fast as
+    # the client receives the data.
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+def _iter_ss_download(stream):
+    """Iterate a SS download in chunks, releasing the connection at the end.
+
+    The chunk size is set by the `SS_DOWNLOAD_CHUNK_SIZE` setting, the default
+    `requests` iteration uses 128 bytes chunks.
+    """
+    try:
+        yield from stream.iter_content(django_settings.SS_DOWNLOAD_CHUNK_SIZE)
+    finally:
+        stream.close()
+
+
+def _get_ss_download_accel_response(dip):
+    """Hand a SS download off to Nginx.
+
+    Redirects to the internal location set in the `SS_DOWNLOAD_ACCEL_PREFIX`
+    setting, followed by the scheme, host and path of the download URL. The
+    range requests are handled by Nginx, which also adds the SS credentials
+    from its own configuration, so they are never included in the response.
+    """
+    url = urlparse(dip.ss_download_url)
+    response = HttpResponse()
+    response["Content-Type"] = "application/x-tar"
+    response["Content-Disposition"] = 'attachment; filename="%s.tar"' % dip.ss_dir_name
+    response["X-Accel-Redirect"] = "%s%s/%s%s" % (
+        django_settings.SS_DOWNLOAD_ACCEL_PREFIX,
+        url.scheme,
+        url.netloc,
+        url.path,
+    )
     return response
 
 
@@ -0,0 +1,125 @@
+"""Coalescing of the ES descendants updates of the Collections and DIPs.
+
+With the `ES_DESCENDANTS_UPDATE_DELAY` setting, the `update_es_descendants`
+task is delayed by the given seconds and a pending marker is set for the
+ancestor in the Redis server used as Celery broker, so the updates requested
+meanwhile for the same ancestor are dropped. The task removes the marker
+before reading the ancestor, to apply its latest state, and holds a lock
+while it runs, so the updates of the same ancestor don't overlap. With the
+`ES_UPDATE_BY_QUERY` setting, the update runs in ES after the task ends and
+it's marked as running until `check_es_task` finds it completed, the next
+updates of the ancestor are postponed meanwhile.
+"""
+
+import logging
+from contextlib import contextmanager
+from functools import lru_cache
+
+import redis
+from django.conf import settings
+from redis.exceptions import LockNotOwnedError
+
+from scope.celery import app as celery_app
+
+logger = logging.getLogger("search.coalesce")
+
+
+@lru_cache(maxsize=None)
+def _get_client(url):
+    return redis.Redis.from_url(url)
+
+
+def get_client():
+    """Get a Redis client for the Celery broker, reused in each process."""
+    return _get_client(settings.CELERY_BROKER_URL)
+
+
+def _get_key(class_name, pk):
+    return "scope:es_descendants:%s:%s" % (class_name, pk)
+
+
+def _get_running_key(class_name, pk):
+    return "%s:running" % _get_key(class_name, pk)
+
+
+def _get_timeout():
+    # Tasks running longer than the visibility timeout are redelivered anyway
+    return settings.CELERY_BROKER_TRANSPORT_OPTIONS["visibility_timeout"]
+
+
+def _get_running_timeout():
+    # Refreshed on each check of the ES task, it expires if the checks are lost
+    return settings.ES_TASK_CHECK_INTERVAL + _get_timeout()
+
+
+def request_descendants_update(class_name, pk):
+    """Send the `update_es_descendants` task unless one is already pending.
+
+    Returns `True` if the task was sent. The marker expires if the task is
+    lost, after the delay and the time it may run.
+    """
+    kwargs = {}
+    delay = settings.ES_DESCENDANTS_UPDATE_DELAY
+    if delay:
+        key = _get_key(class_name, pk)
+        if not get_client().set(key, 1, nx=True, ex=delay + _get_timeout()):
+            return False
+        kwargs["countdown"] = delay
+    # Launch async. task by name to avoid circular imports
+    celery_app.send_task(
+        "search.tasks.update_es_descendants", args=(class_name, pk), **kwargs
+    )
+    return True
+
+
+@contextmanager
+def descendants_update(class_name, pk):
+    """Hold the lock of an ancestor and remove its pending marker.
+
+    Yields `True` if the update can run. If the ES task of a previous update
+    is still running, the update is sent again after `ES_TASK_CHECK_INTERVAL`
+    seconds, keeping the marker, and `False` is yielded.
+    """
+    if not settings.ES_DESCENDANTS_UPDATE_DELAY:
+        yield True
+        return
+    client = get_client()
+    key = _get_key(class_name, pk)
+    lock = client.lock("%s:lock" % key, timeout=_get_timeout())
+    lock.acquire()
+    try:
+        if client.exists(_get_running_key(class_name, pk)):
+            client.expire(key, _get_running_timeout())
+            celery_app.send_task(
+                "search.tasks.update_es_descendants",
+                args=(class_name, pk),
+                countdown=settings.ES_TASK_CHECK_INTERVAL,
+            )
+            yield False
+        else:
+            client.delete(key)
+            yield True
+    finally:
+        try:
+            lock.release()
+        except LockNotOwnedError:
+            # The next update may have started already
+            logger.warning(
+                "The lock of %s [id: %s] expired before its descendants update "
+                "finished." % (class_name, pk)
+            )
+
+
+def set_update_running(class_name, pk, running):
+    """Mark the ES task updating the descendants of an ancestor as running.
+
+    Called again while the task is running to extend the mark, and with
+    `running` set to `False` when it's completed.
+    """
+    if not settings.ES_DESCENDANTS_UPDATE_DELAY:
+        return
+    key = _get_running_key(class_name, pk)
+    if running:
+        get_client().set(key, 1, ex=_get_running_timeout())
+    else:
+        get_client().delete(key)
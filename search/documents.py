@@ -65,6 +65,9 @@ class DigitalFileDoc(BaseDoc):
             "title": Text(fields={"raw": Keyword()}),
         }
     )
+    # Version of the ancestors data set by the update by query requests,
+    # which can't set the external version of the documents.
+    _ancestor_version = Long(index=False)
 
     class Index:
         name = "scope_digital_files"
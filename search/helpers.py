@@ -1,5 +1,19 @@
+import hashlib
+import json
+from datetime import datetime
+from datetime import timezone
+
+from elasticsearch.exceptions import ConflictError
+from elasticsearch.helpers import bulk
 from elasticsearch_dsl.connections import connections
 
+# Version type of the documents writes. Writes with the same version as the
+# indexed document are accepted, as they're made from the same rows, to not
+# fail when a document is written again or repaired.
+VERSION_TYPE = "external_gte"
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
 
 def delete_document(index, id):
     """
@@ -10,6 +24,171 @@ def delete_document(index, id):
     es.delete(index=index, id=id, refresh=True)
 
 
+def save_document(doc, refresh=True):
+    """Index a Document with the external version set in its meta data.
+
+    Returns `False` if the write was rejected because a newer version of
+    the document is already indexed.
+    """
+    kwargs = {
+        key: doc.meta[key] for key in ("version", "version_type") if key in doc.meta
+    }
+    try:
+        doc.save(refresh=refresh, **kwargs)
+    except ConflictError:
+        return False
+    return True
+
+
+def bulk_index_documents(index, documents):
+    """Index documents with the bulk API and refresh the index once at the end.
+
+    The documents can be a generator of dictionaries with the `_id` and the
+    document fields, it will be consumed in chunks. Delete actions, with the
+    `_op_type` set to "delete", are also accepted and missing documents are
+    ignored, like the documents rejected because a newer version is already
+    indexed. Raises `BulkIndexError` if any of the documents could not be
+    indexed. Returns the success count.
+    """
+    es = connections.get_connection()
+    success_count, _ = bulk(es, documents, index=index, ignore_status=(404, 409))
+    refresh_index(index)
+    return success_count
+
+
+def write_documents(index, documents, refresh=False):
+    """Index or delete documents with the bulk API without forcing a refresh.
+
+    Like `bulk_index_documents`, but the changes are visible after the next
+    scheduled refresh of the index, or when the request returns if `refresh`
+    is set to "wait_for". Returns the success count.
+    """
+    es = connections.get_connection()
+    success_count, _ = bulk(
+        es, documents, index=index, ignore_status=(404, 409), refresh=refresh
+    )
+    return success_count
+
+
+def refresh_index(index):
+    """Refresh an index to make the changes written without refresh visible."""
+    connections.get_connection().indices.refresh(index=index)
+
+
+def get_version(*datetimes):
+    """Get the external version of a document from modification times.
+
+    The version is the latest modification time of the rows the document
+    data is built from, in microseconds since the epoch, so ES rejects the
+    writes of data older than the indexed one. Returns `None` if none of the
+    modification times is set, e.g. for unsaved instances.
+    """
+    datetimes = [value for value in datetimes if value is not None]
+    if not datetimes:
+        return None
+    delta = max(datetimes) - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def add_version(data, *datetimes):
+    """Add the external version and version type to the data of a document."""
+    version = get_version(*datetimes)
+    if version is not None:
+        data["_version"] = version
+        data["_version_type"] = VERSION_TYPE
+
+
+def get_fingerprint(data):
+    """Get a hash of the canonical JSON representation of a document.
+
+    The data is serialized like in the ES requests and the empty values are
+    skipped, like `Document.save` does, so the data generated for a model
+    instance and the source of its document in ES match when they are equal.
+    The metadata, like the `_id` and `_version`, is not included.
+    """
+    es = connections.get_connection()
+    data = {key: value for key, value in data.items() if not key.startswith("_")}
+    data = _skip_empty(json.loads(es.transport.serializer.dumps(data)))
+    canonical = json.dumps(data, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(canonical.encode("utf-8")).hexdigest()
+
+
+def _skip_empty(data):
+    """Remove the empty values from the dictionaries within the data."""
+    if isinstance(data, list):
+        return [_skip_empty(value) for value in data]
+    if not isinstance(data, dict):
+        return data
+    result = {}
+    for key, value in data.items():
+        value = _skip_empty(value)
+        if value not in ([], {}, None):
+            result[key] = value
+    return result
+
+
+def get_versioned_indexes(alias):
+    """Get the versioned indexes of an alias and the one it points to.
+
+    The versioned indexes are named after the alias with a timestamp suffix
+    and they are returned sorted from oldest to newest. The current index is
+    `None` if the alias doesn't exist.
+    """
+    es = connections.get_connection()
+    names = sorted(es.indices.get(index="%s_*" % alias, ignore_unavailable=True))
+    aliased = es.indices.get_alias(name=alias, ignore=404)
+    current = next((name for name in names if name in aliased), None)
+    return names, current
+
+
+def switch_alias(alias, index_name):
+    """Point an alias to the given index in a single atomic request.
+
+    The alias is removed from any other index. An existing index with the
+    alias name, created before the aliases were used, is deleted in the same
+    request.
+    """
+    es = connections.get_connection()
+    actions = [{"add": {"index": index_name, "alias": alias}}]
+    if es.indices.exists_alias(name=alias):
+        for name in es.indices.get_alias(name=alias):
+            actions.insert(0, {"remove": {"index": name, "alias": alias}})
+    elif es.indices.exists(index=alias):
+        actions.insert(0, {"remove_index": {"index": alias}})
+    es.indices.update_aliases(body={"actions": actions})
+
+
+def rollback_alias(alias):
+    """Point an alias back to the previous versioned index.
+
+    The index the alias pointed to is deleted. Returns the name of the
+    previous index and raises `ValueError` if there is none.
+    """
+    names, current = get_versioned_indexes(alias)
+    if current is None or names.index(current) == 0:
+        raise ValueError("No previous index found for alias: %s" % alias)
+    previous = names[names.index(current) - 1]
+    switch_alias(alias, previous)
+    connections.get_connection().indices.delete(index=current)
+    return previous
+
+
+def prune_versioned_indexes(alias):
+    """Delete the versioned indexes of an alias not needed for a rollback.
+
+    Keeps the index the alias points to and the previous one.
+    """
+    names, current = get_versioned_indexes(alias)
+    if current is None:
+        return []
+    position = names.index(current)
+    keep = names[max(position - 1, 0) : position + 1]
+    deleted = [name for name in names if name not in keep]
+    if deleted:
+        connections.get_connection().indices.delete(index=",".join(deleted))
+    return deleted
+
+
 def add_query_to_search(search, query, fields):
     """
     Check if a query is not whitespace and add a `simple_query_string`
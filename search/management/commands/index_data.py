@@ -1,46 +1,278 @@
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from datetime import datetime
+from datetime import time
+
 from django.conf import settings
 from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from django.utils.dateparse import parse_datetime
+from elasticsearch.helpers import bulk
 from elasticsearch.helpers import streaming_bulk
 from elasticsearch_dsl import analyzer
 from elasticsearch_dsl.connections import connections
 from tqdm import tqdm
 
+from scope.helpers import iter_batches
 from scope.models import DIP
 from scope.models import Collection
 from scope.models import DigitalFile
+from search.helpers import prune_versioned_indexes
+from search.helpers import rollback_alias
+from search.helpers import switch_alias
+from search.reconcile import find_orphans
 
 # Tuples with display name and models to index in ES.
 MODELS = [("collections", Collection), ("folders", DIP), ("digital files", DigitalFile)]
 
 
+def _parallel_bulk(es, documents, workers, chunk_size, **kwargs):
+    """Send the documents in bulk requests from a pool of threads.
+
+    The documents are read in chunks in the calling thread, as the database
+    connections can't be shared between threads, keeping up to two chunks per
+    worker in memory. Yields the number of documents indexed in each chunk and
+    raises `BulkIndexError` if any of them could not be indexed.
+    """
+    with ThreadPoolExecutor(workers) as executor:
+        futures = set()
+        for chunk in iter_batches(documents, chunk_size):
+            if len(futures) >= workers * 2:
+                done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()[0]
+            futures.add(
+                executor.submit(bulk, es, chunk, chunk_size=chunk_size, **kwargs)
+            )
+        for future in futures:
+            yield future.result()[0]
+
+
+def _parse_since(value):
+    """Parse an ISO date or datetime, in the current time zone if naive."""
+    since = parse_datetime(value)
+    if since is None:
+        date = parse_date(value)
+        if date is None:
+            raise ValueError("Invalid date or datetime: %s" % value)
+        since = datetime.combine(date, time.min)
+    if timezone.is_naive(since):
+        since = timezone.make_aware(since)
+    return since
+
+
+def get_queryset(model, collection=None, dip=None, since=None):
+    """Get the rows of a model within a Collection or DIP, or modified since.
+
+    The DigitalFiles are also included when their DIP or Collection have been
+    modified, as their documents contain the ancestors data.
+    """
+    queryset = model.objects.all()
+    if model is Collection:
+        if dip is not None:
+            return queryset.none()
+        if collection is not None:
+            queryset = queryset.filter(pk=collection)
+        if since is not None:
+            queryset = queryset.filter(modified__gte=since)
+    elif model is DIP:
+        if collection is not None:
+            queryset = queryset.filter(collection_id=collection)
+        if dip is not None:
+            queryset = queryset.filter(pk=dip)
+        if since is not None:
+            queryset = queryset.filter(modified__gte=since)
+    else:
+        if collection is not None:
+            queryset = queryset.filter(dip__collection_id=collection)
+        if dip is not None:
+            queryset = queryset.filter(dip_id=dip)
+        if since is not None:
+            queryset = queryset.filter(
+                Q(modified__gte=since)
+                | Q(dip__modified__gte=since)
+                | Q(dip__collection__modified__gte=since)
+            )
+    return queryset
+
+
 class Command(BaseCommand):
-    def handle(self, *args, **kwargs):
+    help = (
+        "Index all the data in new ES indexes, switching their aliases when "
+        "finished, or update part of the data in the current indexes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--models",
+            nargs="+",
+            choices=[name.replace(" ", "_") for name, _ in MODELS],
+            help="Only process these models.",
+        )
+        parser.add_argument(
+            "--collection",
+            type=int,
+            help="Update a Collection and its descendants in the current indexes.",
+        )
+        parser.add_argument(
+            "--dip",
+            type=int,
+            help="Update a DIP and its DigitalFiles in the current indexes.",
+        )
+        parser.add_argument(
+            "--since",
+            type=_parse_since,
+            help=(
+                "Update the data modified since an ISO date or datetime in the "
+                "current indexes."
+            ),
+        )
+        parser.add_argument(
+            "--rollback",
+            action="store_true",
+            help=(
+                "Point the aliases back to the previous indexes, deleting the "
+                "current ones."
+            ),
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Number of threads sending the bulk requests in parallel.",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=500,
+            help="Number of documents sent in each bulk request.",
+        )
+        parser.add_argument(
+            "--max-chunk-bytes",
+            type=int,
+            default=104857600,
+            help="Maximum size in bytes of each bulk request.",
+        )
+        parser.add_argument(
+            "--force-merge",
+            action="store_true",
+            help="Merge each new index into a single segment after indexing.",
+        )
+
+    def handle(self, *args, **options):
         es = connections.get_connection()
+        scope = {key: options[key] for key in ("collection", "dip", "since")}
         for name, model in MODELS:
-            print("Processing %s:" % name)
-            document = model.es_doc
-            index = document._index
-            index.settings(**settings.ES_INDEXES_SETTINGS)
-            # Use English analizer by default, other analyzers may be
-            # defined in the documents declaration for specific fields.
-            index.analyzer(analyzer("default", "english"))
-            print(" - Deleting index.")
-            index.delete(ignore=404)
-            print(" - Creating index.")
-            index.create()
-            total = model.objects.count()
-            if total == 0:
-                print(" - No %s to index." % name)
+            if options["models"] and name.replace(" ", "_") not in options["models"]:
                 continue
-            progress_bar = tqdm(
-                total=total,
-                bar_format=" - Indexing: {n_fmt}/{total_fmt} [{elapsed} < {remaining}]",
-                ncols=1,  # required to show the custom bar_format
+            print("Processing %s:" % name)
+            alias = model.es_doc._index._name
+            if options["rollback"]:
+                try:
+                    previous = rollback_alias(alias)
+                except ValueError as error:
+                    raise CommandError(error)
+                print(" - Switched alias to %s." % previous)
+            elif any(value is not None for value in scope.values()):
+                queryset = get_queryset(model, **scope)
+                if self._index_queryset(es, name, model, queryset, alias, options):
+                    es.indices.refresh(index=alias)
+            else:
+                self._rebuild_index(es, name, model, alias, options)
+
+    def _rebuild_index(self, es, name, model, alias, options):
+        """Index all the rows of a model in a new index and switch the alias.
+
+        The new index is filled without refresh and replicas. The documents of
+        the rows deleted while indexing are removed before switching the alias,
+        the rows modified while indexing are updated again after switching it,
+        and the indexes older than the previous one are deleted.
+        """
+        started = timezone.now()
+        index = model.es_doc._index.clone(
+            name="%s_%s" % (alias, started.strftime("%Y%m%d%H%M%S"))
+        )
+        index_settings = dict(settings.ES_INDEXES_SETTINGS)
+        index_settings.update(refresh_interval="-1", number_of_replicas=0)
+        index.settings(**index_settings)
+        # Use English analizer by default, other analyzers may be
+        # defined in the documents declaration for specific fields.
+        index.analyzer(analyzer("default", "english"))
+        print(" - Creating index %s." % index._name)
+        index.create()
+        try:
+            self._index_queryset(
+                es, name, model, model.objects.all(), index._name, options
             )
-            for _ in streaming_bulk(
-                es,
-                (obj.get_es_data() for obj in model.objects.all().iterator()),
+            if options["force_merge"]:
+                # Merge before adding the replicas, so they copy the merged segments
+                print(" - Merging segments.")
+                es.indices.refresh(index=index._name)
+                es.indices.forcemerge(index=index._name, max_num_segments=1)
+            print(" - Restoring refresh and replicas.")
+            es.indices.put_settings(
                 index=index._name,
-            ):
+                body={
+                    "index": {
+                        "refresh_interval": None,
+                        "number_of_replicas": settings.ES_INDEXES_SETTINGS[
+                            "number_of_replicas"
+                        ],
+                    }
+                },
+            )
+            es.indices.refresh(index=index._name)
+            # Remove the documents of the rows deleted while indexing
+            orphans = sum(1 for _ in find_orphans(model, index._name, fix=True))
+            if orphans:
+                print(" - Deleted %d %s removed while indexing." % (orphans, name))
+                es.indices.refresh(index=index._name)
+        except BaseException:
+            # Keep using the current index
+            print(" - Deleting index %s." % index._name)
+            index.delete(ignore=404)
+            raise
+        print(" - Switching alias.")
+        switch_alias(alias, index._name)
+        queryset = get_queryset(model, since=started)
+        if queryset.exists():
+            print(" - Updating %s modified while indexing." % name)
+            self._index_queryset(es, name, model, queryset, alias, options)
+            es.indices.refresh(index=alias)
+        for deleted in prune_versioned_indexes(alias):
+            print(" - Deleted old index %s." % deleted)
+
+    def _index_queryset(self, es, name, model, queryset, index_name, options):
+        """Index or replace the documents of a queryset in the given index.
+
+        Returns the number of documents indexed.
+        """
+        total = queryset.count()
+        if total == 0:
+            print(" - No %s to index." % name)
+            return 0
+        progress_bar = tqdm(
+            total=total,
+            bar_format=" - Indexing: {n_fmt}/{total_fmt} [{elapsed} < {remaining}]",
+            ncols=1,  # required to show the custom bar_format
+        )
+        documents = model.iter_es_data(queryset)
+        kwargs = {
+            "index": index_name,
+            "chunk_size": options["chunk_size"],
+            "max_chunk_bytes": options["max_chunk_bytes"],
+            # Ignore the documents already indexed with a newer version
+            "ignore_status": (409,),
+        }
+        if options["workers"] > 1:
+            for count in _parallel_bulk(es, documents, options["workers"], **kwargs):
+                progress_bar.update(count)
+        else:
+            for _ in streaming_bulk(es, documents, **kwargs):
                 progress_bar.update(1)
-            progress_bar.close()
+        progress_bar.close()
+        return total
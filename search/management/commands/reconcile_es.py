@@ -0,0 +1,57 @@
+from collections import Counter
+
+from django.core.management.base import BaseCommand
+
+from search.management.commands.index_data import MODELS
+from search.reconcile import BATCH_SIZE
+from search.reconcile import MISSING
+from search.reconcile import ORPHANED
+from search.reconcile import STALE
+from search.reconcile import get_counts
+from search.reconcile import reconcile
+
+
+class Command(BaseCommand):
+    help = (
+        "Find the ES documents missing, stale or orphaned compared to the "
+        "database, and optionally fix them."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--models",
+            nargs="+",
+            choices=[name.replace(" ", "_") for name, _ in MODELS],
+            help="Only process these models.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=BATCH_SIZE,
+            help="Number of rows and documents compared in each batch.",
+        )
+        parser.add_argument(
+            "--fix",
+            action="store_true",
+            help="Index the missing and stale documents and delete the orphaned.",
+        )
+
+    def handle(self, *args, **options):
+        for name, model in MODELS:
+            if options["models"] and name.replace(" ", "_") not in options["models"]:
+                continue
+            print("Processing %s:" % name)
+            print(" - Database rows: %d, index documents: %d." % get_counts(model))
+            counts = Counter()
+            for status, id in reconcile(model, options["batch_size"], options["fix"]):
+                print(" - %s: %s" % (status.capitalize(), id))
+                counts[status] += 1
+            print(
+                " - %d missing, %d stale and %d orphaned documents%s."
+                % (
+                    counts[MISSING],
+                    counts[STALE],
+                    counts[ORPHANED],
+                    " fixed" if options["fix"] else "",
+                )
+            )
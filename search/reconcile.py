@@ -0,0 +1,121 @@
+"""Detection and repair of the differences between the database and ES.
+
+The rows of a model are read in batches ordered by primary key and the
+documents of each batch are fetched from its index with a single `mget`
+request. The documents are compared by fingerprint, a hash of their canonical
+JSON data, to find the missing and stale ones. Then, the index is scrolled to
+find the orphaned documents, checking their ids against the database for each
+page. Only a batch of rows or documents is kept in memory at a time.
+"""
+
+from elasticsearch.helpers import bulk
+from elasticsearch.helpers import scan
+from elasticsearch_dsl.connections import connections
+
+from scope.helpers import iter_batches
+from search.helpers import get_fingerprint
+
+# Document statuses
+MISSING = "missing"
+STALE = "stale"
+ORPHANED = "orphaned"
+
+BATCH_SIZE = 1000
+
+
+def get_counts(model):
+    """Get the number of rows of a model and the documents in its index."""
+    es = connections.get_connection()
+    count = es.count(index=model.es_doc._index._name)["count"]
+    return model.objects.count(), count
+
+
+def reconcile(model, batch_size=BATCH_SIZE, fix=False):
+    """Yield the status and id of the documents that differ from the rows.
+
+    The status is `MISSING` for the rows without document, `STALE` for the
+    documents with different data and `ORPHANED` for the documents without
+    row. If `fix` is set, the documents of each batch are indexed or deleted
+    in bulk after they're yielded, and the index is refreshed at the end.
+    """
+    es = connections.get_connection()
+    index = model.es_doc._index._name
+    fixed = False
+    for pks in _iter_pk_batches(model.objects.all(), batch_size):
+        expected = {
+            str(data["_id"]): get_fingerprint(data)
+            for data in model.iter_es_data(model.objects.filter(pk__in=pks))
+        }
+        response = es.mget(index=index, body={"ids": list(expected)})
+        found = {
+            doc["_id"]: get_fingerprint(doc["_source"])
+            for doc in response["docs"]
+            if doc["found"]
+        }
+        if found == expected:
+            continue
+        ids = []
+        for id, fingerprint in expected.items():
+            if id not in found:
+                yield MISSING, id
+            elif found[id] != fingerprint:
+                yield STALE, id
+            else:
+                continue
+            ids.append(id)
+        if fix and ids:
+            # Get the data again and ignore the version conflicts, to not
+            # overwrite the changes made meanwhile
+            bulk(
+                es,
+                model.iter_es_data(model.objects.filter(pk__in=ids)),
+                index=index,
+                ignore_status=(409,),
+            )
+            fixed = True
+    for id in find_orphans(model, index, batch_size, fix):
+        yield ORPHANED, id
+        fixed = fixed or fix
+    if fixed:
+        es.indices.refresh(index=index)
+
+
+def find_orphans(model, index=None, batch_size=BATCH_SIZE, fix=False):
+    """Yield the ids of the documents without row in an index of a model.
+
+    The index is scrolled and the ids of each page are checked against the
+    database. The index of the model is used unless another one is given.
+    If `fix` is set, the orphaned documents of each page are deleted in bulk
+    after they're yielded, without refreshing the index.
+    """
+    es = connections.get_connection()
+    if index is None:
+        index = model.es_doc._index._name
+    hits = scan(es, index=index, query={"_source": False}, size=batch_size)
+    for batch in iter_batches(hits, batch_size):
+        ids = [hit["_id"] for hit in batch]
+        existing = model.objects.filter(pk__in=ids).values_list("pk", flat=True)
+        existing = {str(pk) for pk in existing}
+        orphans = [id for id in ids if id not in existing]
+        yield from orphans
+        if fix and orphans:
+            bulk(
+                es,
+                ({"_op_type": "delete", "_id": id} for id in orphans),
+                index=index,
+                ignore_status=(404,),
+            )
+
+
+def _iter_pk_batches(queryset, batch_size):
+    """Yield lists with the primary keys of a QuerySet in ascending order.
+
+    Each batch is queried on its own, starting after the last primary key of
+    the previous batch, to avoid keeping a cursor open on the database.
+    """
+    queryset = queryset.order_by("pk")
+    pks = list(queryset.values_list("pk", flat=True)[:batch_size])
+    while pks:
+        yield pks
+        pks = queryset.filter(pk__gt=pks[-1]).values_list("pk", flat=True)
+        pks = list(pks[:batch_size])
@@ -1,20 +1,36 @@
 import logging
+from collections import Counter
+from collections import defaultdict
 
 from celery import shared_task
+from django.conf import settings
 from django.db.utils import DatabaseError
 from elasticsearch.exceptions import TransportError
-from elasticsearch.helpers import bulk
 from elasticsearch_dsl.connections import connections
 
 from scope.models import DIP
 from scope.models import Collection
 from scope.models import DigitalFile
+from scope.models import EsOutbox
+from search.coalesce import descendants_update
+from search.coalesce import request_descendants_update
+from search.coalesce import set_update_running
+from search.helpers import get_version
+from search.helpers import write_documents
+from search.reconcile import MISSING
+from search.reconcile import ORPHANED
+from search.reconcile import STALE
+from search.reconcile import get_counts
+from search.reconcile import reconcile
 
 # Use a normal logger to avoid redirecting both `stdout` and `stderr` to the
 # logger and back when using Celery's `get_task_logger`, and to avoid changing
 # the default `CELERY_REDIRECT_STDOUTS_LEVEL` when using `print`.
 logger = logging.getLogger("search.tasks")
 
+# Number of outbox entries applied in each batch
+OUTBOX_BATCH_SIZE = 1000
+
 
 @shared_task(
     autoretry_for=(TransportError, DatabaseError),
@@ -25,65 +41,145 @@ logger = logging.getLogger("search.tasks")
 def update_es_descendants(class_name, pk):
     """Update the related DigitalFiles documents in ES.
 
-    With the partial data from the ancestor Collection or DIP.
+    With the partial data from the ancestor Collection or DIP. If the
+    `ES_UPDATE_BY_QUERY` setting is enabled, a single sliced update by query
+    request is sent and ES runs it in the background, which is followed by
+    `check_es_task`. Otherwise, the DigitalFiles documents are indexed again
+    in bulk, with their external version, which can't be set in updates.
+    The updates of the same ancestor are coalesced and run one at a time with
+    the `ES_DESCENDANTS_UPDATE_DELAY` setting, see `search.coalesce`.
     """
     if class_name not in ["Collection", "DIP"]:
         raise ValueError("Can not update descendants of %s." % class_name)
+    with descendants_update(class_name, pk) as ready:
+        if ready:
+            _update_es_descendants(class_name, pk)
+
+
+def _update_es_descendants(class_name, pk):
     logger.info("Updating DigitalFiles of %s [id: %s] " % (class_name, pk))
+    if not settings.ES_UPDATE_BY_QUERY:
+        if class_name == "Collection":
+            queryset = DigitalFile.objects.filter(dip__collection__pk=pk)
+        else:
+            queryset = DigitalFile.objects.filter(dip__pk=pk)
+        # Documents with a newer version, written meanwhile, are not replaced
+        count = write_documents(
+            DigitalFile.es_doc._index._name, DigitalFile.iter_es_data(queryset)
+        )
+        logger.info("%d/%d DigitalFiles updated." % (count, queryset.count()))
+        return
     if class_name == "Collection":
         collection = Collection.objects.get(pk=pk)
+        params = {
+            "collection": collection.get_es_data_for_files(),
+            "version": get_version(collection.modified),
+        }
         # Partial update with `doc` doesn't remove the fields missing in data,
         # they have to be removed via script to clear the existing value,
         # `script` and `doc` can't be combined in update actions, therefore
         # it's required to generate a Painless script to perform the update.
-        script = {
-            "source": "ctx._source.collection = params.collection;",
-            "lang": "painless",
-            "params": {"collection": collection.get_es_data_for_files()},
-        }
-        file_uuids = DigitalFile.objects.filter(dip__collection__pk=pk).values_list(
-            "uuid", flat=True
-        )
+        source = "ctx._source.collection = params.collection;"
+        field = "collection.id"
     else:
         dip = DIP.objects.get(pk=pk)
-        data_params = {"dip": dip.get_es_data_for_files()}
+        params = {"dip": dip.get_es_data_for_files()}
+        modified = [dip.modified]
         if dip.collection:
-            data_params["collection"] = dip.collection.get_es_data_for_files()
-        script = {
-            "source": """
-                ctx._source.dip = params.dip;
-                if (params.containsKey('collection')) {
-                  ctx._source.collection = params.collection;
-                } else {
-                  ctx._source.remove('collection');
-                }
-            """,
-            "lang": "painless",
-            "params": data_params,
-        }
-        file_uuids = DigitalFile.objects.filter(dip__pk=pk).values_list(
-            "uuid", flat=True
-        )
+            params["collection"] = dip.collection.get_es_data_for_files()
+            modified.append(dip.collection.modified)
+        params["version"] = get_version(*modified)
+        source = """
+            ctx._source.dip = params.dip;
+            if (params.containsKey('collection')) {
+              ctx._source.collection = params.collection;
+            } else {
+              ctx._source.remove('collection');
+            }
+        """
+        field = "dip.id"
+    # The updates can't set the external version, which is increased by one
+    # instead, so the version of the ancestors data is kept in the document.
+    # Skip the documents indexed or updated with the same or newer data.
+    script = {
+        "source": """
+            def applied = ctx._source.getOrDefault('_ancestor_version', 0);
+            if (ctx._version >= params.version || applied >= params.version) {
+              ctx.op = 'noop';
+            } else {
+              ctx._source['_ancestor_version'] = params.version;
+              %s
+            }
+        """
+        % source,
+        "lang": "painless",
+        "params": params,
+    }
     # Get connection to ES
     es = connections.get_connection()
-    # Bulk update with partial data
-    success_count, errors = bulk(
-        es,
-        (
-            {
-                "_op_type": "update",
-                "_index": DigitalFile.es_doc._index._name,
-                "_id": uuid,
-                "script": script,
-            }
-            for uuid in file_uuids
-        ),
+    # Conflicts with concurrent writes don't abort the task, the documents
+    # are updated again when it's completed, see `check_es_task`.
+    response = es.update_by_query(
+        index=DigitalFile.es_doc._index._name,
+        body={"query": {"match": {field: pk}}, "script": script},
+        slices="auto",
+        conflicts="proceed",
+        wait_for_completion=False,
+    )
+    logger.info("Update by query task started: %s" % response["task"])
+    set_update_running(class_name, pk, True)
+    check_es_task.apply_async(
+        (response["task"], class_name, pk), countdown=settings.ES_TASK_CHECK_INTERVAL
+    )
+
+
+@shared_task(
+    autoretry_for=(TransportError,),
+    max_retries=10,
+    default_retry_delay=30,
+    ignore_result=True,
+)
+def check_es_task(task_id, class_name=None, pk=None):
+    """Report the progress and result of an ES background task.
+
+    The task is checked again after the `ES_TASK_CHECK_INTERVAL` setting
+    seconds, logging its progress, until it's completed. Then, the result
+    and the errors encountered are logged. For the update by query tasks of
+    an ancestor, the task is marked as running until it's completed, see
+    `search.coalesce`, and the descendants update is requested again if
+    there were version conflicts, to update the documents skipped by it.
+    """
+    es = connections.get_connection()
+    task = es.tasks.get(task_id=task_id)
+    status = task["task"]["status"]
+    if not task["completed"]:
+        logger.info(
+            "ES task %s in progress: %d/%d documents updated."
+            % (task_id, status["updated"], status["total"])
+        )
+        if class_name:
+            set_update_running(class_name, pk, True)
+        # Queue a new check, a retry would be limited by `max_retries`
+        check_es_task.apply_async(
+            (task_id, class_name, pk), countdown=settings.ES_TASK_CHECK_INTERVAL
+        )
+        return
+    logger.info(
+        "ES task %s completed: %d/%d documents updated, %d version conflicts."
+        % (task_id, status["updated"], status["total"], status["version_conflicts"])
     )
-    logger.info("%d/%d DigitalFiles updated." % (success_count, len(file_uuids)))
+    errors = task.get("response", {}).get("failures", [])
+    if "error" in task:
+        errors.append(task["error"])
     if len(errors) > 0:
         logger.info("The following errors were encountered:")
         for error in errors:
             logger.info("- %s" % error)
+    if not class_name:
+        return
+    set_update_running(class_name, pk, False)
+    if status["version_conflicts"]:
+        request_descendants_update(class_name, pk)
 
 
 @shared_task(
@@ -112,3 +208,81 @@ def delete_es_descendants(class_name, pk):
         logger.info("The following errors were encountered:")
         for error in response["failures"]:
             logger.info("- %s" % error)
+
+
+@shared_task(
+    autoretry_for=(TransportError, DatabaseError),
+    max_retries=3,
+    default_retry_delay=300,
+    ignore_result=True,
+)
+def reconcile_es(fix=False):
+    """Find the ES documents that differ from the database and fix them.
+
+    Logs the rows and documents counts and the missing, stale and orphaned
+    documents of each index, which are fixed in bulk if `fix` is set. Run
+    periodically when the `ES_RECONCILE_INTERVAL` setting is set.
+    """
+    for model in [Collection, DIP, DigitalFile]:
+        name = model.__name__
+        logger.info("%s: %d rows, %d documents." % ((name,) + get_counts(model)))
+        counts = Counter()
+        for status, id in reconcile(model, fix=fix):
+            logger.debug("%s document %s: %s" % (name, status, id))
+            counts[status] += 1
+        if not counts:
+            continue
+        logger.warning(
+            "%s: %d missing, %d stale and %d orphaned documents%s."
+            % (
+                name,
+                counts[MISSING],
+                counts[STALE],
+                counts[ORPHANED],
+                " fixed" if fix else "",
+            )
+        )
+
+
+@shared_task(
+    autoretry_for=(TransportError, DatabaseError),
+    max_retries=10,
+    default_retry_delay=30,
+    ignore_result=True,
+)
+def drain_es_outbox():
+    """Apply the ES operations recorded in the outbox, in batches.
+
+    The entries of each batch are coalesced: each document is written once,
+    with the current data from the database in a single bulk request per
+    index, and the descendants of each ancestor are updated or deleted once,
+    in their own tasks. The entries are removed after they're applied, so
+    the operations of a failed batch are applied by the next drain.
+    """
+    models = {model.__name__: model for model in [Collection, DIP, DigitalFile]}
+    while True:
+        entries = list(EsOutbox.objects.order_by("pk")[:OUTBOX_BATCH_SIZE])
+        if not entries:
+            return
+        pks = defaultdict(set)
+        descendants = {}
+        for entry in entries:
+            if entry.operation == EsOutbox.SYNC:
+                pks[entry.model_name].add(entry.object_id)
+                continue
+            key = (entry.model_name, entry.object_id)
+            # The descendants are not updated when they have been deleted
+            if descendants.get(key) != EsOutbox.DELETE_DESCENDANTS:
+                descendants[key] = entry.operation
+        for model_name, model_pks in pks.items():
+            model = models[model_name]
+            count = write_documents(
+                model.es_doc._index._name, model.iter_es_sync_data(model_pks)
+            )
+            logger.info("%d %s documents synced." % (count, model_name))
+        for (model_name, pk), operation in descendants.items():
+            if operation == EsOutbox.DELETE_DESCENDANTS:
+                delete_es_descendants.delay(model_name, int(pk))
+            else:
+                request_descendants_update(model_name, int(pk))
+        EsOutbox.objects.filter(pk__in=[entry.pk for entry in entries]).delete()
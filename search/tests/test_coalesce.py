@@ -0,0 +1,95 @@
+from unittest.mock import patch
+
+from django.test import SimpleTestCase
+from django.test import override_settings
+from redis.exceptions import LockNotOwnedError
+
+from search.coalesce import descendants_update
+from search.coalesce import request_descendants_update
+from search.coalesce import set_update_running
+
+
+@patch("search.coalesce.celery_app.send_task")
+@patch("search.coalesce.get_client")
+class CoalesceTests(SimpleTestCase):
+    def test_request_without_delay(self, mock_get_client, mock_send_task):
+        self.assertTrue(request_descendants_update("DIP", 1))
+        mock_get_client.assert_not_called()
+        mock_send_task.assert_called_once_with(
+            "search.tasks.update_es_descendants", args=("DIP", 1)
+        )
+
+    @override_settings(
+        ES_DESCENDANTS_UPDATE_DELAY=5,
+        CELERY_BROKER_TRANSPORT_OPTIONS={"visibility_timeout": 60},
+    )
+    def test_request_with_delay(self, mock_get_client, mock_send_task):
+        mock_set = mock_get_client.return_value.set
+        mock_set.side_effect = [True, None]
+        self.assertTrue(request_descendants_update("DIP", 1))
+        # The second request is dropped while the first one is pending
+        self.assertFalse(request_descendants_update("DIP", 1))
+        mock_set.assert_called_with("scope:es_descendants:DIP:1", 1, nx=True, ex=65)
+        mock_send_task.assert_called_once_with(
+            "search.tasks.update_es_descendants", args=("DIP", 1), countdown=5
+        )
+
+    @override_settings(
+        ES_DESCENDANTS_UPDATE_DELAY=5,
+        CELERY_BROKER_TRANSPORT_OPTIONS={"visibility_timeout": 60},
+    )
+    def test_descendants_update(self, mock_get_client, mock_send_task):
+        client = mock_get_client.return_value
+        client.exists.return_value = False
+        with descendants_update("Collection", 2) as ready:
+            self.assertTrue(ready)
+            # The marker is removed holding the lock
+            client.lock.assert_called_once_with(
+                "scope:es_descendants:Collection:2:lock", timeout=60
+            )
+            client.lock.return_value.acquire.assert_called_once()
+            client.exists.assert_called_once_with(
+                "scope:es_descendants:Collection:2:running"
+            )
+            client.delete.assert_called_once_with("scope:es_descendants:Collection:2")
+        client.lock.return_value.release.assert_called_once()
+        mock_send_task.assert_not_called()
+
+    @override_settings(
+        ES_DESCENDANTS_UPDATE_DELAY=5,
+        ES_TASK_CHECK_INTERVAL=10,
+        CELERY_BROKER_TRANSPORT_OPTIONS={"visibility_timeout": 60},
+    )
+    def test_descendants_update_running(self, mock_get_client, mock_send_task):
+        client = mock_get_client.return_value
+        client.exists.return_value = True
+        client.lock.return_value.release.side_effect = LockNotOwnedError
+        with self.assertLogs("search.coalesce", "WARNING"):
+            with descendants_update("DIP", 1) as ready:
+                self.assertFalse(ready)
+        # The update is postponed while the previous ES task runs
+        client.delete.assert_not_called()
+        client.expire.assert_called_once_with("scope:es_descendants:DIP:1", 70)
+        mock_send_task.assert_called_once_with(
+            "search.tasks.update_es_descendants", args=("DIP", 1), countdown=10
+        )
+
+    @override_settings(
+        ES_DESCENDANTS_UPDATE_DELAY=5,
+        ES_TASK_CHECK_INTERVAL=10,
+        CELERY_BROKER_TRANSPORT_OPTIONS={"visibility_timeout": 60},
+    )
+    def test_set_update_running(self, mock_get_client, mock_send_task):
+        client = mock_get_client.return_value
+        set_update_running("DIP", 1, True)
+        client.set.assert_called_once_with(
+            "scope:es_descendants:DIP:1:running", 1, ex=70
+        )
+        set_update_running("DIP", 1, False)
+        client.delete.assert_called_once_with("scope:es_descendants:DIP:1:running")
+
+    def test_descendants_update_without_delay(self, mock_get_client, mock_send_task):
+        with descendants_update("Collection", 2) as ready:
+            self.assertTrue(ready)
+        set_update_running("Collection", 2, True)
+        mock_get_client.assert_not_called()
@@ -1,9 +1,23 @@
+from datetime import datetime
+from datetime import timezone
+from unittest.mock import patch
+
 from django.test import TestCase
+from elasticsearch.exceptions import ConflictError
 
 from scope.models import DigitalFile
 from search.helpers import add_digital_file_aggs
 from search.helpers import add_digital_file_filters
 from search.helpers import add_query_to_search
+from search.helpers import add_version
+from search.helpers import bulk_index_documents
+from search.helpers import get_fingerprint
+from search.helpers import get_version
+from search.helpers import get_versioned_indexes
+from search.helpers import prune_versioned_indexes
+from search.helpers import rollback_alias
+from search.helpers import save_document
+from search.helpers import switch_alias
 
 
 class FunctionsTests(TestCase):
@@ -11,6 +25,148 @@ class FunctionsTests(TestCase):
         self.search = DigitalFile.es_doc.search()
         self.query_fields = ["filepath", "fileformat"]
 
+    @patch("elasticsearch.client.IndicesClient.refresh")
+    @patch("search.helpers.bulk", return_value=(2, []))
+    def test_bulk_index_documents(self, mock_bulk, mock_refresh):
+        documents = iter([{"_id": 1}, {"_id": 2}])
+        self.assertEqual(bulk_index_documents("index", documents), 2)
+        mock_bulk.assert_called_once()
+        self.assertEqual(mock_bulk.call_args[0][1], documents)
+        self.assertEqual(
+            mock_bulk.call_args[1], {"index": "index", "ignore_status": (404, 409)}
+        )
+        mock_refresh.assert_called_once_with(index="index")
+
+    @patch("elasticsearch_dsl.Document.save", side_effect=[None, ConflictError, None])
+    def test_save_document(self, mock_save):
+        doc = DigitalFile.es_doc(meta={"id": 1, "version": 2, "version_type": "a"})
+        self.assertTrue(save_document(doc))
+        mock_save.assert_called_with(refresh=True, version=2, version_type="a")
+        # Rejected if a newer version is indexed
+        self.assertFalse(save_document(doc, refresh=False))
+        doc = DigitalFile.es_doc(meta={"id": 1})
+        save_document(doc)
+        mock_save.assert_called_with(refresh=True)
+
+    def test_get_version(self):
+        self.assertIsNone(get_version(None))
+        self.assertEqual(
+            get_version(
+                datetime(2020, 1, 1, tzinfo=timezone.utc),
+                None,
+                datetime(2020, 1, 1, 0, 0, 1, 5, tzinfo=timezone.utc),
+            ),
+            1577836801000005,
+        )
+        data = {}
+        add_version(data, None)
+        self.assertEqual(data, {})
+        add_version(data, datetime(1970, 1, 2, tzinfo=timezone.utc))
+        self.assertEqual(
+            data, {"_version": 86400000000, "_version_type": "external_gte"}
+        )
+
+    def test_get_fingerprint(self):
+        data = {
+            "_id": 1,
+            "_version": 1,
+            "datemodified": datetime(2020, 1, 1, tzinfo=timezone.utc),
+            "dip": {"id": 1, "title": None},
+            "collection": {},
+        }
+        source = {"dip": {"id": 1}, "datemodified": "2020-01-01T00:00:00+00:00"}
+        self.assertEqual(get_fingerprint(data), get_fingerprint(source))
+        source["dip"]["id"] = 2
+        self.assertNotEqual(get_fingerprint(data), get_fingerprint(source))
+
+    @patch(
+        "elasticsearch.client.IndicesClient.get_alias",
+        return_value={"scope_dips_2": {"aliases": {"scope_dips": {}}}},
+    )
+    @patch(
+        "elasticsearch.client.IndicesClient.get",
+        return_value={"scope_dips_3": {}, "scope_dips_1": {}, "scope_dips_2": {}},
+    )
+    def test_get_versioned_indexes(self, mock_get, mock_get_alias):
+        self.assertEqual(
+            get_versioned_indexes("scope_dips"),
+            (["scope_dips_1", "scope_dips_2", "scope_dips_3"], "scope_dips_2"),
+        )
+        mock_get.assert_called_once_with(index="scope_dips_*", ignore_unavailable=True)
+
+    @patch("elasticsearch.client.IndicesClient.update_aliases")
+    @patch(
+        "elasticsearch.client.IndicesClient.get_alias",
+        return_value={"scope_dips_1": {"aliases": {"scope_dips": {}}}},
+    )
+    @patch("elasticsearch.client.IndicesClient.exists_alias", return_value=True)
+    def test_switch_alias(self, mock_exists_alias, mock_get_alias, mock_update):
+        switch_alias("scope_dips", "scope_dips_2")
+        mock_update.assert_called_once_with(
+            body={
+                "actions": [
+                    {"remove": {"index": "scope_dips_1", "alias": "scope_dips"}},
+                    {"add": {"index": "scope_dips_2", "alias": "scope_dips"}},
+                ]
+            }
+        )
+
+    @patch("elasticsearch.client.IndicesClient.update_aliases")
+    @patch("elasticsearch.client.IndicesClient.exists", return_value=True)
+    @patch("elasticsearch.client.IndicesClient.exists_alias", return_value=False)
+    def test_switch_alias_legacy_index(
+        self, mock_exists_alias, mock_exists, mock_update
+    ):
+        switch_alias("scope_dips", "scope_dips_1")
+        mock_exists.assert_called_once_with(index="scope_dips")
+        mock_update.assert_called_once_with(
+            body={
+                "actions": [
+                    {"remove_index": {"index": "scope_dips"}},
+                    {"add": {"index": "scope_dips_1", "alias": "scope_dips"}},
+                ]
+            }
+        )
+
+    @patch("elasticsearch.client.IndicesClient.delete")
+    @patch("search.helpers.switch_alias")
+    @patch(
+        "search.helpers.get_versioned_indexes",
+        return_value=(["scope_dips_1", "scope_dips_2"], "scope_dips_2"),
+    )
+    def test_rollback_alias(self, mock_get_indexes, mock_switch, mock_delete):
+        self.assertEqual(rollback_alias("scope_dips"), "scope_dips_1")
+        mock_switch.assert_called_once_with("scope_dips", "scope_dips_1")
+        mock_delete.assert_called_once_with(index="scope_dips_2")
+
+    @patch("elasticsearch.client.IndicesClient.delete")
+    @patch("search.helpers.switch_alias")
+    @patch(
+        "search.helpers.get_versioned_indexes",
+        return_value=(["scope_dips_1"], "scope_dips_1"),
+    )
+    def test_rollback_alias_no_previous(
+        self, mock_get_indexes, mock_switch, mock_delete
+    ):
+        with self.assertRaises(ValueError):
+            rollback_alias("scope_dips")
+        mock_switch.assert_not_called()
+        mock_delete.assert_not_called()
+
+    @patch("elasticsearch.client.IndicesClient.delete")
+    @patch(
+        "search.helpers.get_versioned_indexes",
+        return_value=(
+            ["scope_dips_1", "scope_dips_2", "scope_dips_3", "scope_dips_4"],
+            "scope_dips_3",
+        ),
+    )
+    def test_prune_versioned_indexes(self, mock_get_indexes, mock_delete):
+        self.assertEqual(
+            prune_versioned_indexes("scope_dips"), ["scope_dips_1", "scope_dips_4"]
+        )
+        mock_delete.assert_called_once_with(index="scope_dips_1,scope_dips_4")
+
     def test_add_query_to_search_empty_query(self):
         modified_search = add_query_to_search(self.search, "", self.query_fields)
         self.assertTrue("query" not in modified_search.to_dict().keys())
@@ -1,28 +1,37 @@
+from datetime import datetime
+from datetime import timezone
 from unittest.mock import patch
 
 from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.test import TestCase
 
 from scope.models import DIP
 from scope.models import Collection
 from scope.models import DigitalFile
+from search.management.commands.index_data import get_queryset
 
 
+# Patch tqdm and print to disable output
+@patch("search.management.commands.index_data.print")
+@patch("search.management.commands.index_data.tqdm")
 class IndexDataTests(TestCase):
     # This fixture is located in the scope app to avoid duplication
     fixtures = ["index_data"]
 
-    # Patch tqdm and print to disable output
-    @patch("search.management.commands.index_data.print")
-    @patch("search.management.commands.index_data.tqdm")
-    # Patch bulk to avoid ES requests
+    # Patch bulk and the aliases management to avoid ES requests
     @patch("elasticsearch.Elasticsearch.bulk")
+    @patch("elasticsearch.client.IndicesClient.refresh")
+    @patch("search.management.commands.index_data.find_orphans")
+    @patch("elasticsearch.client.IndicesClient.put_settings")
+    @patch("search.management.commands.index_data.prune_versioned_indexes")
+    @patch("search.management.commands.index_data.switch_alias")
     # Mock models get_es_data to check call_counts
     @patch.object(Collection, "get_es_data", return_value={})
     @patch.object(DIP, "get_es_data", return_value={})
-    @patch.object(DigitalFile, "get_es_data", return_value={})
+    @patch.object(DigitalFile, "iter_es_data", return_value=iter([{}] * 12))
     # Mock index create and delete to avoid ES requests and check call_counts
-    @patch("elasticsearch_dsl.Index.create")
+    @patch("elasticsearch_dsl.Index.create", autospec=True)
     @patch("elasticsearch_dsl.Index.delete")
     def test_index_recreation(
         self,
@@ -31,13 +40,168 @@ class IndexDataTests(TestCase):
         mock_df_es_data,
         mock_dip_es_data,
         mock_col_es_data,
+        mock_switch_alias,
+        mock_prune_indexes,
+        mock_es_put_settings,
+        mock_find_orphans,
+        mock_es_refresh,
         mock_es_bulk,
         mock_cmd_tqdm,
         mock_cmd_print,
     ):
+        mock_prune_indexes.return_value = []
+        mock_find_orphans.side_effect = lambda *args, **kwargs: iter(["1"])
         call_command("index_data")
-        self.assertEqual(mock_es_index_delete.call_count, 3)
+        # New indexes are created and the current ones are kept
+        mock_es_index_delete.assert_not_called()
         self.assertEqual(mock_es_index_create.call_count, 3)
-        self.assertEqual(mock_df_es_data.call_count, 12)
+        for model, call in zip(
+            [Collection, DIP, DigitalFile], mock_es_index_create.call_args_list
+        ):
+            alias = model.es_doc._index._name
+            name = call[0][0]._name
+            self.assertRegex(name, r"^%s_\d{14}$" % alias)
+            mock_switch_alias.assert_any_call(alias, name)
+            mock_prune_indexes.assert_any_call(alias)
+            # The documents of the rows deleted while indexing are removed
+            mock_find_orphans.assert_any_call(model, name, fix=True)
+            mock_es_refresh.assert_any_call(index=name)
+        self.assertEqual(mock_switch_alias.call_count, 3)
+        # DigitalFiles are serialized in bulk, nothing changed while indexing
+        self.assertEqual(mock_df_es_data.call_count, 1)
         self.assertEqual(mock_dip_es_data.call_count, 2)
         self.assertEqual(mock_col_es_data.call_count, 2)
+
+    @patch("elasticsearch.Elasticsearch.bulk")
+    @patch("search.management.commands.index_data.find_orphans", return_value=[])
+    @patch("elasticsearch.client.IndicesClient.forcemerge")
+    @patch("elasticsearch.client.IndicesClient.refresh")
+    @patch("elasticsearch.client.IndicesClient.put_settings")
+    @patch("search.management.commands.index_data.prune_versioned_indexes")
+    @patch("search.management.commands.index_data.switch_alias")
+    @patch("elasticsearch_dsl.Index.create", autospec=True)
+    @patch("elasticsearch_dsl.Index.delete")
+    def test_index_options(
+        self,
+        mock_es_index_delete,
+        mock_es_index_create,
+        mock_switch_alias,
+        mock_prune_indexes,
+        mock_es_put_settings,
+        mock_es_refresh,
+        mock_es_forcemerge,
+        mock_find_orphans,
+        mock_es_bulk,
+        mock_cmd_tqdm,
+        mock_cmd_print,
+    ):
+        mock_prune_indexes.return_value = []
+        call_command(
+            "index_data",
+            models=["digital_files"],
+            workers=2,
+            chunk_size=5,
+            force_merge=True,
+        )
+        # The index is created without refresh and replicas
+        mock_es_index_create.assert_called_once()
+        index_name = mock_es_index_create.call_args[0][0]._name
+        index_settings = mock_es_index_create.call_args[0][0]._settings
+        self.assertEqual(index_settings["refresh_interval"], "-1")
+        self.assertEqual(index_settings["number_of_replicas"], 0)
+        # Which are restored at the end
+        mock_es_put_settings.assert_called_once_with(
+            index=index_name,
+            body={"index": {"refresh_interval": None, "number_of_replicas": 0}},
+        )
+        mock_es_forcemerge.assert_called_once_with(index=index_name, max_num_segments=1)
+        # 12 DigitalFiles in chunks of 5
+        bulk_sizes = [
+            len(call[0][0].splitlines()) // 2
+            for call in mock_es_bulk.call_args_list
+            if call[1]["index"] == index_name
+        ]
+        self.assertEqual(sorted(bulk_sizes), [2, 5, 5])
+
+    @patch("elasticsearch.Elasticsearch.bulk", side_effect=RuntimeError)
+    @patch("search.management.commands.index_data.switch_alias")
+    @patch("elasticsearch_dsl.Index.create")
+    @patch("elasticsearch_dsl.Index.delete")
+    def test_index_recreation_error(
+        self,
+        mock_es_index_delete,
+        mock_es_index_create,
+        mock_switch_alias,
+        mock_es_bulk,
+        mock_cmd_tqdm,
+        mock_cmd_print,
+    ):
+        with self.assertRaises(RuntimeError):
+            call_command("index_data", models=["folders"])
+        # The new index is deleted and the alias is not switched
+        mock_es_index_delete.assert_called_once_with(ignore=404)
+        mock_switch_alias.assert_not_called()
+
+    @patch("elasticsearch.Elasticsearch.bulk")
+    @patch("elasticsearch.client.IndicesClient.refresh")
+    @patch.object(DigitalFile, "iter_es_data", return_value=iter([]))
+    @patch.object(DIP, "iter_es_data", return_value=iter([]))
+    @patch.object(Collection, "iter_es_data", return_value=iter([]))
+    @patch("elasticsearch_dsl.Index.create")
+    def test_index_dip(
+        self,
+        mock_es_index_create,
+        mock_col_es_data,
+        mock_dip_es_data,
+        mock_df_es_data,
+        mock_es_refresh,
+        mock_es_bulk,
+        mock_cmd_tqdm,
+        mock_cmd_print,
+    ):
+        call_command("index_data", dip=1)
+        # The documents are updated in the current indexes
+        mock_es_index_create.assert_not_called()
+        mock_col_es_data.assert_not_called()
+        self.assertEqual(
+            list(mock_dip_es_data.call_args[0][0]), list(DIP.objects.filter(pk=1))
+        )
+        self.assertEqual(
+            set(mock_df_es_data.call_args[0][0]),
+            set(DigitalFile.objects.filter(dip_id=1)),
+        )
+        self.assertEqual(mock_es_refresh.call_count, 2)
+        mock_es_refresh.assert_called_with(index=DigitalFile.es_doc._index._name)
+
+    def test_get_queryset_since(self, mock_cmd_tqdm, mock_cmd_print):
+        since = datetime(2021, 1, 1, tzinfo=timezone.utc)
+        self.assertFalse(get_queryset(DigitalFile, since=since).exists())
+        # Modifying a DIP includes its DigitalFiles
+        DIP.objects.filter(pk=2).update(modified=since)
+        self.assertEqual(list(get_queryset(DIP, since=since)), [DIP.objects.get(pk=2)])
+        self.assertEqual(
+            set(get_queryset(DigitalFile, since=since)),
+            set(DigitalFile.objects.filter(dip_id=2)),
+        )
+        self.assertFalse(get_queryset(Collection, since=since).exists())
+        # Modifying a Collection includes its descendants
+        collection = DIP.objects.get(pk=1).collection
+        Collection.objects.filter(pk=collection.pk).update(modified=since)
+        self.assertEqual(
+            list(get_queryset(Collection, since=since, collection=collection.pk)),
+            [collection],
+        )
+        self.assertEqual(
+            set(get_queryset(DigitalFile, since=since)), set(DigitalFile.objects.all())
+        )
+        self.assertFalse(get_queryset(Collection, dip=1).exists())
+
+    @patch(
+        "search.management.commands.index_data.rollback_alias",
+        side_effect=["scope_collections_1", ValueError("No previous index")],
+    )
+    def test_rollback(self, mock_rollback_alias, mock_cmd_tqdm, mock_cmd_print):
+        with self.assertRaises(CommandError):
+            call_command("index_data", rollback=True)
+        mock_rollback_alias.assert_any_call(Collection.es_doc._index._name)
+        mock_rollback_alias.assert_called_with(DIP.es_doc._index._name)
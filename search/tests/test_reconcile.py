@@ -0,0 +1,91 @@
+from unittest.mock import patch
+
+from django.core.management import call_command
+from django.test import TestCase
+
+from scope.models import Collection
+from scope.models import DigitalFile
+from search.reconcile import MISSING
+from search.reconcile import ORPHANED
+from search.reconcile import STALE
+from search.reconcile import find_orphans
+from search.reconcile import reconcile
+
+
+class ReconcileTests(TestCase):
+    # This fixture is located in the scope app to avoid duplication
+    fixtures = ["index_data"]
+
+    @patch("elasticsearch.client.IndicesClient.refresh")
+    @patch("search.reconcile.bulk")
+    @patch("search.reconcile.scan", return_value=iter([{"_id": "2"}, {"_id": "3"}]))
+    @patch("elasticsearch.Elasticsearch.mget")
+    def test_reconcile(self, mock_es_mget, mock_scan, mock_bulk, mock_es_refresh):
+        mock_es_mget.return_value = {
+            "docs": [
+                {"_id": "1", "found": False},
+                {"_id": "2", "found": True, "_source": {"dc": {"identifier": "0"}}},
+            ]
+        }
+        self.assertEqual(
+            list(reconcile(Collection, batch_size=2)),
+            [(MISSING, "1"), (STALE, "2"), (ORPHANED, "3")],
+        )
+        mock_es_mget.assert_called_once_with(
+            index=Collection.es_doc._index._name, body={"ids": ["1", "2"]}
+        )
+        mock_bulk.assert_not_called()
+        mock_es_refresh.assert_not_called()
+
+    @patch("elasticsearch.client.IndicesClient.refresh")
+    @patch("search.reconcile.bulk")
+    @patch("search.reconcile.scan", return_value=iter([{"_id": "1"}, {"_id": "3"}]))
+    @patch("elasticsearch.Elasticsearch.mget")
+    def test_reconcile_fix(self, mock_es_mget, mock_scan, mock_bulk, mock_es_refresh):
+        collection = Collection.objects.get(pk=1)
+        mock_es_mget.return_value = {
+            "docs": [
+                {"_id": "1", "found": True, "_source": collection.get_es_data()},
+                {"_id": "2", "found": False},
+            ]
+        }
+        self.assertEqual(
+            list(reconcile(Collection, fix=True)), [(MISSING, "2"), (ORPHANED, "3")]
+        )
+        index = Collection.es_doc._index._name
+        self.assertEqual(mock_bulk.call_count, 2)
+        self.assertEqual(
+            list(mock_bulk.call_args_list[0][0][1]),
+            [Collection.objects.get(pk=2).get_es_data()],
+        )
+        self.assertEqual(
+            mock_bulk.call_args_list[0][1], {"index": index, "ignore_status": (409,)}
+        )
+        self.assertEqual(
+            list(mock_bulk.call_args_list[1][0][1]),
+            [{"_op_type": "delete", "_id": "3"}],
+        )
+        mock_es_refresh.assert_called_once_with(index=index)
+
+    @patch("search.reconcile.bulk")
+    @patch("search.reconcile.scan", return_value=iter([{"_id": "1"}, {"_id": "3"}]))
+    def test_find_orphans(self, mock_scan, mock_bulk):
+        self.assertEqual(list(find_orphans(Collection, "index_1", fix=True)), ["3"])
+        self.assertEqual(mock_scan.call_args[1]["index"], "index_1")
+        self.assertEqual(
+            list(mock_bulk.call_args[0][1]), [{"_op_type": "delete", "_id": "3"}]
+        )
+        self.assertEqual(mock_bulk.call_args[1]["index"], "index_1")
+
+    @patch("search.management.commands.reconcile_es.print")
+    @patch("search.management.commands.reconcile_es.reconcile")
+    @patch("search.management.commands.reconcile_es.get_counts", return_value=(1, 1))
+    def test_reconcile_es_command(self, mock_get_counts, mock_reconcile, mock_print):
+        mock_reconcile.return_value = iter([(STALE, "uuid")])
+        call_command("reconcile_es", models=["digital_files"], batch_size=10, fix=True)
+        mock_get_counts.assert_called_once_with(DigitalFile)
+        mock_reconcile.assert_called_once_with(DigitalFile, 10, True)
+        mock_print.assert_any_call(" - Stale: uuid")
+        mock_print.assert_called_with(
+            " - 0 missing, 1 stale and 0 orphaned documents fixed."
+        )
@@ -1,10 +1,16 @@
+from unittest.mock import call
 from unittest.mock import patch
 
 from django.test import TestCase
+from django.test import override_settings
 
 from scope.models import DIP
 from scope.models import DigitalFile
+from scope.models import EsOutbox
+from search.tasks import check_es_task
 from search.tasks import delete_es_descendants
+from search.tasks import drain_es_outbox
+from search.tasks import reconcile_es
 from search.tasks import update_es_descendants
 
 
@@ -15,43 +21,82 @@ class TasksTests(TestCase):
         with self.assertRaises(ValueError):
             update_es_descendants("DigitalFile", 1)
 
-    @patch("search.tasks.bulk", return_value=(1, []))
-    @patch("scope.models.Collection.get_es_data_for_files")
-    @patch("scope.models.DigitalFile.objects.filter")
-    def test_update_es_descendants_collection(
-        self, mock_orm_filter, mock_get_es_data, mock_task_bulk
-    ):
-        update_es_descendants("Collection", 1)
-        # The DigitalFiles should be filtered
-        mock_orm_filter.assert_called_with(dip__collection__pk=1)
-        # The Collection data should be obtained (actual
-        # data is tested in `test_models_to_docs`)
-        mock_get_es_data.assert_called()
-        # It's hard to assert the bulk call parameters as the second
-        # one is a generator so we'll only check that it has been called.
-        mock_task_bulk.assert_called()
+    @patch("search.tasks.write_documents", return_value=1)
+    def test_update_es_descendants(self, mock_write_documents):
+        for class_name, queryset in [
+            ("Collection", DigitalFile.objects.filter(dip__collection__pk=1)),
+            ("DIP", DigitalFile.objects.filter(dip__pk=1)),
+        ]:
+            update_es_descendants(class_name, 1)
+            # The DigitalFiles documents are written with their version
+            args = mock_write_documents.call_args[0]
+            self.assertEqual(args[0], DigitalFile.es_doc._index._name)
+            documents = list(args[1])
+            self.assertEqual(documents, list(DigitalFile.iter_es_data(queryset)))
+            self.assertTrue(documents)
+            self.assertTrue(all("_version" in document for document in documents))
 
-    @patch("search.tasks.bulk", return_value=(1, []))
-    @patch("scope.models.DIP.get_es_data_for_files")
-    @patch("scope.models.DigitalFile.objects.filter")
-    def test_update_es_descendants_dip(
-        self, mock_orm_filter, mock_get_es_data, mock_task_bulk
+    @override_settings(ES_UPDATE_BY_QUERY=True, ES_TASK_CHECK_INTERVAL=5)
+    @patch("search.tasks.check_es_task.apply_async")
+    @patch("search.tasks.write_documents")
+    @patch(
+        "elasticsearch.Elasticsearch.update_by_query",
+        return_value={"task": "node:1"},
+    )
+    def test_update_es_descendants_by_query(
+        self, mock_es_update, mock_write_documents, mock_check_es_task
     ):
-        update_es_descendants("DIP", 1)
-        # The DigitalFiles should be filtered
-        mock_orm_filter.assert_called_with(dip__pk=1)
-        # The DIP data should be obtained (actual
-        # data is tested in `test_models_to_docs`)
-        mock_get_es_data.assert_called()
-        # It's hard to assert the bulk call parameters as the second
-        # one is a generator so we'll only check that it has been called.
-        mock_task_bulk.assert_called()
+        for class_name, field in [("Collection", "collection.id"), ("DIP", "dip.id")]:
+            update_es_descendants(class_name, 1)
+            kwargs = mock_es_update.call_args[1]
+            self.assertEqual(kwargs["index"], DigitalFile.es_doc._index._name)
+            self.assertEqual(kwargs["body"]["query"], {"match": {field: 1}})
+            # Only the documents written before the ancestor changed are updated
+            self.assertIn("ctx._version", kwargs["body"]["script"]["source"])
+            self.assertEqual(
+                kwargs["body"]["script"]["params"]["version"], 1577836800000000
+            )
+            self.assertEqual(kwargs["slices"], "auto")
+            self.assertFalse(kwargs["wait_for_completion"])
+            # The ES task is checked in the background
+            mock_check_es_task.assert_called_with(
+                ("node:1", class_name, 1), countdown=5
+            )
+        mock_write_documents.assert_not_called()
 
-    @patch("search.tasks.logger.info")
-    @patch("search.tasks.bulk", return_value=(1, ["error_1", "error_2"]))
-    def test_update_es_descendants_errors_logged(self, mock_task_bulk, mock_log_info):
-        update_es_descendants("DIP", 1)
-        self.assertEqual(mock_log_info.call_count, 5)
+    @override_settings(ES_TASK_CHECK_INTERVAL=5)
+    @patch("search.tasks.set_update_running")
+    @patch("search.tasks.request_descendants_update")
+    @patch("search.tasks.check_es_task.apply_async")
+    @patch("elasticsearch.client.TasksClient.get")
+    def test_check_es_task(
+        self, mock_es_get_task, mock_check_es_task, mock_request_update, mock_running
+    ):
+        status = {"total": 3, "updated": 1, "version_conflicts": 0}
+        mock_es_get_task.return_value = {"completed": False, "task": {"status": status}}
+        with self.assertLogs("search.tasks", "INFO") as logs:
+            check_es_task("node:1")
+        mock_es_get_task.assert_called_with(task_id="node:1")
+        mock_check_es_task.assert_called_once_with(("node:1", None, None), countdown=5)
+        self.assertIn("in progress: 1/3", logs.output[0])
+        status = {"total": 3, "updated": 2, "version_conflicts": 1}
+        mock_es_get_task.return_value = {
+            "completed": True,
+            "task": {"status": status},
+            "response": {"failures": ["error"]},
+        }
+        with self.assertLogs("search.tasks", "INFO") as logs:
+            check_es_task("node:1")
+        mock_check_es_task.assert_called_once()
+        self.assertIn("completed: 2/3 documents updated, 1 version", logs.output[0])
+        self.assertEqual(len(logs.output), 3)
+        mock_request_update.assert_not_called()
+        mock_running.assert_not_called()
+        # The descendants are updated again after version conflicts
+        with self.assertLogs("search.tasks", "INFO"):
+            check_es_task("node:1", "DIP", 1)
+        mock_running.assert_called_once_with("DIP", 1, False)
+        mock_request_update.assert_called_once_with("DIP", 1)
 
     def test_delete_es_descendants_wrong_class(self):
         with self.assertRaises(ValueError):
@@ -79,3 +124,55 @@ class TasksTests(TestCase):
     def test_delete_es_descendants_errors_logged(self, mock_es_delete, mock_log_info):
         delete_es_descendants("DIP", 1)
         self.assertEqual(mock_log_info.call_count, 4)
+
+    @patch("search.tasks.reconcile")
+    @patch("search.tasks.get_counts", return_value=(2, 3))
+    def test_reconcile_es(self, mock_get_counts, mock_reconcile):
+        mock_reconcile.side_effect = [
+            iter([]),
+            iter([("missing", "1"), ("orphaned", "3")]),
+            iter([]),
+        ]
+        with self.assertLogs("search.tasks", "INFO") as logs:
+            reconcile_es(fix=True)
+        mock_reconcile.assert_called_with(DigitalFile, fix=True)
+        self.assertEqual(len(logs.output), 4)
+        self.assertEqual(
+            logs.output[2],
+            "WARNING:search.tasks:DIP: 1 missing, 0 stale and 1 orphaned "
+            "documents fixed.",
+        )
+
+    @patch("search.tasks.delete_es_descendants.delay")
+    @patch("search.tasks.request_descendants_update")
+    @patch("search.tasks.write_documents", return_value=2)
+    def test_drain_es_outbox(
+        self, mock_write_documents, mock_update_request, mock_delete_delay
+    ):
+        for model_name, object_id, operation in [
+            ("DIP", "1", EsOutbox.SYNC),
+            ("DIP", "1", EsOutbox.UPDATE_DESCENDANTS),
+            ("DIP", "3", EsOutbox.SYNC),
+            ("DIP", "1", EsOutbox.SYNC),
+            ("Collection", "2", EsOutbox.UPDATE_DESCENDANTS),
+            ("Collection", "1", EsOutbox.DELETE_DESCENDANTS),
+            ("Collection", "1", EsOutbox.UPDATE_DESCENDANTS),
+        ]:
+            EsOutbox.objects.create(
+                model_name=model_name, object_id=object_id, operation=operation
+            )
+        drain_es_outbox()
+        # The documents are synced once, deleting the missing ones
+        mock_write_documents.assert_called_once()
+        self.assertEqual(mock_write_documents.call_args[0][0], DIP.es_doc._index._name)
+        self.assertEqual(
+            list(mock_write_documents.call_args[0][1]),
+            [DIP.objects.get(pk=1).get_es_data(), {"_op_type": "delete", "_id": "3"}],
+        )
+        # The descendants of deleted ancestors are not updated
+        self.assertEqual(
+            mock_update_request.call_args_list,
+            [call("DIP", 1), call("Collection", 2)],
+        )
+        mock_delete_delay.assert_called_once_with("Collection", 1)
+        self.assertFalse(EsOutbox.objects.exists())